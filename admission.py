@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control for expensive requests
+
+Each class of expensive request (large transfers, uploads, exports built on the request
+thread, preview builds) has a Limiter: at most `concurrent` of them run at once, at most
+`queued` more wait (for up to `wait` seconds) for a free slot, and one user may hold at
+most `per_user` slots, running or waiting, at a time (0 for no per-user limit). Anything
+beyond that is turned away straight away with Busy, so the server's threads stay free for
+cheap pages instead of piling up behind a burst of expensive ones.
+"""
+
+import time
+import threading
+
+
+class Busy(Exception):
+  pass
+
+
+class Limiter(object):
+  def __init__(self, name, concurrent, queued=0, per_user=0, wait=10):
+    self.name = name
+    self.concurrent = concurrent
+    self.queued = queued
+    self.per_user = per_user
+    self.wait = wait
+    self.condition = threading.Condition()
+    self.active = 0
+    self.waiting = 0
+    self.users = {}  # user: slots held or waited for
+
+  def acquire(self, user):
+    # Takes a slot for user, waiting if allowed. Raises Busy when turned away
+    with self.condition:
+      if self.per_user and self.users.get(user, 0) >= self.per_user:
+        raise Busy('You already have %d %s in progress. Please wait for them to finish.'
+          % (self.users[user], self.name))
+      if self.active >= self.concurrent and self.waiting >= self.queued:
+        raise Busy('The server is busy with other %s. Please try again shortly.' % self.name)
+      self.users[user] = self.users.get(user, 0) + 1
+      if self.active >= self.concurrent:
+        self.waiting += 1
+        deadline = time.time() + self.wait
+        try:
+          while self.active >= self.concurrent:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+              self._forget(user)
+              raise Busy('The server is busy with other %s. Please try again shortly.'
+                % self.name)
+            self.condition.wait(remaining)
+        finally:
+          self.waiting -= 1
+      self.active += 1
+
+  def release(self, user):
+    with self.condition:
+      self.active -= 1
+      self._forget(user)
+      self.condition.notify()
+
+  def _forget(self, user):
+    self.users[user] -= 1
+    if not self.users[user]:
+      del self.users[user]
+
+  def info(self):
+    with self.condition:
+      return {'concurrent': self.concurrent, 'queued': self.queued,
+        'per_user': self.per_user, 'active': self.active, 'waiting': self.waiting}
@@ -16,21 +16,50 @@ Original code respository @ https://github.com/alhamood/STG-database-project
 @author: Albert W. Hamood
 """
 
-from flask import Flask, render_template, request, redirect, url_for, g, make_response, send_from_directory, session
+import time
+startup_started = time.time()  # For the startup timing report, see /health
+
+from flask import Flask, render_template, request, redirect, url_for, g, make_response, send_from_directory, session, send_file, jsonify
 from flask.ext.login import LoginManager, UserMixin, login_required
 from wtforms import Form, validators, fields, widgets
 from werkzeug import secure_filename
+from werkzeug.wsgi import ClosingIterator
 from shutil import rmtree
+from io import BytesIO
+from background_jobs import JobQueue, QueueFull
+from admission import Limiter, Busy
+from snapshot_tool import TakeSnapshot, ListSnapshots
+from binary_store import WriteBinary, LoadBinary
+from derived_metrics import ComputeMetrics, DERIVED_COLUMNS, Number
+from trace_preview import Envelope, PreviewSvg, PreviewError
+from thumbnails import IsImage, MakePreviews, CachedPath, Touch, PruneCache
+from thumbnails import SIZES as THUMBNAIL_SIZES, AVAILABLE as THUMBNAILS_AVAILABLE
+from search_index import SearchIndex
+from change_feed import ChangeFeed
+from replica import Primary
+from shard_store import ShardStore, WriteShards, ExperimentOf
+from blob_store import OpenStore
 import os
+import re
 import sys
 import zipfile
 import random
 import string
 import logging
+import hmac
 import hashlib
+import functools
+import threading
+import mimetypes
 import flask.ext.login
+from collections import OrderedDict
+from jinja2 import FileSystemBytecodeCache
 import simplejson as json
-import pandas as pd
+# pandas is slow to import, so it is imported in the functions that use it
+if sys.version_info[0] < 3:
+  string_types = (str, unicode)
+else:
+  string_types = (str,)
 
 # Initialize application using the Flask module
 app = Flask(__name__)
@@ -54,33 +83,318 @@ experiment_flags_global = ['VoltageClamp', 'TempRamp', 'IsolatedNeurons', 'Dynam
 app.logger.addHandler(logging.StreamHandler(sys.stdout))
 app.logger.setLevel(logging.ERROR)
 
-# The following bits load in databases for users, metadata, and processed data
-# as well as for basic web server configuration
-with open('config.json') as json_data:
-  config = json.load(json_data)
-  json_data.close()
+# Time taken by each startup phase, in seconds, as [phase, seconds] pairs
+startup_timings = [['imports', time.time()-startup_started]]
 
 
-with open('databases/user_pdatabase.json') as json_data:
-  user_pdatabase = json.load(json_data)
-  json_data.close()
+def TimePhase(phase, started):
+  startup_timings.append([phase, time.time()-started])
 
 
-with open('databases/user_database.json') as json_data:
-  user_database = json.load(json_data)
-  json_data.close()
-    
-  
-with open('databases/metadata.json') as json_data:
-  metadata = json.load(json_data)
-  json_data.close()
-  
-  
-with open('databases/processed_data.json') as json_data:
-  proc_data = json.load(json_data)
+# The following bits load in basic web server configuration, and set up the databases
+# for users, metadata, and processed data. The databases start empty and are read in
+# the background by LoadDatabases, so the server can answer health checks right away.
+phase_started = time.time()
+with open('config.json') as json_data:
+  config = json.load(json_data)
   json_data.close()
+TimePhase('config', phase_started)
+
+# A read replica (ReplicaOf set to the primary's address, or the REPLICA_OF environment
+# variable) copies the primary's databases and files and follows its changes, see
+# replica.py. It keeps its own job directory and, unless it shares the primary's files
+# directory or object store, its own copy of the files, named after its port
+config['ReplicaOf'] = os.environ.get('REPLICA_OF', config.get('ReplicaOf', ''))
+replica_copies_files = config.get('ReplicaSharesFiles', 0) != 1 and \
+  config.get('BlobStorage', 'local') != 's3'
+if config['ReplicaOf']:
+  replica_suffix = '-replica-%d/' % int(os.environ.get('PORT', 80))
+  config['JobPath'] = config.get('JobPath', 'jobs/').rstrip('/') + replica_suffix
+  if replica_copies_files:
+    config['FilePath'] = config['FilePath'].rstrip('/') + replica_suffix
+    if not os.path.isdir(config['FilePath']):
+      os.makedirs(config['FilePath'])
+replica_status = {'since': None, 'synced': None, 'error': None}
+
+# Uploaded files are kept in the FilePath directory, or with BlobStorage "s3" in an
+# S3-compatible object store that several servers can share, see blob_store.py
+blobs = OpenStore(config)
+
+user_pdatabase = {}
+user_database = {}
+# With ShardedStorage, metadata and processed data are stored one experiment per file and
+# only recently used processed data is held in memory, see shard_store.py. Replicas keep
+# plain dicts, as they never save
+SHARDED_DATABASES = ['metadata', 'processed_data']
+shards = None
+if config.get('ShardedStorage', 0) == 1 and not config['ReplicaOf']:
+  shards = ShardStore('databases/shards', config.get('ShardCacheMB', 64) * 2**20)
+  metadata = shards.metadata
+  proc_data = shards.conditions
+else:
+  metadata = {}
+  proc_data = {}
+file_manifest = {}
+derived_metrics = {}  # Computed from metadata and proc_data, see derived_metrics.py
+METRICS_BATCH = 1000  # Experiments computed together at startup
+search_index = SearchIndex()  # Notes, READ_ME text, IDs and names, see search_index.py
+databases_loaded = threading.Event()
+database_load_error = []
+
+
+# All writes of the json databases go through SaveDatabase. Each write (and each change
+# to uploaded files) bumps data_version, which keys cached exports and archives.
+# The two large databases also get a binary copy for fast startup, see binary_store.py
+BINARY_DATABASES = ['metadata', 'processed_data']
+databases = {'metadata': metadata, 'processed_data': proc_data,
+  'user_database': user_database, 'user_pdatabase': user_pdatabase,
+  'file_manifest': file_manifest}
+db_lock = threading.RLock()
+data_version = 0
+
+# Saves are also recorded in the change feed (see change_feed.py), except the password
+# database. It is opened by the startup loader
+FEED_DATABASES = ['metadata', 'processed_data', 'file_manifest', 'user_database']
+change_feed = None
+
+
+def BumpDataVersion():
+  global data_version
+  with db_lock:
+    data_version += 1
+
+
+def SaveDatabase(name, *keys):
+  # Writes one of the json databases in /databases from its in-memory copy. The file is
+  # replaced in one step, so a copy taken at any moment (backups) is never half written.
+  # Pass the keys of the rows that were changed, added or removed (experiments for
+  # metadata and file manifests, conditions for processed data), so the change feed and
+  # sharded storage only look at those; without keys every row is compared.
+  if config['ReplicaOf']:
+    raise RuntimeError('A read replica does not save databases')
+  with db_lock:
+    changed = set(keys) or None
+    if shards is not None and name in SHARDED_DATABASES:
+      changed = SaveShards(name, keys)
+    else:
+      with open('databases/'+name+'.json.tmp', 'w') as outfile:
+        json.dump(databases[name], outfile)
+      os.rename('databases/'+name+'.json.tmp', 'databases/'+name+'.json')
+      if name in BINARY_DATABASES:
+        WriteBinary(databases[name], 'databases/'+name+'.bin', 'databases/'+name+'.json')
+    if change_feed is not None and name in FEED_DATABASES:
+      change_feed.record(name, databases[name], changed)
+    BumpDataVersion()
+
+
+def SaveShards(name, keys):
+  # Saves the experiments changed in metadata or processed data. Returns the keys of the
+  # rows that may have changed, or None if any may have
+  if name == 'metadata':
+    changed = metadata.take_dirty() | set(keys)
+    if not keys:  # Rows changed in place are found by comparing them all
+      shards.save(changed | shards.changed_metadata())
+      return None
+    shards.save(changed)
+    return changed
+  changed = proc_data.take_dirty() | set(keys)
+  shards.save(set(ExperimentOf(key) for key in changed))
+  return changed
+
+
+# Compiled templates are cached on disk, so they survive restarts
+if not os.path.isdir(config.get('TemplateCachePath', 'template-cache/')):
+  os.makedirs(config.get('TemplateCachePath', 'template-cache/'))
+app.jinja_options = dict(Flask.jinja_options,
+  bytecode_cache=FileSystemBytecodeCache(config.get('TemplateCachePath', 'template-cache/')))
+
+
+# Worker pool for archives and full exports, see background_jobs.py
+phase_started = time.time()
+jobs = JobQueue(config.get('JobPath', 'jobs/'), workers=config.get('JobWorkers', 2),
+  max_results=config.get('JobResultsKept', 20), max_pending=config.get('JobQueueMax', 20))
+# Image previews have a queue of their own, so their many small jobs do not push finished
+# archives and exports out of "JobResultsKept". Their jobs write no result files; keeping
+# them only remembers images that could not be read
+thumbnail_jobs = JobQueue(config.get('JobPath', 'jobs/').rstrip('/')+'-thumbnails/', workers=1,
+  max_results=500, max_pending=config.get('JobQueueMax', 20))
+TimePhase('job workers', phase_started)
+
+
+# Concurrency limits for expensive requests, see admission.py. config.json entries in
+# "ConcurrencyLimits" override these per class
+CONCURRENCY_LIMITS = {
+  'transfers': {'Concurrent': 4, 'Queued': 8, 'PerUser': 2},  # Archive and export files
+  'exports': {'Concurrent': 2, 'Queued': 4, 'PerUser': 1},  # Exports built per request
+  'uploads': {'Concurrent': 2, 'Queued': 4, 'PerUser': 1},
+  'previews': {'Concurrent': 2, 'Queued': 8, 'PerUser': 0},  # Recording preview builds
+  'feeds': {'Concurrent': 16, 'Queued': 0, 'PerUser': 2}}  # Change feed long-polls
+limiters = {}
+for limit_name, limit in CONCURRENCY_LIMITS.items():
+  limit = dict(limit, **config.get('ConcurrencyLimits', {}).get(limit_name, {}))
+  limiters[limit_name] = Limiter(limit_name, limit['Concurrent'], limit['Queued'],
+    limit['PerUser'], config.get('QueueWaitSeconds', 10))
+
+
+def LoadDatabases():
+  # Runs on a background thread at startup. Requests (other than /health) wait for it
+  global change_feed
+  try:
+    unsharded = {}  # Sharded databases read from json, the first time shards are used
+    for name in ['user_pdatabase', 'user_database', 'metadata', 'processed_data',
+        'file_manifest']:
+      phase_started = time.time()
+      if name == 'file_manifest' and not os.path.exists('databases/file_manifest.json'):
+        continue  # Installs from before manifests; built by the reconcile below
+      target = databases[name]
+      if shards is not None and name in SHARDED_DATABASES:
+        if not shards.new:
+          continue
+        target = unsharded[name] = {}
+      if name in BINARY_DATABASES:
+        data = LoadBinary('databases/'+name+'.bin', 'databases/'+name+'.json')
+        if data is not None:
+          target.update(data)
+          TimePhase('load '+name+' (binary)', phase_started)
+          continue
+      with open('databases/'+name+'.json') as json_data:
+        target.update(json.load(json_data))
+      if name in BINARY_DATABASES and shards is None:
+        # Missing or stale, so the next start can use it
+        WriteBinary(databases[name], 'databases/'+name+'.bin', 'databases/'+name+'.json')
+      TimePhase('load '+name, phase_started)
+    if shards is not None:
+      phase_started = time.time()
+      if shards.new:
+        WriteShards(shards.path, unsharded['metadata'], unsharded['processed_data'])
+        unsharded.clear()
+      shards.load()
+      TimePhase('load shard index', phase_started)
+    phase_started = time.time()
+    feed = ChangeFeed('databases', config.get('ChangeFeedKept', 100000))
+    with db_lock:
+      for name in FEED_DATABASES:
+        if feed.new:  # Starts from the current data; mirrors begin with a snapshot
+          feed.prime(name, databases[name])
+        else:  # Picks up changes made while the server was stopped
+          feed.record(name, databases[name])
+      if feed.new:
+        feed.save_base()
+      change_feed = feed
+    TimePhase('change feed', phase_started)
+    phase_started = time.time()
+    ReconcileAllManifests()
+    TimePhase('reconcile file manifests', phase_started)
+    phase_started = time.time()
+    import pandas
+    TimePhase('import pandas', phase_started)
+    phase_started = time.time()
+    # In batches of experiments, so sharded storage reads each shard once, through its
+    # cache, and the frame of conditions stays small
+    exp_names = sorted(metadata.keys())
+    for start in range(0, len(exp_names), METRICS_BATCH):
+      derived_metrics.update(ComputeMetrics(metadata, proc_data,
+        exp_names[start:start+METRICS_BATCH]))
+    TimePhase('derived metrics', phase_started)
+    phase_started = time.time()
+    for exp_name in list(metadata.keys()):
+      IndexExperiment(exp_name)
+    TimePhase('search index', phase_started)
+  except Exception as e:
+    database_load_error.append(str(e))
+    app.logger.error('Loading databases failed: '+str(e))
+  TimePhase('total', startup_started)
+  app.logger.info('Startup timings (s): '+', '.join(
+    '%s %.3f' % (phase, seconds) for phase, seconds in startup_timings))
+  databases_loaded.set()
+
+
+def CopyPrimary(primary):
+  # Replaces the replica's databases (and files) with the primary's. Returns the feed
+  # version to follow changes from
+  versions = []
+  rows = {}
+  for name in FEED_DATABASES:
+    version, rows[name] = primary.snapshot(name)
+    versions.append(version)
+  if primary.file_path:
+    for exp_name in set(file_manifest) | set(rows['file_manifest']):
+      primary.sync_files(exp_name, file_manifest.get(exp_name, []),
+        rows['file_manifest'].get(exp_name, []))
+  with db_lock:
+    for name in FEED_DATABASES:
+      databases[name].clear()
+      databases[name].update(rows[name])
+    derived_metrics.clear()
+    derived_metrics.update(ComputeMetrics(metadata, proc_data))
+    for exp_name in set(search_index.lengths) | set(metadata):
+      IndexExperiment(exp_name)
+    BumpDataVersion()
+  # Snapshots are taken one after another, so changes after the oldest may already be in
+  # the later ones. Applying those again leaves the same rows
+  return min(versions)
+
+
+def ApplyChanges(primary, changes):
+  # Applies a page of change feed changes, in order
+  touched = set()
+  for change in changes:
+    name, key, op, row = change['database'], change['key'], change['op'], change['row']
+    if name == 'file_manifest' and primary.file_path:
+      primary.sync_files(key, file_manifest.get(key, []), row or [])
+    with db_lock:
+      if op == 'delete':
+        databases[name].pop(key, None)
+      else:
+        databases[name][key] = row
+    if name in ('metadata', 'file_manifest'):
+      touched.add(key)
+    elif name == 'processed_data':
+      touched.add(key.rsplit('_', 1)[0])
+  if touched:
+    with db_lock:
+      RefreshDerivedMetrics(*touched)
+      for exp_name in touched:
+        IndexExperiment(exp_name)
+      BumpDataVersion()
+
+
+def FollowPrimary():
+  # Runs on a background thread at startup in replica mode, instead of LoadDatabases.
+  # The token lets the replica copy user details, which pages show
+  if not config.get('ReplicaToken', ''):
+    database_load_error.append('ReplicaToken must be set to follow a primary')
+    app.logger.error(database_load_error[0])
+    databases_loaded.set()
+    return
+  primary = Primary(config['ReplicaOf'],
+    config['FilePath'] if replica_copies_files else None,
+    config.get('ReplicaToken', ''))
+  since = None
+  while True:
+    try:
+      if since is None:
+        phase_started = time.time()
+        since = CopyPrimary(primary)
+        if not databases_loaded.is_set():
+          TimePhase('copy from primary', phase_started)
+          TimePhase('total', startup_started)
+          databases_loaded.set()
+      feed = primary.changes(since, wait=30)
+      if feed['resync']:
+        app.logger.error('Replica fell behind the change feed, copying the primary again')
+        since = None
+        continue
+      ApplyChanges(primary, feed['changes'])
+      since = feed['version']
+      replica_status.update(since=since, synced=time.time(), error=None)
+    except Exception as e:
+      replica_status['error'] = str(e)
+      app.logger.error('Following the primary failed: '+str(e))
+      time.sleep(10)
+
+
 
-  
 # Basic user class, required for Flask-Login which handles user sessions
 class User(UserMixin):
   pass
@@ -284,6 +598,7 @@ class ProcessedDataForm(Form):
 
 # Functions for making dataframes from databases to serve in html templates     
 def MakeDF(data, column_names):
+  import pandas as pd
   df = pd.DataFrame(data.values(), columns = column_names)
   df.index = user_database.keys() 
   return df
@@ -293,32 +608,510 @@ def MakeMetaDF(data):
   column_names = ['User', 'Exp ID', 'Exp Date','Animal Date', 'Experimenter', 'Lab',
     'Temp (C)', 'Tank Temp (C)', 'Species', 'Saline', 'Intra Sol.', 'Conditions',
     'Files', 'Nerves', 'Neurons', 'Flags', 'Notes']
+  import pandas as pd
   df = pd.DataFrame(data.values(), columns = column_names, index=data.keys())
   df = df.sort_values(by='Exp Date')
   return df
 
 
+COND_COLUMNS = ['cond_name', 'temp', 'pyl_hz','pyl_cycvar','pyl_niqr','gas_hz','gas_cycvar',
+  'gas_niqr','pd_off','pd_spikes','lp_on','lp_off','lp_spikes','py_on','py_off',
+  'py_spikes','vd_on','vd_off','vd_spikes','lg_off','lg_spikes','dg_on','dg_off',
+  'dg_spikes','gm_on','gm_off','gm_spikes','mg_on','mg_off','mg_spikes', 'blank1',
+  'blank2', 'blank3']
+
+
 def MakeCondDF(data):
-  column_names = ['cond_name', 'temp', 'pyl_hz','pyl_cycvar','pyl_niqr','gas_hz','gas_cycvar',
-    'gas_niqr','pd_off','pd_spikes','lp_on','lp_off','lp_spikes','py_on','py_off',
-    'py_spikes','vd_on','vd_off','vd_spikes','lg_off','lg_spikes','dg_on','dg_off',
-    'dg_spikes','gm_on','gm_off','gm_spikes','mg_on','mg_off','mg_spikes', 'blank1',
-    'blank2', 'blank3']
-  df = pd.DataFrame(proc_data.values(), columns=column_names, index=proc_data.keys())
+  import pandas as pd
+  df = pd.DataFrame(data.values(), columns=COND_COLUMNS, index=data.keys())
   df = df.sort_index()
   return df
 
 
+class TableCache(object):
+  # Least-recently-used cache of rendered html tables, bounded by total size of the html
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.size = 0
+    self.tables = OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, key, render):
+    with self.lock:
+      if key in self.tables:
+        html = self.tables.pop(key)
+        self.tables[key] = html
+        return html
+    html = render()
+    with self.lock:
+      if key not in self.tables and len(html) <= self.max_bytes:
+        self.tables[key] = html
+        self.size += len(html)
+        while self.size > self.max_bytes:
+          self.size -= len(self.tables.popitem(last=False)[1])
+    return html
+
+
+table_cache = TableCache(int(config.get('TableCacheMB', 32)*1e6))
+
+
+def CachedTableHtml(view, params, render):
+  # Rendered table for a page view, reused until the data version changes
+  return table_cache.get((view, data_version) + tuple(params), render)
+
+
+def UserMetaDF(user_id):
+  # Metadata for the experiments a user may edit (Admin sees all), without notes
+  metadata_df = MakeMetaDF(metadata)
+  if user_id != 'Admin':
+    metadata_df = metadata_df.loc[metadata_df.loc[:,'User']==user_id,:]
+  metadata_df.index = range(len(metadata_df))
+  return metadata_df.drop('Notes', axis=1)
+
+
+def FilesMetaDF():
+  # Metadata for experiments that have uploaded files, as listed on dl-files-page
+  metadata_df = MakeMetaDF(metadata)
+  metadata_df = metadata_df.drop('Notes', axis=1)
+  metadata_df = metadata_df.loc[metadata_df.loc[:,'Files']>1,:]
+  metadata_df.index = range(len(metadata_df))
+  return metadata_df
+
+
+def ConditionKeys(exp_name):
+  # Processed data keys of an experiment's conditions, in condition order. Looked up one by
+  # one, so only this experiment's rows are read (and only its shard, when sharded)
+  return [key for key in (exp_name+'_'+str(condnum)
+    for condnum in range(metadata[exp_name][11])) if key in proc_data]
+
+
+def ConditionRows(exp_names):
+  # {key: row} of experiments' conditions, read one experiment (shard) at a time
+  return OrderedDict((key, proc_data[key]) for exp_name in exp_names if exp_name in metadata
+    for key in ConditionKeys(exp_name))
+
+
+def ConditionsTableHtml(exp_name):
+  def render():
+    import pandas as pd
+    conditions_df = pd.DataFrame([proc_data[key] for key in ConditionKeys(exp_name)],
+      columns=COND_COLUMNS)
+    conditions_df = conditions_df.dropna(axis=1, how='all')
+    return conditions_df.to_html()
+  return CachedTableHtml('conditions', (exp_name,), render)
+
+
+def DerivedTableHtml(exp_name):
+  # One experiment's derived metrics, leaving out those that could not be computed
+  def render():
+    rows = {exp_name: derived_metrics[exp_name]} if exp_name in derived_metrics else {}
+    return MakeDerivedDF(rows).dropna(axis=1, how='all').to_html()
+  return CachedTableHtml('derived', (exp_name,), render)
+
+
+def FilenamesTableHtml(exp_name):
+  def render():
+    import pandas as pd
+    rows = [[name, size, time.strftime('%Y-%m-%d %H:%M', time.localtime(mtime)), filetype]
+      for name, size, mtime, sha, filetype in file_manifest.get(exp_name, [])]
+    return pd.DataFrame(rows, columns=['Filename', 'Size (bytes)', 'Modified', 'Type']).to_html()
+  return CachedTableHtml('filenames', (exp_name,), render)
+
+
+def UsersTableHtml():
+  def render():
+    users_df = MakeDF(user_database, ['Email', 'Surname', 'Lab', 'UploadFlag'])
+    for username in user_database.keys():
+      users_df.loc[username, 'Experiments'] = sum([username in key for key in metadata.keys()])
+    return users_df.to_html()
+  return CachedTableHtml('users', (), render)
+
+
+def MakeDerivedDF(data):
+  import pandas as pd
+  df = pd.DataFrame(list(data.values()), columns=DERIVED_COLUMNS, index=list(data.keys()))
+  return df.sort_index()
+
+
+def ExperimentMetaHtml(exp_name):
+  # One experiment's metadata, one field per row
+  def render():
+    return MakeMetaDF({exp_name: metadata[exp_name]}).T.to_html(header=False)
+  return CachedTableHtml('experiment-meta', (exp_name,), render)
+
+
+def ExperimentDigest(exp_name):
+  # Identifies everything shown on an experiment's public page, for its ETag
+  conditions = [proc_data.get(exp_name+'_'+str(condnum))
+    for condnum in range(metadata[exp_name][11])]
+  text = json.dumps([metadata[exp_name], conditions, derived_metrics.get(exp_name),
+    file_manifest.get(exp_name, [])], default=str)
+  return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def RefreshDerivedMetrics(*exp_names):
+  # Recomputes experiments' derived metrics. Call before saving their changes
+  with db_lock:
+    for exp_name in exp_names:
+      derived_metrics.pop(exp_name, None)
+    derived_metrics.update(ComputeMetrics(metadata, proc_data, list(exp_names)))
+
+
+def IndexExperiment(exp_name):
+  # Updates an experiment's search index entry. Call after changing its metadata or
+  # READ_ME.txt, or deleting it
+  if exp_name not in metadata:
+    search_index.remove(exp_name)
+    return
+  data = metadata[exp_name]
+  readme = ''
+  if ManifestEntry(exp_name, 'READ_ME.txt') is not None:
+    readme = blobs.read(exp_name, 'READ_ME.txt').decode('utf-8', 'replace')
+  search_index.update(exp_name, {'id': exp_name+' '+data[1], 'experimenter': data[4],
+    'lab': data[5], 'notes': data[16], 'readme': readme})
+
+
+# ProcessedDataForm fields in processed data row order (slot 0 is the condition name).
+# Batch edits also accept 'temp', the column name used in exports, for exp_temp
+PROC_FIELDS = ['exp_temp', 'pyl_hz', 'pyl_cycvar', 'pyl_niqr', 'gas_hz', 'gas_cycvar',
+  'gas_niqr', 'pd_off', 'pd_spikes', 'lp_on', 'lp_off', 'lp_spikes', 'py_on', 'py_off',
+  'py_spikes', 'vd_on', 'vd_off', 'vd_spikes', 'lg_off', 'lg_spikes', 'dg_on', 'dg_off',
+  'dg_spikes', 'gm_on', 'gm_off', 'gm_spikes', 'mg_on', 'mg_off', 'mg_spikes', 'blank1',
+  'blank2', 'blank3']
+
+
+def FormText(value):
+  # A patch value as form input text; repr keeps all digits of floats under python 2.
+  # Whole floats drop the '.0', so 12.0 is accepted where an integer is expected
+  if value is None:
+    return ''
+  if isinstance(value, float):
+    return '%d' % value if value.is_integer() else repr(value)
+  return '%s' % value
+
+
+def PatchConditionRow(row, patch):
+  """
+  Returns (new row, errors) for a processed data row with some fields replaced, given as
+  {field: value} (None or '' clears a field). Patched fields are checked exactly as the
+  processed data form checks them; other fields are left as they are.
+  """
+  from werkzeug.datastructures import MultiDict
+  if not isinstance(patch, dict) or not patch:
+    return None, {'values': ['Expected an object of field: value pairs']}
+  patch = dict(('exp_temp' if field == 'temp' else field, FormText(value))
+    for field, value in patch.items())
+  errors = {}
+  for field, text in patch.items():
+    if field not in PROC_FIELDS:
+      errors[field] = ['Unknown field']
+    elif text.strip().lower().lstrip('+-') in ('nan', 'inf', 'infinity'):
+      errors[field] = ['Not a valid number']  # Range checks cannot compare these
+  if errors:
+    return None, errors
+  # Only patched fields are given to the form, so values already stored are not rechecked
+  form = ProcessedDataForm(MultiDict(patch))
+  form.validate()
+  errors = dict((field, list(form.errors[field])) for field in patch if field in form.errors)
+  if errors:
+    return None, errors
+  new_row = list(row)
+  for field in patch:
+    new_row[PROC_FIELDS.index(field)+1] = form.data[field]
+  return new_row, {}
+
+
+# Full-database exports, by job kind: (source, download filename)
+EXPORT_SOURCES = {'metadata': metadata, 'processed_data': proc_data,
+  'derived_metrics': derived_metrics}
+EXPORTS = {'metadata-json': ('metadata', 'metadata.json'),
+  'metadata-csv': ('metadata', 'metadata.csv'),
+  'metadata-csv-nonotes': ('metadata', 'metadata_nonotes.csv'),
+  'procdata-json': ('processed_data', 'procdata.json'),
+  'procdata-csv': ('processed_data', 'procdata.csv'),
+  'derived-json': ('derived_metrics', 'derived_metrics.json'),
+  'derived-csv': ('derived_metrics', 'derived_metrics.csv')}
+
+
+def ExportText(kind, data):
+  # Renders one of the EXPORTS from a metadata or processed data dict
+  if kind == 'metadata-json':
+    return MakeMetaDF(data).to_json()
+  if kind == 'metadata-csv':
+    return MakeMetaDF(data).to_csv(index=False)
+  if kind == 'metadata-csv-nonotes':
+    return MakeMetaDF(data).drop('Notes', axis=1).to_csv(index=False)
+  if kind == 'procdata-json':
+    return MakeCondDF(data).to_json()
+  if kind == 'procdata-csv':
+    return MakeCondDF(data).to_csv(index_label='cond_ID')
+  if kind == 'derived-json':
+    return MakeDerivedDF(data).to_json()
+  if kind == 'derived-csv':
+    return MakeDerivedDF(data).to_csv(index_label='Experiment')
+
+
+# Columns of the joined export: the experiment and condition keys, metadata (by slot) and
+# processed data (by position). Metadata temperatures are renamed to keep them apart from
+# the condition temperature
+JOIN_META_COLUMNS = ['user', 'exp_id', 'exp_date', 'animal_date', 'experimenter', 'lab',
+  'baseline_temp', 'tank_temp', 'species', 'intra_sol', 'saline', 'conditions', 'files',
+  'nerves', 'neurons', 'flags', 'notes']
+JOIN_COLUMNS = ['experiment', 'condition', 'cond_num'] + JOIN_META_COLUMNS + COND_COLUMNS
+JOIN_DEFAULT_COLUMNS = ['experiment', 'cond_num'] + JOIN_META_COLUMNS[:11] + COND_COLUMNS[:15]
+JOIN_FILTER = re.compile(r'^(\w+)\s*(<=|>=|!=|=|<|>|~)\s*(.*)$', re.UNICODE)
+
+
+def JoinValue(column, exp_name, condnum, meta_row, cond_row):
+  if column == 'experiment':
+    return exp_name
+  if column == 'condition':
+    return exp_name+'_'+str(condnum)
+  if column == 'cond_num':
+    return condnum
+  if column in JOIN_META_COLUMNS:
+    return meta_row[JOIN_META_COLUMNS.index(column)]
+  return cond_row[COND_COLUMNS.index(column)]
+
+
+def JoinFilter(text):
+  """
+  Parses a row filter such as species=Cancer, temp>=11 or notes~ramp into (column, test).
+  Comparisons are numeric when the value is a number, otherwise text (so dates compare
+  as YYYY-MM-DD); = and != ignore case, and ~ means contains. Raises ValueError.
+  """
+  match = JOIN_FILTER.match(text)
+  if match is None or match.group(1) not in JOIN_COLUMNS:
+    raise ValueError('Cannot read filter: '+text)
+  column, op, value = match.groups()
+  number = Number(value)
+  def test(cell):
+    if cell is None:
+      return op == '!='
+    if op == '~':
+      return value.lower() in FormText(cell).lower()
+    if number is not None and Number(cell) is not None:
+      cell, wanted = Number(cell), number
+    else:
+      cell, wanted = FormText(cell).lower(), value.lower()
+    return {'=': cell == wanted, '!=': cell != wanted, '<': cell < wanted,
+      '<=': cell <= wanted, '>': cell > wanted, '>=': cell >= wanted}[op]
+  return column, test
+
+
+def JoinedRows(columns, filters):
+  """
+  Joins metadata onto processed data, one row per condition, with the given columns and
+  only the rows passing every (column, test) filter. Conditions are found from each
+  experiment's condition count, so experiments are filtered on their metadata before any
+  of their processed data is read.
+  """
+  meta_filters = [(column, test) for column, test in filters
+    if column == 'experiment' or column in JOIN_META_COLUMNS]
+  cond_filters = [(column, test) for column, test in filters
+    if (column, test) not in meta_filters]
+  with db_lock:
+    experiments = sorted(metadata.items())
+  rows = []
+  for exp_name, meta_row in experiments:
+    if not all(test(JoinValue(column, exp_name, None, meta_row, None))
+        for column, test in meta_filters):
+      continue
+    for condnum in range(meta_row[11]):
+      cond_row = proc_data.get(exp_name+'_'+str(condnum))
+      if cond_row is None or not all(test(JoinValue(column, exp_name, condnum, meta_row,
+          cond_row)) for column, test in cond_filters):
+        continue
+      rows.append([JoinValue(column, exp_name, condnum, meta_row, cond_row)
+        for column in columns])
+  return rows
+
+
 def allowed_file(filename):
   # Implements check of filename extensions specified in config.json
   allowed_exts = set(config['AllowedFiletypes'])
   return '.' in filename and filename.rsplit('.', 1)[1] in allowed_exts
 
 
-def zipdir(path, zipf):
+def zipdir(path, zipf, start):
+  # Archive names are relative to start, so no chdir is needed (not thread safe)
   for root, dirs, files in os.walk(path):
     for file in files:
-      zipf.write(os.path.join(root, file))
+      zipf.write(os.path.join(root, file), os.path.relpath(os.path.join(root, file), start))
+
+
+# Each experiment's uploaded files are listed in file_manifest (databases/file_manifest.json)
+# as [name, size, mtime, sha256, type] rows sorted by name, so pages never list the
+# directory. Row position is the file index shown to users. Metadata slot 12 (file count)
+# is kept equal to the number of rows.
+def FileEntry(exp_name, filename, size=None, mtime=None):
+  if size is None:
+    size, mtime = blobs.stat(exp_name, filename)
+  filetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+  return [filename, size, mtime, blobs.sha256(exp_name, filename), filetype]
+
+
+def ManifestFilenames(exp_name):
+  return [entry[0] for entry in file_manifest.get(exp_name, [])]
+
+
+def ManifestEntry(exp_name, filename):
+  for entry in file_manifest.get(exp_name, []):
+    if entry[0] == filename:
+      return entry
+  return None
+
+
+def ManifestVersion(exp_name):
+  # Changes whenever any of an experiment's files is added, removed or changed
+  text = json.dumps(file_manifest.get(exp_name, []))
+  return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+def SetManifest(exp_name, entries):
+  # Stores an experiment's manifest rows and syncs the file count, without saving
+  entries.sort(key=lambda entry: entry[0])
+  if entries or exp_name in file_manifest:
+    file_manifest[exp_name] = entries
+  if exp_name in metadata:
+    metadata[exp_name][12] = len(entries)
+
+
+def UpdateManifest(exp_name, added=(), removed=()):
+  # Call after saving (added) or deleting (removed) files of an experiment. Added files
+  # are hashed before taking the lock, so a large upload does not hold up other saves
+  new_entries = [FileEntry(exp_name, filename) for filename in added]
+  with db_lock:
+    entries = [entry for entry in file_manifest.get(exp_name, [])
+      if entry[0] not in removed and entry[0] not in added]
+    entries += new_entries
+    SetManifest(exp_name, entries)
+    SaveDatabase('file_manifest', exp_name)
+    SaveDatabase('metadata', exp_name)
+    if 'READ_ME.txt' in added:
+      IndexExperiment(exp_name)
+
+
+def ReadMe(exp_name):
+  # Start of an experiment's READ_ME.txt, as much as the edit form shows
+  return blobs.read(exp_name, 'READ_ME.txt', 0, 10000).decode('utf-8', 'ignore')
+
+
+def SaveReadMe(exp_name, text, *added):
+  # Writes READ_ME.txt and records it in the manifest, with any other files just saved
+  blobs.save(exp_name, 'READ_ME.txt', BytesIO(text.encode('utf-8')))
+  UpdateManifest(exp_name, added=['READ_ME.txt']+list(added))
+
+
+def ReconcileManifest(exp_name, files):
+  # Brings a manifest in line with the experiment's stored files (name, size, mtime), for
+  # files changed outside the server. Only files whose size or mtime changed are
+  # re-hashed. Returns True if anything changed (caller saves).
+  known = dict((entry[0], entry) for entry in file_manifest.get(exp_name, []))
+  entries = []
+  for name, size, mtime in files:
+    entry = known.get(name)
+    if entry is None or entry[1] != size or entry[2] != mtime:
+      entry = FileEntry(exp_name, name, size, mtime)
+    entries.append(entry)
+  entries.sort(key=lambda entry: entry[0])
+  changed = entries != file_manifest.get(exp_name, []) or \
+    (exp_name in metadata and metadata[exp_name][12] != len(entries))
+  if changed:
+    SetManifest(exp_name, entries)
+  return changed
+
+
+def ReconcileAllManifests():
+  stored = blobs.list_all()
+  with db_lock:
+    removed = []
+    reconciled = []
+    for exp_name in set(metadata.keys()) | set(file_manifest.keys()):
+      if exp_name not in metadata:
+        file_manifest.pop(exp_name)
+        removed.append(exp_name)
+      elif ReconcileManifest(exp_name, stored.get(exp_name, [])):
+        reconciled.append(exp_name)
+    if removed or reconciled or not os.path.exists('databases/file_manifest.json'):
+      SaveDatabase('file_manifest', *(removed + reconciled))
+    if reconciled:
+      SaveDatabase('metadata', *reconciled)
+
+
+def BuildArchive(exp_name, result_path):
+  zipf = zipfile.ZipFile(result_path, 'w')
+  for entry in file_manifest.get(exp_name, []):
+    zipf.write(blobs.fetch(exp_name, entry[0], entry[3]), exp_name+'/'+entry[0])
+  zipf.close()
+
+
+# Previews of .abf recordings are cached as json in PreviewPath, named by the file's
+# SHA256 from the manifest, so a preview is built once per file content and a replaced
+# file gets a new one
+def AbfFilenames(exp_name):
+  return [filename for filename in ManifestFilenames(exp_name)
+    if filename.lower().endswith('.abf')]
+
+
+def TracePreview(exp_name, filename):
+  # Returns (preview, sha256), or (None, None) if the file is not an uploaded recording
+  entry = ManifestEntry(exp_name, filename)
+  if entry is None or not filename.lower().endswith('.abf'):
+    return None, None
+  preview_path = config.get('PreviewPath', 'previews/')
+  cached = os.path.join(preview_path, entry[3]+'.json')
+  if os.path.exists(cached):
+    with open(cached) as infile:
+      return json.load(infile), entry[3]
+  preview = Envelope(blobs.fetch(exp_name, filename, entry[3]))
+  if not os.path.isdir(preview_path):
+    os.makedirs(preview_path)
+  temp = cached+'.%d.tmp' % threading.current_thread().ident
+  with open(temp, 'w') as outfile:
+    json.dump(preview, outfile)
+  os.rename(temp, cached)
+  return preview, entry[3]
+
+
+# Image previews are made by thumbnail_jobs when an image is uploaded (or first viewed)
+# and kept in ThumbnailPath, a least recently used cache of at most ThumbnailCacheMB
+def ImageFilenames(exp_name):
+  if not THUMBNAILS_AVAILABLE:
+    return []
+  return [filename for filename in ManifestFilenames(exp_name) if IsImage(filename)]
+
+
+def SubmitThumbnails(exp_name, filename):
+  # Queues the previews of an uploaded image; returns the job, or None if not an image
+  entry = ManifestEntry(exp_name, filename)
+  if entry is None or not THUMBNAILS_AVAILABLE or not IsImage(filename):
+    return None
+  cache_dir = config.get('ThumbnailPath', 'thumbnails/')
+  def build(result_path):
+    MakePreviews(blobs.fetch(exp_name, filename, entry[3]), cache_dir, entry[3])
+    PruneCache(cache_dir, int(config.get('ThumbnailCacheMB', 64)*1e6))
+  # A finished job whose previews were since pruned from the cache is built again
+  thumbnail_jobs.discard('thumbnails', exp_name+'/'+filename, entry[3])
+  return thumbnail_jobs.submit('thumbnails', exp_name+'/'+filename, entry[3], build, 'thumbnails')
+
+
+def SubmitJob(kind, target=None):
+  # Queues an archive (target is the experiment) or export build for the current data
+  with db_lock:
+    version = data_version
+    if kind == 'archive':
+      # Keyed on the files rather than all data, so edits elsewhere keep the archive
+      version = ManifestVersion(target)
+      filename = target+'.zip'
+      build = lambda result_path: BuildArchive(target, result_path)
+    else:
+      table, filename = EXPORTS[kind]
+      rows = dict((key, list(row)) for key, row in EXPORT_SOURCES[table].items())
+      def build(result_path):
+        with open(result_path, 'w') as outfile:
+          outfile.write(ExportText(kind, rows))
+  return jobs.submit(kind, target, version, build, filename)
 
 
 @login_manager.user_loader
@@ -335,6 +1128,102 @@ def load_user(user_id):
   return user
 
 
+# Experiments and their files have resource URLs (/experiments/<user>-<exp id>/...) that
+# need no session, so they can be linked to, and public responses from them may be kept
+# by browsers and caching proxies for PublicCacheSeconds. Caches revalidate with ETags
+def PublicResponse(response, etag):
+  response.set_etag(etag)
+  response.cache_control.public = True
+  response.cache_control.max_age = config.get('PublicCacheSeconds', 300)
+  return response
+
+
+def PublicFile(path, etag, mimetype=None, attachment_filename=None):
+  # Sends a file, or 304 if the client already has this version. Checked before opening
+  # the file, so an unchanged download costs nothing
+  if etag in request.if_none_match:
+    response = make_response('', 304)
+  else:
+    # send_file would take a relative path from app.py's directory, not the working one
+    response = send_file(os.path.abspath(path), mimetype=mimetype, add_etags=False,
+      as_attachment=attachment_filename is not None, attachment_filename=attachment_filename)
+  return PublicResponse(response, etag)
+
+
+def PublicBlob(exp_name, entry):
+  """
+  Sends an uploaded file (entry is its manifest row), or 304 if the client already has
+  this version. A Range header gets just those bytes, read from the store as a ranged
+  read, so large recordings can be read in pieces and broken downloads resumed.
+  """
+  etag = entry[3]
+  if etag in request.if_none_match:
+    return PublicResponse(make_response('', 304), etag)
+  byte_range = None
+  if request.range is not None and request.if_range.date is None and \
+      request.if_range.etag in (None, etag):
+    byte_range = request.range.range_for_length(entry[1])
+  if byte_range is None and blobs.file_path is not None:
+    response = PublicFile(blobs.fetch(exp_name, entry[0], etag), etag, mimetype=entry[4])
+    response.headers['Accept-Ranges'] = 'bytes'
+    return response
+  start, end = byte_range or (0, entry[1])
+  response = app.response_class(blobs.stream(exp_name, entry[0], start, end),
+    mimetype=entry[4], direct_passthrough=True)
+  response.headers['Content-Length'] = str(end - start)
+  response.headers['Accept-Ranges'] = 'bytes'
+  if byte_range is not None:
+    response.status_code = 206
+    response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, entry[1])
+  return PublicResponse(response, etag)
+
+
+def RequestUser():
+  # Who a request counts against for per-user limits: the user, or their address
+  user = flask.ext.login.current_user
+  if user.is_authenticated:
+    return user.id
+  return request.remote_addr
+
+
+def Admit(limit_name, methods=None):
+  """
+  Decorator that runs a view only once it gets a slot from limiters[limit_name] (for
+  the given methods, or all). The slot is held until the response has been sent, so it
+  covers streaming large files too.
+  """
+  def decorator(view):
+    @functools.wraps(view)
+    def admitted(*args, **kwargs):
+      if methods is not None and request.method not in methods:
+        return view(*args, **kwargs)
+      limiter = limiters[limit_name]
+      user = RequestUser()
+      limiter.acquire(user)
+      try:
+        response = make_response(view(*args, **kwargs))
+      except:
+        limiter.release(user)
+        raise
+      release = lambda: limiter.release(user)
+      if response.direct_passthrough:  # Files from send_file skip the response's close
+        response.response = ClosingIterator(response.response, release)
+      else:
+        response.call_on_close(release)
+      return response
+    return admitted
+  return decorator
+
+
+@app.errorhandler(Busy)
+@app.errorhandler(QueueFull)
+def too_busy(error):
+  # Expensive requests turned away by admission control or a full job queue
+  response = make_response(render_template('busy-page.html', msg=str(error)), 503)
+  response.headers['Retry-After'] = str(config.get('RetryAfterSeconds', 30))
+  return response
+
+
 @login_manager.unauthorized_handler
 def nope():
   # Flask redirects here when a @login_required page fails authentication check
@@ -370,21 +1259,43 @@ def dl_files_page():
   # Directs to file download page
   if config['DownloadsAllowed'] != 1:
     return render_template('feature-disabled.html')
-  metadata_df = MakeMetaDF(metadata)
-  metadata_df = metadata_df.drop('Notes', axis=1)
-  metadata_df = metadata_df.loc[metadata_df.loc[:,'Files']>1,:] 
-  metadata_df.index = range(len(metadata_df))   
   if request.method == 'POST':
+    metadata_df = FilesMetaDF()
     form = FileDownloadForm(request.form)
     if form.data['identifier']>=0 and form.data['identifier']<len(metadata_df):
       session['exp_name'] = metadata_df.loc[form.data['identifier']]['User'] \
         +'-'+metadata_df.loc[form.data['identifier']]['Exp ID']
-      return redirect(url_for('file_download'))
-  table_html = metadata_df.to_html()
+      return redirect(url_for('experiment_view', key=session['exp_name']))
+  table_html = CachedTableHtml('dl-files', (), lambda: FilesMetaDF().to_html())
   form = FileDownloadForm()
   return render_template('dl-files-page.html', table_html=table_html, form=form)
 
 
+@app.route('/search')
+def search():
+  # Ranked full-text search of experiments, 20 per page (?q=<words>&page=<n>), or json
+  # with ?format=json
+  if config['DownloadsAllowed'] != 1:
+    return render_template('feature-disabled.html')
+  query = request.args.get('q', '')
+  try:
+    page = max(1, int(request.args.get('page', 1)))
+  except ValueError:
+    page = 1
+  per_page = 20
+  total, hits = search_index.search(query, (page-1)*per_page, per_page)
+  results = [{'experiment': exp_name, 'score': score, 'snippet': snippet,
+    'experimenter': metadata[exp_name][4], 'lab': metadata[exp_name][5],
+    'exp_date': metadata[exp_name][2], 'url': url_for('experiment_view', key=exp_name)}
+    for exp_name, score, snippet in hits
+    if exp_name in metadata]
+  if request.args.get('format') == 'json':
+    return jsonify({'query': query, 'page': page, 'per_page': per_page, 'total': total,
+      'results': results})
+  return render_template('search-page.html', query=query, page=page, total=total,
+    results=results, pages=-(-total // per_page))
+
+
 #Following routes direct to various downloads, as described
 @app.route('/dl-readme')
 def dl_readme():
@@ -395,32 +1306,30 @@ def dl_readme():
 def dl_metadata_page():
   if config['DownloadsAllowed'] != 1:
     return render_template('feature-disabled.html')
-  metadata_df = MakeMetaDF(metadata)
-  table_html = metadata_df.to_html()
+  table_html = CachedTableHtml('dl-metadata', (), lambda: MakeMetaDF(metadata).to_html())
   return render_template('dl-metadata-page.html', table_html=table_html)
 
 
 @app.route('/dl-metadata-json')
+@Admit('exports')
 def dl_metadata_json():
-  metadata_df = MakeMetaDF(metadata)
-  response = make_response(metadata_df.to_json())
+  response = make_response(ExportText('metadata-json', metadata))
   response.headers['Content-Disposition'] = 'attachment; filename=metadata.json'
   return response
 
 
 @app.route('/dl-metadata-csv')
+@Admit('exports')
 def dl_metadata_csv():
-  metadata_df = MakeMetaDF(metadata)
-  response = make_response(metadata_df.to_csv(index=False))
+  response = make_response(ExportText('metadata-csv', metadata))
   response.headers['Content-Disposition'] = 'attachment; filename=metadata.csv'
   return response
 
 
 @app.route('/dl-metadata-csv-nonotes')
+@Admit('exports')
 def dl_metadata_csv_nonotes():
-  metadata_df = MakeMetaDF(metadata)
-  metadata_df = metadata_df.drop('Notes', axis=1)
-  response = make_response(metadata_df.to_csv(index=False))
+  response = make_response(ExportText('metadata-csv-nonotes', metadata))
   response.headers['Content-Disposition'] = 'attachment; filename=metadata_nonotes.csv'
   return response
 
@@ -429,28 +1338,93 @@ def dl_metadata_csv_nonotes():
 def dl_procdata_page():
   if config['DownloadsAllowed'] != 1:
     return render_template('feature-disabled.html')
-  procdata_df = MakeCondDF(proc_data)
-  procdata_df = procdata_df.dropna(axis=1, how='all')
-  table_html = procdata_df.to_html()
+  table_html = CachedTableHtml('dl-procdata', (),
+    lambda: MakeCondDF(ConditionRows(sorted(metadata))).dropna(axis=1, how='all').to_html())
   return render_template('dl-procdata-page.html', table_html=table_html)
 
 
 @app.route('/dl-procdata-csv')
+@Admit('exports')
 def dl_procdata_csv():
-  procdata_df = MakeCondDF(proc_data)
-  response = make_response(procdata_df.to_csv(index_label='cond_ID'))
+  response = make_response(ExportText('procdata-csv', proc_data))
   response.headers['Content-Disposition'] = 'attachment; filename=procdata.csv'
   return response
 
 
 @app.route('/dl-procdata-json')
+@Admit('exports')
 def dl_procdata_json():
-  procdata_df = MakeCondDF(proc_data)
-  response = make_response(procdata_df.to_json())
+  response = make_response(ExportText('procdata-json', proc_data))
   response.headers['Content-Disposition'] = 'attachment; filename=procdata.json'
   return response 
 
 
+@app.route('/export/joined')
+@Admit('exports')
+def export_joined():
+  """
+  Metadata joined onto processed data, one row per condition:
+  ?columns=<column,...>&where=<filter>&where=...&format=csv|json. Filters are
+  <column><op><value> with op one of = != < <= > >= ~ (contains); rows must pass all.
+  json is {"columns": [...], "data": [[...], ...]}.
+  """
+  if config['DownloadsAllowed'] != 1:
+    return render_template('feature-disabled.html')
+  columns = [column.strip() for column in request.args.get('columns', '').split(',')
+    if column.strip()] or JOIN_DEFAULT_COLUMNS
+  unknown = [column for column in columns if column not in JOIN_COLUMNS]
+  export_format = request.args.get('format', 'csv')
+  if unknown or export_format not in ('csv', 'json'):
+    return jsonify({'error': 'Unknown columns or format: '+', '.join(unknown or
+      [export_format]), 'columns': JOIN_COLUMNS}), 400
+  try:
+    filters = [JoinFilter(text) for text in request.args.getlist('where')]
+  except ValueError as e:
+    # args[0] rather than str(e), which fails on python 2 for a filter with accents
+    return jsonify({'error': e.args[0], 'columns': JOIN_COLUMNS}), 400
+  # The ETag names the data version and the normalized query, so an unchanged export is
+  # answered with 304 before it is built. Exports are not kept in the table cache, which
+  # is sized for page fragments; PublicResponse lets proxies keep them instead
+  query = json.dumps([data_version, columns, export_format, request.args.getlist('where')])
+  etag = hashlib.sha1(query.encode('utf-8')).hexdigest()
+  if etag in request.if_none_match:
+    return PublicResponse(make_response('', 304), etag)
+  import pandas as pd
+  df = pd.DataFrame(JoinedRows(columns, filters), columns=columns)
+  if export_format == 'json':
+    text = df.to_json(orient='split', index=False)
+  else:
+    text = df.to_csv(index=False, encoding='utf-8')
+  response = make_response(text)
+  response.mimetype = 'application/json' if export_format == 'json' else 'text/csv'
+  response.headers['Content-Disposition'] = 'attachment; filename=joined.'+export_format
+  return PublicResponse(response, etag)
+
+
+@app.route('/dl-derived-page')
+def dl_derived_page():
+  if config['DownloadsAllowed'] != 1:
+    return render_template('feature-disabled.html')
+  table_html = CachedTableHtml('dl-derived', (), lambda: MakeDerivedDF(derived_metrics).to_html())
+  return render_template('dl-derived-page.html', table_html=table_html)
+
+
+@app.route('/dl-derived-csv')
+@Admit('exports')
+def dl_derived_csv():
+  response = make_response(ExportText('derived-csv', derived_metrics))
+  response.headers['Content-Disposition'] = 'attachment; filename=derived_metrics.csv'
+  return response
+
+
+@app.route('/dl-derived-json')
+@Admit('exports')
+def dl_derived_json():
+  response = make_response(ExportText('derived-json', derived_metrics))
+  response.headers['Content-Disposition'] = 'attachment; filename=derived_metrics.json'
+  return response
+
+
 @app.route('/upload-page', methods=['GET', 'POST'])
 @login_required
 def upload_page():
@@ -465,20 +1439,13 @@ def upload_page():
   if user_database[g.user.id][3] == 0:
     return render_template('user-uploads-disabled.html')
   if request.method == 'GET':
-    metadata_df=MakeMetaDF(metadata)
-    if g.user.id != 'Admin':  # Admin can see all experiments
-      metadata_df=metadata_df.loc[metadata_df.loc[:,'User']==g.user.id,:]
-    metadata_df.index = range(len(metadata_df))   
-    df_no_notes = metadata_df.drop('Notes', axis=1) # Don't show notes here
-    table_html = df_no_notes.to_html()
+    # Admin can see all experiments. Notes are not shown here
+    table_html = CachedTableHtml('upload', (g.user.id,), lambda: UserMetaDF(g.user.id).to_html())
     form = UploadActionForm()
     return render_template('upload-page.html', table_html=table_html, form=form)
   else:
     form = UploadActionForm(request.form)
-    metadata_df=MakeMetaDF(metadata)
-    if g.user.id != 'Admin':  
-      metadata_df=metadata_df.loc[metadata_df.loc[:,'User']==g.user.id,:] 
-    metadata_df.index = range(len(metadata_df))   
+    metadata_df = UserMetaDF(g.user.id)
     if form.validate():   # Checks for valid form entry
       if form.data['identifier']<0 or form.data['identifier']>(len(metadata_df)-1) \
                     or form.data['identifier']==None:
@@ -492,12 +1459,7 @@ def upload_page():
       if form.data['action'] == 'delete':
         return redirect(url_for('delete_experiment'))
     else: # sends back to template with errors if form did not validate
-      metadata_df=MakeMetaDF(metadata)
-      if g.user.id != 'Admin':
-        metadata_df=metadata_df.loc[metadata_df.loc[:,'User']==g.user.id,:] 
-      metadata_df.index = range(len(metadata_df))
-      df_no_notes = metadata_df.drop('Notes', axis=1)
-      table_html = df_no_notes.to_html()      
+      table_html = CachedTableHtml('upload', (g.user.id,), lambda: metadata_df.to_html())
       return render_template('upload-page.html', table_html=table_html, form=form)  
 
 
@@ -514,28 +1476,17 @@ def experiment_page():
     return render_template('feature-disabled.html')
   if user_database[g.user.id][3] == 0:
     return render_template('user-uploads-disabled.html')
-  if not os.path.isdir(config['FilePath']+session['exp_name']):
-    os.mkdir(config['FilePath']+session['exp_name'])  
-  if not os.path.exists(config['FilePath']+session['exp_name']+'/READ_ME.txt'):
-    read_me = open(config['FilePath']+session['exp_name']+'/READ_ME.txt', 'w')
-    read_me.write('Auto-generated blank read_me for '+session['exp_name'])
-    read_me.close()
-    metadata[session['exp_name']][12] += 1
-    with open('databases/metadata.json', 'w') as outfile:
-      json.dump(metadata, outfile)    
+  if ManifestEntry(session['exp_name'], 'READ_ME.txt') is None:
+    SaveReadMe(session['exp_name'], 'Auto-generated blank read_me for '+session['exp_name'])
   if request.method == 'GET':
-    conditions_df = MakeCondDF(proc_data)
-    conditions_df = conditions_df[conditions_df.index.str.contains(session['exp_name'])]
-    conditions_df = conditions_df.sort_index()
-    conditions_df.index = range(len(conditions_df))
-    conditions_df = conditions_df.dropna(axis=1, how='all')
-    table_html = conditions_df.to_html()
+    table_html = ConditionsTableHtml(session['exp_name'])
     form = ExperimentActionForm()   
-    filenames = [str(filename) for filename in os.listdir(config['FilePath']+session['exp_name'])]
-    metadata[session['exp_name']][12] = len(filenames)
+    filenames = ManifestFilenames(session['exp_name'])
     filecount = metadata[session['exp_name']][12]
     return render_template('experiment-page.html', table_html=table_html,
-      filenames=filenames, filecount=filecount, form=form, name=session['exp_name'])
+      derived_html=DerivedTableHtml(session['exp_name']), filenames=filenames, filecount=filecount, form=form, name=session['exp_name'],
+      recordings=AbfFilenames(session['exp_name']),
+      images=ImageFilenames(session['exp_name']))
   if request.method == 'POST':
     form = ExperimentActionForm(request.form)
     if form.validate():
@@ -551,31 +1502,31 @@ def experiment_page():
           return render_template('experiment-message.html', msg=msg)
         session['cond_num'] = str(form.data['identifier'])      
         session['cond_name'] = proc_data[session['exp_name']+'_'+session['cond_num']][0]          
+        # This condition and those after it, which move down one
+        changed = [session['exp_name']+'_'+str(condnum) for condnum in
+          range(form.data['identifier'], metadata[session['exp_name']][11])]
         proc_data.pop(session['exp_name']+'_'+session['cond_num'])
         for condnum in range(form.data['identifier']+1, metadata[session['exp_name']][11]):
           proc_data[session['exp_name']+'_'+str(condnum-1)]=proc_data.pop(session['exp_name']+'_'+str(condnum))
         metadata[session['exp_name']][11]-=1
-        with open('databases/metadata.json', 'w') as outfile:
-          json.dump(metadata, outfile)
-        with open('databases/processed_data.json', 'w') as outfile:
-          json.dump(proc_data, outfile)
+        RefreshDerivedMetrics(session['exp_name'])
+        SaveDatabase('metadata', session['exp_name'])
+        SaveDatabase('processed_data', *changed)
         msg='Condition '+session['cond_name']+' deleted.'
         return render_template('experiment-message.html', msg=msg)
     else:
-      conditions_df = (proc_data)
-      conditions_df = conditions_df[conditions_df.index.str.contains(session['exp_name'])]
-      conditions_df = conditions_df.sort_index()
-      conditions_df.index = range(len(conditions_df))
-      conditions_df = conditions_df.dropna(axis=1, how='all')
-      table_html = conditions_df.to_html()
-      filenames = [str(filename) for filename in os.listdir(config['FilePath']+session['exp_name'])]
+      table_html = ConditionsTableHtml(session['exp_name'])
+      filenames = ManifestFilenames(session['exp_name'])
       filecount = metadata[session['exp_name']][12]
       return render_template('experiment-page.html', table_html=table_html,
-        filenames=filenames, filecount=filecount, form=form, name=session['exp_name'])
+        derived_html=DerivedTableHtml(session['exp_name']), filenames=filenames, filecount=filecount, form=form, name=session['exp_name'],
+        recordings=AbfFilenames(session['exp_name']),
+        images=ImageFilenames(session['exp_name']))
 
 
 @app.route('/file-upload', methods=['GET', 'POST'])
 @login_required
+@Admit('uploads', methods=['POST'])
 def file_upload():
   # Manages file uploads
   if config['UploadsAllowed'] != 1:
@@ -586,36 +1537,35 @@ def file_upload():
     msg = 'Cannot upload more files, reached maximum for this experiment.'
     return render_template('file-upload-message.html', msg=msg)
   if request.method == 'GET':
-    read_me_file = open(config['FilePath']+session['exp_name']+'/READ_ME.txt')
-    form = ReadMeForm(read_me = read_me_file.read(10000))
-    read_me_file.close()
+    form = ReadMeForm(read_me = ReadMe(session['exp_name']))
     return render_template('file-upload-page.html', name=session['exp_name'], form=form)
   else:
     form = ReadMeForm(request.form)
-    read_me_file = open(config['FilePath']+session['exp_name']+'/READ_ME.txt', 'w')
-    read_me_file.write(form.data['read_me'])
-    read_me_file.close()
     file = request.files['file']
     file.seek(0, os.SEEK_END)
     file_length = file.tell()
+    file.seek(0, os.SEEK_SET)
+    filename = secure_filename(file.filename) if file and allowed_file(file.filename) \
+      else None
+    # The READ_ME is saved even if the file is turned away, and recorded in the same
+    # manifest update as the file otherwise
     if file_length > config['MaxFilesizeMB']*1e6:
       msg = 'Cannot upload, file too large'
-      return render_template('file-upload-message.html', msg=msg)
-    file.seek(0, os.SEEK_SET)
-    if file and allowed_file(file.filename):
-      filename = secure_filename(file.filename)
-      filenames = os.listdir(config['FilePath']+session['exp_name'])
-      if filename in filenames:
-        return render_template('file-upload-message.html', msg='Filename already used.')
-      file.save(config['FilePath']+session['exp_name']+'/'+filename)
-      metadata[session['exp_name']][12]+=1
-      with open('databases/metadata.json', 'w') as outfile:
-        json.dump(metadata, outfile)
+    elif filename is None:
+      msg = 'Upload failed. File type is probably not allowed.'
+    elif filename in ManifestFilenames(session['exp_name']):
+      msg = 'Filename already used.'
+    else:
+      blobs.save(session['exp_name'], filename, file.stream)
+      SaveReadMe(session['exp_name'], form.data['read_me'], filename)
+      try:
+        SubmitThumbnails(session['exp_name'], filename)
+      except QueueFull:
+        pass  # Made when first viewed instead
       msg = 'Successfully uploaded '+filename
       return render_template('file-upload-message.html', msg=msg)
-    else:
-      msg = 'Upload failed. File type is probably not allowed.'
-      return render_template('file-upload-message.html', msg=msg) 
+    SaveReadMe(session['exp_name'], form.data['read_me'])
+    return render_template('file-upload-message.html', msg=msg)
 
 
 @app.route('/files-readme', methods=['GET', 'POST'])
@@ -623,41 +1573,231 @@ def file_upload():
 def files_readme():
   # Direct edit of read me file for files
   if request.method == 'GET':
-    read_me_file = open(config['FilePath']+session['exp_name']+'/READ_ME.txt')
-    form = ReadMeForm(read_me = read_me_file.read(10000))
-    read_me_file.close()
-    filenames = [str(filename) for filename in os.listdir(config['FilePath']+session['exp_name'])]
+    form = ReadMeForm(read_me = ReadMe(session['exp_name']))
+    filenames = ManifestFilenames(session['exp_name'])
     return render_template('files-readme-page.html', form=form, filenames=filenames)
   else:
     form = ReadMeForm(request.form)
-    read_me_file = open(config['FilePath']+session['exp_name']+'/READ_ME.txt', 'w')
-    read_me_file.write(form.data['read_me'])
-    read_me_file.close()
+    SaveReadMe(session['exp_name'], form.data['read_me'])
     return redirect(url_for('experiment_page'))
 
 
 @app.route('/file-download', methods=['GET', 'POST'])
 def file_download():
-  # Manages file downloads
-  if metadata[session['exp_name']][12] == 0:
-    msg = 'No files to download.'
-    return render_template('download-message.html', msg=msg)
-  if request.method == 'GET':
-    filenames = os.listdir(config['FilePath']+session['exp_name'])
-    filenames_df = pd.DataFrame(filenames, columns=['Filename'])
-    table_html = filenames_df.to_html()
-    return render_template('file-download-page.html', table_html=table_html)
+  # Old address of the file download page, kept for bookmarks: the experiment's public
+  # page, or its zip for the page's download button (a post)
+  exp_name = session.get('exp_name')
+  if exp_name not in metadata:
+    return redirect(url_for('dl_files_page'))
+  if request.method == 'POST':
+    return redirect(url_for('experiment_archive', key=exp_name), code=303)
+  return redirect(url_for('experiment_view', key=exp_name))
+
+
+@app.route('/experiments/<key>')
+def experiment_view(key):
+  # Public page of one experiment: metadata, conditions, derived metrics and files
+  if config['DownloadsAllowed'] != 1:
+    return render_template('feature-disabled.html')
+  if key not in metadata:
+    return render_template('download-message.html', msg='Experiment not found.'), 404
+  etag = ExperimentDigest(key)
+  if etag in request.if_none_match:
+    return PublicResponse(make_response('', 304), etag)
+  html = render_template('experiment-view.html', name=key,
+    meta_html=ExperimentMetaHtml(key), table_html=ConditionsTableHtml(key),
+    derived_html=DerivedTableHtml(key), files=file_manifest.get(key, []),
+    recordings=AbfFilenames(key), images=ImageFilenames(key),
+    modified=dict((entry[0], time.strftime('%Y-%m-%d %H:%M', time.localtime(entry[2])))
+      for entry in file_manifest.get(key, [])))
+  return PublicResponse(make_response(html), etag)
+
+
+@app.route('/experiments/<key>/files/<path:name>')
+@Admit('transfers')
+def experiment_file(key, name):
+  # One uploaded file. Its ETag is the file's SHA256 from the manifest
+  if config['DownloadsAllowed'] != 1:
+    return render_template('feature-disabled.html')
+  entry = ManifestEntry(key, name)
+  if entry is None:
+    return render_template('download-message.html', msg='File not found.'), 404
+  return PublicBlob(key, entry)
+
+
+@app.route('/experiments/<key>/archive')
+@Admit('transfers')
+def experiment_archive(key):
+  # Zip of an experiment's files: sent if already built for the current files, otherwise
+  # queued, redirecting to the job's status page
+  if config['DownloadsAllowed'] != 1:
+    return render_template('feature-disabled.html')
+  if key not in metadata or metadata[key][12] == 0:
+    return render_template('download-message.html', msg='No files to download.'), 404
+  version = ManifestVersion(key)
+  job = jobs.find('archive', key, version)
+  if job is not None:
+    try:
+      return PublicFile(job.result_path, job.id, attachment_filename=job.filename)
+    except (IOError, OSError):
+      # Pruned by newer results since it was found, so it is built again
+      jobs.discard('archive', key, version)
+  response = redirect(url_for('job_status', job_id=SubmitJob('archive', key).id))
+  response.cache_control.no_store = True
+  return response
+
+
+def FeedDatabases():
+  # Databases whose changes the requester may follow. Users are for Admin and replicas
+  user = flask.ext.login.current_user
+  if user.is_authenticated and user.id == 'Admin':
+    return FEED_DATABASES
+  token = config.get('ReplicaToken', '')
+  if token and hmac.compare_digest(str(request.headers.get('X-Replica-Token', '')),
+      str(token)):
+    return FEED_DATABASES
+  return [name for name in FEED_DATABASES if name != 'user_database']
+
+
+@app.route('/changes')
+@Admit('feeds')
+def changes():
+  """
+  Changes since a feed version, as json: ?since=<version>&limit=<changes per page>
+  &wait=<seconds to wait for a change if there is none yet>&db=<database,...>.
+  Pass the returned version as since next time. If resync is true, the client is too
+  far behind (or ahead) and must start again from /changes/snapshot.
+  """
+  if config['DownloadsAllowed'] != 1:
+    return render_template('feature-disabled.html')
+  try:
+    since = int(request.args.get('since', 0))
+    limit = min(5000, max(1, int(request.args.get('limit', 500))))
+    wait = min(60.0, max(0.0, float(request.args.get('wait', 0))))
+  except ValueError:
+    return jsonify({'error': 'since, limit and wait must be numbers'}), 400
+  allowed = FeedDatabases()
+  wanted = [name for name in request.args.get('db', ','.join(allowed)).split(',')
+    if name in allowed]
+  page, version, more, resync = change_feed.read(since, limit, wanted, wait)
+  response = jsonify({'version': version, 'more': more, 'resync': resync,
+    'oldest': change_feed.base_version, 'changes': [{'version': change[0],
+      'database': change[1], 'key': change[2], 'op': change[3], 'row': change[4]}
+      for change in page]})
+  response.cache_control.no_store = True
+  return response
+
+
+@app.route('/changes/snapshot/<database>')
+@Admit('exports')
+def changes_snapshot(database):
+  # A whole database with the feed version it is current to, to start a mirror from
+  if config['DownloadsAllowed'] != 1:
+    return render_template('feature-disabled.html')
+  if database not in FeedDatabases():
+    return jsonify({'error': 'Unknown database'}), 404
+  with db_lock:
+    response = jsonify({'version': change_feed.version, 'database': database,
+      'rows': dict(databases[database])})
+  response.cache_control.no_store = True
+  return response
+
+
+@app.route('/jobs/submit/<kind>', methods=['GET', 'POST'])
+def submit_job(kind):
+  # Starts (or joins) a background build of an export or archive (?exp=<user>-<exp id>)
+  if config['DownloadsAllowed'] != 1:
+    return render_template('feature-disabled.html')
+  target = None
+  if kind == 'archive':
+    target = request.values.get('exp')
+    if target not in metadata:
+      return render_template('download-message.html', msg='Experiment not found.')
+  elif kind not in EXPORTS:
+    return render_template('download-message.html', msg='Unknown download.')
+  job = SubmitJob(kind, target)
+  return redirect(url_for('job_status', job_id=job.id, format=request.values.get('format')))
+
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+  # Job progress as a page that refreshes itself, or as json with ?format=json
+  job = jobs.get(job_id)
+  if job is None:
+    return render_template('download-message.html', msg='Download job not found.'), 404
+  if request.args.get('format') == 'json':
+    info = job.info()
+    if job.status == 'done':
+      info['result_url'] = url_for('job_result', job_id=job.id)
+    return jsonify(info)
+  return render_template('job-status.html', job=job)
+
+
+@app.route('/jobs/<job_id>/result')
+@Admit('transfers')
+def job_result(job_id):
+  job = jobs.get(job_id)
+  if job is None or job.status != 'done':
+    return render_template('download-message.html', msg='Download is not ready.'), 404
+  # A job's id names its exact inputs, so its result never changes
+  try:
+    return PublicFile(job.result_path, job.id, attachment_filename=job.filename)
+  except (IOError, OSError):
+    # Pushed out by newer results while this link was waiting
+    return render_template('download-message.html',
+      msg='This download has expired, please start it again.'), 404
+
+
+@app.route('/trace-preview/<exp_name>/<path:filename>')
+@Admit('previews')
+def trace_preview(exp_name, filename):
+  # Min/max envelope of an uploaded .abf recording, as svg or as json with ?format=json
+  if config['DownloadsAllowed'] != 1:
+    return render_template('feature-disabled.html')
+  try:
+    preview, sha = TracePreview(exp_name, filename)
+  except PreviewError as e:
+    return 'No preview: '+str(e), 404
+  if preview is None:
+    return 'Recording not found.', 404
+  if request.args.get('format') == 'json':
+    response = jsonify(preview)
   else:
-    home_dir = os.getcwd()
-    if os.path.exists(config['FilePath']+'temp/'):
-      rmtree(config['FilePath']+'temp/')
-    os.mkdir(config['FilePath']+'temp')
-    zipf = zipfile.ZipFile(config['FilePath']+'temp/'+session['exp_name']+'.zip', 'w')
-    os.chdir(config['FilePath'])    
-    zipdir(session['exp_name'], zipf)
-    zipf.close()
-    os.chdir(home_dir)
-    return send_from_directory(config['FilePath']+'temp/', session['exp_name']+'.zip', as_attachment=True)   
+    response = make_response(PreviewSvg(preview))
+    response.mimetype = 'image/svg+xml'
+  response.set_etag(sha+('-json' if request.args.get('format') == 'json' else ''))
+  return response.make_conditional(request)
+
+
+@app.route('/thumbnail/<size>/<exp_name>/<path:filename>')
+def thumbnail(size, exp_name, filename):
+  # Thumbnail ('thumb') or medium preview ('medium') of an uploaded image, as JPEG
+  if config['DownloadsAllowed'] != 1:
+    return render_template('feature-disabled.html')
+  entry = ManifestEntry(exp_name, filename)
+  if size not in THUMBNAIL_SIZES or entry is None or not IsImage(filename) \
+      or not THUMBNAILS_AVAILABLE:
+    return 'Image not found.', 404
+  path = CachedPath(config.get('ThumbnailPath', 'thumbnails/'), entry[3], size)
+  if not os.path.exists(path):
+    # Images that could not be read are not retried until their failed job is pruned
+    previous = thumbnail_jobs.get(thumbnail_jobs.job_id('thumbnails', exp_name+'/'+filename,
+      entry[3]))
+    if previous is not None and previous.status == 'failed':
+      return 'No preview: image could not be read.', 404
+    SubmitThumbnails(exp_name, filename)
+    response = make_response('<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="40">'
+      '<text x="4" y="24" font-size="12" fill="#a00">Preview being made, reload to see it'
+      '</text></svg>' % THUMBNAIL_SIZES[size])
+    response.mimetype = 'image/svg+xml'
+    response.cache_control.no_store = True
+    return response
+  Touch(path)
+  with open(path, 'rb') as infile:
+    response = make_response(infile.read())
+  response.mimetype = 'image/jpeg'
+  response.set_etag(entry[3]+'-'+size)
+  return response.make_conditional(request)
 
 
 @app.route('/file-delete', methods=['GET', 'POST'])
@@ -670,29 +1810,23 @@ def file_delete():
     msg = 'No files to delete.'
     return render_template('file-upload-message.html', msg=msg)
   if request.method == 'GET':
-    filenames = [str(filename) for filename in os.listdir(config['FilePath']+session['exp_name'])]
-    filenames_df = pd.DataFrame(filenames, columns=['Filename'])
-    table_html = filenames_df.to_html()
+    table_html = FilenamesTableHtml(session['exp_name'])
     form = FileDeleteForm()
     return render_template('file-delete-page.html', table_html=table_html, form=form)
   else:
     form = FileDeleteForm(request.form)
     if form.validate():
-      filenames = os.listdir(config['FilePath']+session['exp_name'])
-      filenames_df = pd.DataFrame(filenames, columns=['Filename'])
-      if form.data['identifier'] >= len(filenames_df['Filename']) or form.data['identifier'] < 0:
+      filenames = ManifestFilenames(session['exp_name'])
+      if form.data['identifier'] >= len(filenames) or form.data['identifier'] < 0:
         msg = 'Delete failed. Invalid identifier.'
         return render_template('file-upload-message.html', msg=msg)
-      os.remove(config['FilePath']+session['exp_name']+'/'+filenames_df['Filename'][form.data['identifier']])
-      metadata[session['exp_name']][12]-=1
-      with open('databases/metadata.json', 'w') as outfile:
-        json.dump(metadata, outfile)
+      filename = filenames[form.data['identifier']]
+      blobs.remove(session['exp_name'], filename)
+      UpdateManifest(session['exp_name'], removed=[filename])
       msg = 'File deleted.'
       return render_template('file-upload-message.html', msg=msg)
     else:
-      filenames = [str(filename) for filename in os.listdir(config['FilePath']+session['exp_name'])]
-      filenames_df = pd.DataFrame(filenames, columns=['Filename'])
-      table_html = filenames_df.to_html()   
+      table_html = FilenamesTableHtml(session['exp_name'])
       return render_template('file-delete-page.html', table_html=table_html, form=form)
 
 
@@ -711,10 +1845,9 @@ def new_condition():
       proc_data[session['exp_name']+'_'+session['cond_num']] = [None]*33
       proc_data[session['exp_name']+'_'+session['cond_num']][0]=session['cond_name']
       metadata[session['exp_name']][11]+=1
-      with open('databases/metadata.json', 'w') as outfile:
-        json.dump(metadata, outfile)
-      with open('databases/processed_data.json', 'w') as outfile:
-        json.dump(proc_data, outfile)
+      RefreshDerivedMetrics(session['exp_name'])
+      SaveDatabase('metadata', session['exp_name'])
+      SaveDatabase('processed_data', session['exp_name']+'_'+session['cond_num'])
       return redirect(url_for('processed_data'))
     else:
       return render_template('new-condition.html', form=form, name=session['exp_name'])
@@ -734,15 +1867,19 @@ def delete_experiment():
   else:
     form = DeleteForm(request.form)
     if form.data['verify'] == 'DELETE':
-      for condnum in range(metadata[session['exp_name']][11]):
-        proc_data.pop(session['exp_name']+'_'+str(condnum))
-      metadata.pop(session['exp_name']) 
-      with open('databases/metadata.json', 'w') as outfile:
-        json.dump(metadata, outfile)
-      with open('databases/processed_data.json', 'w') as outfile:
-        json.dump(proc_data, outfile)
-      if os.path.isdir(config['FilePath']+session['exp_name']):
-        rmtree(config['FilePath']+session['exp_name'])    
+      changed = [session['exp_name']+'_'+str(condnum)
+        for condnum in range(metadata[session['exp_name']][11])]
+      for key in changed:
+        proc_data.pop(key)
+      metadata.pop(session['exp_name'])
+      derived_metrics.pop(session['exp_name'], None)
+      IndexExperiment(session['exp_name'])
+      SaveDatabase('metadata', session['exp_name'])
+      SaveDatabase('processed_data', *changed)
+      blobs.remove_all(session['exp_name'])
+      if session['exp_name'] in file_manifest:
+        file_manifest.pop(session['exp_name'])
+        SaveDatabase('file_manifest', session['exp_name'])
       msg='Deleted experiment '+session['exp_name']
       return render_template('upload-message.html', msg=msg)
     else:
@@ -779,10 +1916,10 @@ def new_experiment():
         1, 0, "", "", "", form.data['notes']]
       proc_data[g.user.id+'-'+form.data['exp_id']+'_0'] = [None]*33
       proc_data[g.user.id+'-'+form.data['exp_id']+'_0'][0]='baseline'
-      with open('databases/metadata.json', 'w') as outfile:
-        json.dump(metadata, outfile)
-      with open('databases/processed_data.json', 'w') as outfile:
-        json.dump(proc_data, outfile)
+      RefreshDerivedMetrics(g.user.id+'-'+form.data['exp_id'])
+      SaveDatabase('metadata', session['exp_name'])
+      SaveDatabase('processed_data', session['exp_name']+'_0')
+      IndexExperiment(session['exp_name'])
       session['cond_num'] = '0'
       session['cond_name'] = 'baseline'
       return redirect(url_for('checkboxes_page'))
@@ -818,8 +1955,9 @@ def edit_metadata():
       metadata[session['exp_name']][9] = form.data['intra_sol']
       metadata[session['exp_name']][10] = form.data['saline']
       metadata[session['exp_name']][16] = form.data['notes']
-      with open('databases/metadata.json', 'w') as outfile:
-        json.dump(metadata, outfile)
+      RefreshDerivedMetrics(session['exp_name'])  # Baseline temperature may have changed
+      SaveDatabase('metadata', session['exp_name'])
+      IndexExperiment(session['exp_name'])
       return redirect(url_for('checkboxes_page'))
     else:
       return render_template('edit-metadata.html', name=session['exp_name'], form=form)
@@ -857,8 +1995,7 @@ def checkboxes_page():
       metadata[session['exp_name']][15] = ''
     else:
       metadata[session['exp_name']][15] = str('; '.join(form.data['flags']))
-    with open('databases/metadata.json', 'w') as outfile:
-      json.dump(metadata, outfile)
+    SaveDatabase('metadata', session['exp_name'])
     return redirect(url_for('experiment_page'))
 
 
@@ -895,13 +2032,63 @@ def processed_data():
         form.data['gm_on'], form.data['gm_off'], form.data['gm_spikes'],
         form.data['mg_on'], form.data['mg_off'], form.data['mg_spikes'],
         form.data['blank1'], form.data['blank2'], form.data['blank3']]
-      with open('databases/processed_data.json', 'w') as outfile:
-        json.dump(proc_data, outfile)
+      RefreshDerivedMetrics(session['exp_name'])
+      SaveDatabase('processed_data', session['exp_name']+'_'+session['cond_num'])
       return redirect(url_for('experiment_page'))
     else:
       return render_template('processed-data.html', form=form, name=session['exp_name'], cond=session['cond_name'])
 
 
+@app.route('/processed-data/batch', methods=['POST'])
+@login_required
+def processed_data_batch():
+  """
+  Edits many conditions at once. Takes json {"updates": [{"condition": "<user>-<exp id>_<n>",
+  "values": {field: value, ...}}, ...]} and applies either every update or, if any is
+  invalid, none of them. All changes are saved in a single write.
+
+  Returns json {"applied": count, "errors": [{"index", "condition", "errors": {field:
+  [messages]}}]}, with status 400 if anything was rejected.
+  """
+  if config['EditsAllowed'] != 1 or user_database[g.user.id][3] == 0:
+    return jsonify({'applied': 0,
+      'errors': [{'errors': {'request': ['Editing is disabled']}}]}), 403
+  body = request.get_json(silent=True)
+  updates = body.get('updates') if isinstance(body, dict) else None
+  if not isinstance(updates, list) or not updates:
+    return jsonify({'applied': 0, 'errors': [{'errors': {'request':
+      ['Expected json {"updates": [{"condition": ..., "values": {...}}, ...]}']}}]}), 400
+  with db_lock:
+    patched = {}
+    errors = []
+    for index, update in enumerate(updates):
+      key = update.get('condition') if isinstance(update, dict) else None
+      if not isinstance(key, string_types):
+        errors.append({'index': index, 'condition': key,
+          'errors': {'condition': ['Must be a condition key']}})
+        continue
+      exp_name = key.rsplit('_', 1)[0]
+      if key not in proc_data or exp_name not in metadata:
+        errors.append({'index': index, 'condition': key, 'errors': {'condition': ['Not found']}})
+        continue
+      if g.user.id != 'Admin' and metadata[exp_name][0] != g.user.id:
+        errors.append({'index': index, 'condition': key,
+          'errors': {'condition': ['Not your experiment']}})
+        continue
+      # Several updates of one condition apply in order
+      row, row_errors = PatchConditionRow(patched.get(key, proc_data[key]), update.get('values'))
+      if row_errors:
+        errors.append({'index': index, 'condition': key, 'errors': row_errors})
+      else:
+        patched[key] = row
+    if errors:
+      return jsonify({'applied': 0, 'errors': errors}), 400
+    proc_data.update(patched)
+    RefreshDerivedMetrics(*set(key.rsplit('_', 1)[0] for key in patched))
+    SaveDatabase('processed_data', *patched)
+  return jsonify({'applied': len(updates), 'errors': []})
+
+
 @app.route('/new-user', methods=['GET', 'POST'])
 def new_user():
   # Create new user
@@ -924,10 +2111,8 @@ def new_user():
         form.data['lab'], 0]  # Trailing 0 sets upload flag to false for new users
       user_pdatabase[form.data['username']] = \
         (hashlib.sha256(form.data['password']).hexdigest())
-      with open('databases/user_database.json', 'w') as outfile:
-        json.dump(user_database, outfile)
-      with open('databases/user_pdatabase.json', 'w') as outfile:
-        json.dump(user_pdatabase, outfile)
+      SaveDatabase('user_database')
+      SaveDatabase('user_pdatabase')
       user = load_user(form.data['username'])
       session['editusername'] = form.data['username']
       flask.ext.login.login_user(user)
@@ -952,8 +2137,7 @@ def edit_user():
       user_database[session['editusername']] = \
         [form.data['email'], form.data['surname'],
         form.data['lab']]
-      with open('databases/user_database.json', 'w') as outfile:
-        json.dump(user_database, outfile)
+      SaveDatabase('user_database')
       return redirect(url_for('index'))
     else:
       return render_template('edit-user.html', form=form, name=session['editusername'])
@@ -979,8 +2163,7 @@ def password_change():
     else:
       user_pdatabase[session['editusername']] = \
         (hashlib.sha256(form.data['password']).hexdigest())
-      with open('databases/user_pdatabase.json', 'w') as outfile:
-        json.dump(user_pdatabase, outfile)  
+      SaveDatabase('user_pdatabase')
       return redirect(url_for('index'))
 
 
@@ -991,18 +2174,14 @@ def admin_page():
   if g.user.id != "Admin":
     return redirect(url_for('index'))
   if request.method == "GET":
-    users_df = MakeDF(user_database, ['Email', 'Surname', 'Lab', 'UploadFlag'])
-    for username in user_database.keys():
-      users_df.loc[username, 'Experiments'] = sum([username in key for key in metadata.keys()])
-    table_html = users_df.to_html()
+    table_html = UsersTableHtml()
     form = AdminActionForm()
     return render_template('admin-page.html', table_html=table_html, \
       form=form)
   else:
     form = AdminActionForm(request.form)
-    users_df = MakeDF(user_database, ['Email', 'Surname', 'Lab', 'UploadFlag'])
     if not form.validate():
-      table_html = users_df.to_html()
+      table_html = UsersTableHtml()
       return render_template('admin-page.html', \
         table_html=table_html, form=form)
     if form.data['username'] not in user_database.keys():
@@ -1014,10 +2193,8 @@ def admin_page():
       else:
         user_database.pop(form.data['username'])
         user_pdatabase.pop(form.data['username'])
-        with open('databases/user_database.json', 'w') as outfile:
-          json.dump(user_database, outfile)
-        with open('databases/user_pdatabase.json', 'w') as outfile:
-          json.dump(user_pdatabase, outfile)
+        SaveDatabase('user_database')
+        SaveDatabase('user_pdatabase')
         msg = 'User ' + form.data['username'] + ' deleted.'
       return render_template('admin-message.html', msg=msg)
     if form.data['action'] == 'edit':
@@ -1031,25 +2208,45 @@ def admin_page():
         random.choice(string.ascii_letters + string.digits) for _ in range(8))
       user_pdatabase[form.data['username']] = \
         (hashlib.sha256(new_random_password).hexdigest())
-      with open('databases/user_pdatabase.json', 'w') as outfile:
-        json.dump(user_pdatabase, outfile)
+      SaveDatabase('user_pdatabase')
       msg = ('Password for '+form.data['username']+' set to '+new_random_password)
       msg2 = ('\nPlease email this password to '+user_database[form.data['username']][0])
       return render_template('admin-message.html', msg=msg+msg2)
     if form.data['action'] == 'activate':
       user_database[form.data['username']][3] = 1
-      with open('databases/user_database.json', 'w') as outfile:
-        json.dump(user_database, outfile)
+      SaveDatabase('user_database')
       return render_template('admin-message.html',
         msg=form.data['username']+' can now upload data.')      
     if form.data['action'] == 'deactivate':
       user_database[form.data['username']][3] = 0
-      with open('databases/user_database.json', 'w') as outfile:
-        json.dump(user_database, outfile)
+      SaveDatabase('user_database')
       return render_template('admin-message.html',
         msg=form.data['username']+' can no longer upload data.')
 
 
+@app.route('/admin-snapshot', methods=['GET', 'POST'])
+@login_required
+def admin_snapshot():
+  # Takes a snapshot of databases and uploaded files in the background, see snapshot_tool.py
+  if g.user.id != "Admin":
+    return redirect(url_for('index'))
+  snapshot_path = config.get('SnapshotPath', 'snapshots/')
+  if request.method == 'GET':
+    return render_template('admin-snapshot.html', snapshots=ListSnapshots(snapshot_path))
+  with db_lock:  # Databases are serialized together, so they are consistent
+    version = data_version
+    texts = dict((name, json.dumps(data if isinstance(data, dict) else dict(data)))
+      for name, data in databases.items())
+  def build(result_path):
+    name = TakeSnapshot(snapshot_path, 'databases', blobs.file_path, texts)
+    with open(result_path, 'w') as outfile:
+      outfile.write('Took snapshot '+name+' of data version '+str(version)+'\n')
+  # Keyed on the time too, so each request takes a snapshot even if no data changed
+  job = jobs.submit('snapshot', None, '%d@%.6f' % (version, time.time()), build,
+    'snapshot.txt')
+  return redirect(url_for('job_status', job_id=job.id))
+
+
 @app.route('/')
 def index():
   if os.path.exists('temp/'):
@@ -1069,6 +2266,62 @@ def sign_out():
   return render_template('sign-out.html')
 
 
+@app.route('/health')
+def health():
+  # Answers as soon as the process is up, including while databases are still loading
+  if database_load_error:
+    status = 'failed'
+  elif databases_loaded.is_set():
+    status = 'ready'
+  else:
+    status = 'loading'
+  return jsonify({'status': status, 'data_version': data_version,
+    'feed_version': change_feed.version if change_feed is not None else None,
+    'replica': dict(replica_status, primary=config['ReplicaOf']) if config['ReplicaOf']
+      else None,
+    'jobs_queued': jobs.queued(),
+    'thumbnails_queued': thumbnail_jobs.queued(),
+    'admission': dict((name, limiter.info()) for name, limiter in limiters.items()),
+    'startup': [{'phase': phase, 'seconds': seconds} for phase, seconds in startup_timings]})
+
+
+# Pages that change data or sign users in, and the change feed, which only the primary
+# keeps. A replica sends these to the primary
+PRIMARY_ENDPOINTS = set(['login', 'sign_in', 'sign_out', 'new_user', 'upload_page',
+  'experiment_page', 'file_upload', 'files_readme', 'file_delete', 'new_condition',
+  'delete_experiment', 'new_experiment', 'edit_metadata', 'checkboxes_page',
+  'processed_data', 'processed_data_batch', 'edit_user', 'password_change', 'admin_page',
+  'admin_snapshot', 'changes', 'changes_snapshot'])
+
+
+@app.before_request
+def redirect_to_primary():
+  if not config['ReplicaOf'] or request.endpoint not in PRIMARY_ENDPOINTS:
+    return
+  url = config['ReplicaOf'].rstrip('/') + request.path
+  if request.query_string:
+    url += '?' + request.query_string.decode('utf-8')
+  # 307 repeats a form post at the primary
+  return redirect(url, code=302 if request.method in ('GET', 'HEAD') else 307)
+
+
+@app.before_request
+def wait_for_databases():
+  if request.endpoint in ('health', 'static'):
+    return
+  databases_loaded.wait()
+  if database_load_error:
+    return 'Server could not load its databases, see server log.', 503
+
+
+if config['ReplicaOf']:
+  follower = threading.Thread(target=FollowPrimary)
+  follower.daemon = True
+  follower.start()
+else:
+  threading.Thread(target=LoadDatabases).start()
+
+
 # Execution starts here
 # Do not run in debug mode if allowing external connections! Security risk.
 
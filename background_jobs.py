@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Background job queue for the STG database server
+
+Builds that take a long time (zip archives of uploaded files, full database exports)
+are handed to a small pool of worker threads instead of running on the request thread.
+A job is identified by what it builds and the data version it was built from, so many
+users asking for the same archive of the same data share a single build.
+
+Results are written as files in the result directory and kept until they are pushed
+out by newer results. At most max_pending new builds wait for a worker; submitting more
+raises QueueFull until the queue drains.
+"""
+
+import os
+import time
+import hashlib
+import threading
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+
+class QueueFull(Exception):
+  pass
+
+
+class Job(object):
+  # Bookkeeping for one submitted build. Status is queued, running, done or failed
+  def __init__(self, job_id, kind, target, version, build, filename):
+    self.id = job_id
+    self.kind = kind
+    self.target = target
+    self.version = version
+    self.build = build
+    self.filename = filename
+    self.status = 'queued'
+    self.error = None
+    self.result_path = None
+    self.submitted = time.time()
+    self.started = None
+    self.finished = None
+
+  def info(self):
+    # Summary of the job that is safe to hand back to clients as json
+    return {'id': self.id, 'kind': self.kind, 'target': self.target,
+      'version': self.version, 'status': self.status, 'error': self.error,
+      'filename': self.filename, 'submitted': self.submitted,
+      'started': self.started, 'finished': self.finished}
+
+
+class JobQueue(object):
+  """
+  Pool of worker threads that run builds submitted with submit().
+
+  build is called as build(result_path) on a worker thread and must write its
+  output to result_path. Submitting a kind/target/version that is already queued,
+  running or done returns the existing job rather than starting a new build.
+  """
+  def __init__(self, result_dir, workers=2, max_results=20, max_pending=None):
+    self.result_dir = result_dir
+    self.max_results = max_results
+    self.max_pending = max_pending
+    self.lock = threading.Lock()
+    self.jobs = {}
+    self.pending = queue.Queue()
+    if os.path.isdir(result_dir):
+      for filename in os.listdir(result_dir):
+        os.remove(os.path.join(result_dir, filename))
+    else:
+      os.makedirs(result_dir)
+    for _ in range(workers):
+      worker = threading.Thread(target=self._work)
+      worker.daemon = True
+      worker.start()
+
+  @staticmethod
+  def job_id(kind, target, version):
+    key = '%s|%s|%s' % (kind, target, version)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+  def submit(self, kind, target, version, build, filename):
+    job_id = self.job_id(kind, target, version)
+    with self.lock:
+      job = self.jobs.get(job_id)
+      if job is not None and job.status != 'failed':
+        return job
+      if self.max_pending is not None and self.pending.qsize() >= self.max_pending:
+        raise QueueFull('Too many downloads are waiting to be built, try again shortly.')
+      job = Job(job_id, kind, target, version, build, filename)
+      self.jobs[job_id] = job
+    self.pending.put(job)
+    return job
+
+  def queued(self):
+    return self.pending.qsize()
+
+  def get(self, job_id):
+    with self.lock:
+      return self.jobs.get(job_id)
+
+  def find(self, kind, target, version):
+    # Returns a finished job for this build if one exists, without submitting
+    job = self.get(self.job_id(kind, target, version))
+    if job is not None and job.status == 'done':
+      return job
+    return None
+
+  def discard(self, kind, target, version):
+    # Forgets a finished build so the next submit builds it again
+    job = self.find(kind, target, version)
+    if job is not None:
+      with self.lock:
+        self.jobs.pop(job.id, None)
+      if job.result_path is not None and os.path.exists(job.result_path):
+        os.remove(job.result_path)
+
+  def _work(self):
+    while True:
+      job = self.pending.get()
+      job.status = 'running'
+      job.started = time.time()
+      result_path = os.path.join(self.result_dir, job.id + '-' + job.filename)
+      try:
+        job.build(result_path)
+      except Exception as e:
+        job.error = str(e)
+        job.status = 'failed'
+        if os.path.exists(result_path):
+          os.remove(result_path)
+      else:
+        job.result_path = result_path
+        job.status = 'done'
+      job.finished = time.time()
+      job.build = None
+      self._prune()
+
+  def _prune(self):
+    # Drops the oldest finished results once more than max_results are kept
+    with self.lock:
+      finished = sorted([job for job in self.jobs.values() if job.finished is not None],
+        key=lambda job: job.finished)
+      for job in finished[:max(0, len(finished) - self.max_results)]:
+        self.jobs.pop(job.id)
+        if job.result_path is not None and os.path.exists(job.result_path):
+          os.remove(job.result_path)
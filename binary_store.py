@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Compact binary copies of the json databases, for fast loading at startup
+
+metadata.json and processed_data.json map a key to a fixed-length row (list) of values.
+The binary copy stores the same data column by column: each column is typed (strings,
+integers, floats, or json text for anything else) and all strings are kept once, in a
+shared string table. It is read by memory-mapping the file, which is much quicker than
+parsing json and, since repeated strings become one shared object, uses less memory.
+
+The binary file records the size and modification time of the json file it was made
+from. A binary copy that is missing, damaged or older than its json file is ignored.
+
+Layout (little endian):
+  header   b'STGB', format version (H), json size (Q), json mtime (d), crc32 of body (I),
+           body length (Q)
+  body     string count (I), string offsets (I * count+1), utf-8 string bytes,
+           row count (I), column count (I), key string indexes (I * rows),
+           then per column: type (c), flags (B * rows), values
+Column types are 's' (string index, I), 'i' (q), 'f' (d), 'j' (string index of the json
+text, I) and 'n' (all null, no values). Flags are 0 for a value, 1 for null, and 2 for a
+float column entry that was an integer in json.
+"""
+
+import os
+import gc
+import sys
+import mmap
+import zlib
+import struct
+import simplejson as json
+
+MAGIC = b'STGB'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHQdIQ')
+
+if sys.version_info[0] < 3:
+  string_types = (str, unicode)
+  int_types = (int, long)
+else:
+  string_types = (str,)
+  int_types = (int,)
+
+
+def ColumnType(values):
+  kinds = set()
+  for value in values:
+    if value is None:
+      continue
+    if isinstance(value, bool):
+      return 'j'
+    if isinstance(value, int_types) and -2**63 <= value < 2**63:
+      kinds.add('i')
+    elif isinstance(value, float):
+      kinds.add('f')
+    elif isinstance(value, string_types):
+      kinds.add('s')
+    else:
+      return 'j'
+  if not kinds:
+    return 'n'
+  if len(kinds) == 1:
+    return kinds.pop()
+  if kinds == set(['i', 'f']):
+    return 'f'
+  return 'j'
+
+
+def Encode(data):
+  # Returns the body for a {key: row} dict, or None if rows differ in length
+  keys = list(data.keys())
+  rows = [data[key] for key in keys]
+  width = len(rows[0]) if rows else 0
+  if any(not isinstance(row, list) or len(row) != width for row in rows):
+    return None
+  strings = {}
+  def intern(text):
+    if text not in strings:
+      strings[text] = len(strings)
+    return strings[text]
+
+  parts = [struct.pack('<II', len(rows), width),
+    struct.pack('<%dI' % len(keys), *[intern(key) for key in keys])]
+  for column in range(width):
+    values = [row[column] for row in rows]
+    kind = ColumnType(values)
+    flags = bytearray(1 if value is None else 0 for value in values)
+    if kind == 'f':
+      for n, value in enumerate(values):
+        if isinstance(value, int_types):
+          if float(value) != value:
+            kind = 'j'
+            break
+          flags[n] = 2
+    if kind == 'j':
+      flags = bytearray(0 for value in values)
+    parts.append(struct.pack('<c', kind.encode('ascii')))
+    parts.append(bytes(flags))
+    if kind == 's':
+      parts.append(struct.pack('<%dI' % len(values),
+        *[0 if value is None else intern(value) for value in values]))
+    elif kind == 'i':
+      parts.append(struct.pack('<%dq' % len(values),
+        *[0 if value is None else value for value in values]))
+    elif kind == 'f':
+      parts.append(struct.pack('<%dd' % len(values),
+        *[0.0 if value is None else float(value) for value in values]))
+    elif kind == 'j':
+      parts.append(struct.pack('<%dI' % len(values),
+        *[intern(json.dumps(value)) for value in values]))
+
+  table = sorted(strings, key=strings.get)
+  encoded = [(text if isinstance(text, bytes) else text.encode('utf-8')) for text in table]
+  offsets = [0]
+  for text in encoded:
+    offsets.append(offsets[-1] + len(text))
+  head = struct.pack('<I', len(table)) + struct.pack('<%dI' % len(offsets), *offsets)
+  return head + b''.join(encoded) + b''.join(parts)
+
+
+def WriteBinary(data, binary_path, json_path):
+  # Writes the binary copy of data, made from (and matching) the json file at json_path
+  body = Encode(data)
+  if body is None:
+    if os.path.exists(binary_path):
+      os.remove(binary_path)
+    return
+  stat = os.stat(json_path)
+  header = HEADER.pack(MAGIC, FORMAT_VERSION, stat.st_size, stat.st_mtime,
+    zlib.crc32(body) & 0xffffffff, len(body))
+  with open(binary_path+'.tmp', 'wb') as outfile:
+    outfile.write(header)
+    outfile.write(body)
+  os.rename(binary_path+'.tmp', binary_path)
+
+
+def LoadBinary(binary_path, json_path):
+  # Returns the {key: row} dict from a valid, current binary copy, otherwise None
+  if not os.path.exists(binary_path) or not os.path.exists(json_path):
+    return None
+  stat = os.stat(json_path)
+  with open(binary_path, 'rb') as infile:
+    if os.fstat(infile.fileno()).st_size < HEADER.size:
+      return None
+    buf = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    magic, version, json_size, json_mtime, crc, length = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != FORMAT_VERSION or json_size != stat.st_size \
+        or json_mtime != stat.st_mtime or HEADER.size + length != len(buf):
+      return None
+    check = 0
+    for start in range(HEADER.size, len(buf), 1 << 20):
+      check = zlib.crc32(buf[start:start + (1 << 20)], check)
+    if check & 0xffffffff != crc:
+      return None
+    # Decoding only allocates lists that cannot form cycles, so the collector would
+    # just rescan them over and over
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+      return Decode(buf, HEADER.size)
+    finally:
+      if gc_was_enabled:
+        gc.enable()
+  finally:
+    buf.close()
+
+
+def Decode(buf, pos):
+  count, = struct.unpack_from('<I', buf, pos)
+  offsets = struct.unpack_from('<%dI' % (count+1), buf, pos+4)
+  pos += 4 + 4*(count+1)
+  blob = buf[pos:pos+offsets[-1]]
+  strings = [blob[start:end].decode('utf-8') for start, end in zip(offsets, offsets[1:])]
+  pos += offsets[-1]
+  n_rows, width = struct.unpack_from('<II', buf, pos)
+  pos += 8
+  keys = [strings[n] for n in struct.unpack_from('<%dI' % n_rows, buf, pos)]
+  pos += 4*n_rows
+  columns = []
+  for column in range(width):
+    kind = buf[pos:pos+1].decode('ascii')
+    flags = bytearray(buf[pos+1:pos+1+n_rows])
+    pos += 1 + n_rows
+    if kind == 'n':
+      columns.append([None]*n_rows)
+      continue
+    code = {'s': 'I', 'i': 'q', 'f': 'd', 'j': 'I'}[kind]
+    values = list(struct.unpack_from('<%d%s' % (n_rows, code), buf, pos))
+    pos += struct.calcsize(code)*n_rows
+    if kind == 's':
+      values = [strings[value] for value in values]
+    elif kind == 'j':
+      values = [json.loads(strings[value]) for value in values]
+    if flags.count(b'\x00') != n_rows:
+      values = [value if flag == 0 else (None if flag == 1 else int(value))
+        for value, flag in zip(values, flags)]
+    columns.append(values)
+  if not width:
+    return dict((key, []) for key in keys)
+  return dict(zip(keys, map(list, zip(*columns))))
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+"""
+Where uploaded files are kept: a local directory, or an S3-compatible object store
+(BlobStorage in config.json)
+
+Files are addressed by experiment and file name. LocalStore keeps them in
+<FilePath><experiment>/<name>, as the server always has. S3Store keeps them as objects
+<S3Prefix><experiment>/<name> in a bucket, so several servers (or replicas) on different
+machines can share one copy of the files. It speaks the S3 protocol over plain HTTP,
+signed with Signature Version 4, so it works with AWS S3 and with stand-ins such as MinIO
+or Ceph without any extra packages.
+
+S3Store uploads a file in parts of S3PartMB, read one after another from the upload, so a
+large file is never held in memory whole. Each object carries its SHA256 as metadata, so
+the file manifest is built without reading files back. Reads stream the object, or just a
+range of it. Code that needs a file on disk (recording previews, thumbnails, zip archives)
+calls fetch(), which downloads a copy into BlobCachePath, a least recently used cache of at
+most BlobCacheMB whose files are named by their SHA256.
+"""
+
+import os
+import time
+import hmac
+import shutil
+import hashlib
+import calendar
+import threading
+import mimetypes
+from email.utils import parsedate_tz, mktime_tz
+from xml.etree import ElementTree
+try:
+  from urllib2 import urlopen, Request, HTTPError
+  from urllib import quote
+  from urlparse import urlparse
+except ImportError:
+  from urllib.request import urlopen, Request
+  from urllib.error import HTTPError
+  from urllib.parse import quote, urlparse
+try:
+  from os import scandir
+except ImportError:  # Python 2, unless the scandir package is installed
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+CHUNK = 1 << 16
+
+
+class StorageError(Exception):
+  # A request to the object store failed; status is its HTTP status, if it got one
+  def __init__(self, message, status=None):
+    Exception.__init__(self, message)
+    self.status = status
+
+
+def OpenStore(config):
+  # The store config.json asks for: the FilePath directory, or an S3 bucket
+  if config.get('BlobStorage', 'local') == 's3':
+    return S3Store(config['S3Endpoint'], config['S3Bucket'], config.get('S3Prefix', ''),
+      config.get('S3Region', 'us-east-1'),
+      config.get('S3AccessKey') or os.environ.get('AWS_ACCESS_KEY_ID', ''),
+      config.get('S3SecretKey') or os.environ.get('AWS_SECRET_ACCESS_KEY', ''),
+      int(config.get('S3PartMB', 8) * 2**20), config.get('BlobCachePath', 'blob-cache/'),
+      int(config.get('BlobCacheMB', 512) * 2**20))
+  return LocalStore(config['FilePath'])
+
+
+def FileHash(path):
+  sha = hashlib.sha256()
+  with open(path, 'rb') as infile:
+    for chunk in iter(lambda: infile.read(1 << 20), b''):
+      sha.update(chunk)
+  return sha.hexdigest()
+
+
+def ScanFiles(path):
+  # Yields (name, size, mtime) of the regular files in a directory
+  if scandir is not None:
+    for entry in scandir(path):
+      if entry.is_file():
+        stat = entry.stat()
+        yield entry.name, stat.st_size, stat.st_mtime
+  else:
+    for name in os.listdir(path):
+      if os.path.isfile(os.path.join(path, name)):
+        stat = os.stat(os.path.join(path, name))
+        yield name, stat.st_size, stat.st_mtime
+
+
+def ReadChunks(infile, length=None):
+  # Yields an open file's contents (or its next length bytes) in chunks, then closes it
+  try:
+    while length is None or length > 0:
+      chunk = infile.read(CHUNK if length is None else min(CHUNK, length))
+      if not chunk:
+        break
+      if length is not None:
+        length -= len(chunk)
+      yield chunk
+  finally:
+    infile.close()
+
+
+class LocalStore(object):
+  def __init__(self, file_path):
+    self.file_path = file_path  # The files' directory, for tools that work on it directly
+
+  def path(self, exp_name, name=''):
+    return os.path.join(self.file_path, exp_name, name)
+
+  def exists(self, exp_name, name):
+    return os.path.isfile(self.path(exp_name, name))
+
+  def stat(self, exp_name, name):
+    # (size, mtime) of a file
+    stat = os.stat(self.path(exp_name, name))
+    return stat.st_size, stat.st_mtime
+
+  def sha256(self, exp_name, name):
+    return FileHash(self.path(exp_name, name))
+
+  def list(self, exp_name):
+    # (name, size, mtime) of an experiment's files
+    if not os.path.isdir(self.path(exp_name)):
+      return []
+    return list(ScanFiles(self.path(exp_name)))
+
+  def list_all(self):
+    # {experiment: [(name, size, mtime)]} of every experiment with a files directory
+    if not os.path.isdir(self.file_path):
+      return {}
+    return dict((exp_name, self.list(exp_name)) for exp_name in os.listdir(self.file_path)
+      if os.path.isdir(self.path(exp_name)))
+
+  def save(self, exp_name, name, stream):
+    # Stores a file from an open stream, replacing any file of that name
+    if not os.path.isdir(self.path(exp_name)):
+      os.makedirs(self.path(exp_name))
+    with open(self.path(exp_name, name), 'wb') as outfile:
+      shutil.copyfileobj(stream, outfile, CHUNK)
+
+  def stream(self, exp_name, name, start=0, end=None):
+    # Iterator over bytes start to end of a file. The file is opened now, so a missing
+    # file raises here rather than part way through a response
+    infile = open(self.path(exp_name, name), 'rb')
+    infile.seek(start)
+    return ReadChunks(infile, None if end is None else max(0, end-start))
+
+  def read(self, exp_name, name, start=0, end=None):
+    return b''.join(self.stream(exp_name, name, start, end))
+
+  def fetch(self, exp_name, name, sha):
+    # Path of the file on local disk
+    return self.path(exp_name, name)
+
+  def remove(self, exp_name, name):
+    os.remove(self.path(exp_name, name))
+
+  def remove_all(self, exp_name):
+    if os.path.isdir(self.path(exp_name)):
+      shutil.rmtree(self.path(exp_name))
+
+
+class S3Store(object):
+  def __init__(self, endpoint, bucket, prefix, region, access_key, secret_key,
+      part_size=8 * 2**20, cache_path='blob-cache/', cache_bytes=512 * 2**20, timeout=60):
+    url = urlparse(endpoint)
+    self.scheme = url.scheme or 'https'
+    self.host = url.netloc or url.path  # Host, with the port if not the default
+    self.bucket = bucket
+    self.prefix = prefix
+    self.region = region
+    self.access_key = access_key
+    self.secret_key = secret_key
+    self.part_size = max(part_size, 5 * 2**20)  # S3's smallest part, except the last
+    self.cache_path = cache_path
+    self.cache_bytes = cache_bytes
+    self.timeout = timeout
+    self.file_path = None  # Files are not on local disk
+
+  def key(self, exp_name, name=''):
+    return self.prefix + exp_name + '/' + name
+
+  def request(self, method, key='', query=None, headers=None, body=b''):
+    # Sends a signed request and returns the open response. Failures raise StorageError
+    path = Quote('/' + self.bucket + ('/' + key if key else ''), '/~')
+    query = '&'.join(Quote(name, '~')+'='+Quote(value, '~')
+      for name, value in sorted((query or {}).items()))
+    headers = dict(headers or {})
+    if method in ('PUT', 'POST'):
+      # Otherwise urllib marks the body as a form, which some stores then try to parse
+      headers.setdefault('Content-Type', 'application/octet-stream')
+    headers['x-amz-date'] = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    headers['x-amz-content-sha256'] = hashlib.sha256(body).hexdigest()
+    headers['Authorization'] = Authorization(method, self.host, path, query, headers,
+      self.region, self.access_key, self.secret_key)
+    request = Request('%s://%s%s%s' % (self.scheme, self.host, path, query and '?'+query),
+      body if method in ('PUT', 'POST') else None, headers)
+    request.get_method = lambda: method
+    try:
+      return urlopen(request, timeout=self.timeout)
+    except HTTPError as e:
+      raise StorageError('S3 %s %s failed: %s' % (method, path, ErrorText(e)), e.code)
+    except (IOError, OSError) as e:
+      raise StorageError('S3 %s %s failed: %s' % (method, path, e))
+
+  def request_xml(self, method, key='', query=None, headers=None, body=b''):
+    response = self.request(method, key, query, headers, body)
+    try:
+      return ElementTree.fromstring(response.read())
+    finally:
+      response.close()
+
+  def head(self, exp_name, name):
+    response = self.request('HEAD', self.key(exp_name, name))
+    response.close()
+    return response.info()
+
+  def exists(self, exp_name, name):
+    try:
+      self.head(exp_name, name)
+    except StorageError as e:
+      if e.status == 404:
+        return False
+      raise
+    return True
+
+  def stat(self, exp_name, name):
+    # (size, mtime) of a file. S3 keeps times to the second
+    info = self.head(exp_name, name)
+    return int(info.get('Content-Length')), HttpTime(info.get('Last-Modified'))
+
+  def sha256(self, exp_name, name):
+    # From the object's metadata, or read through if it was stored by other means
+    sha = self.head(exp_name, name).get('x-amz-meta-sha256')
+    if sha is None:
+      digest = hashlib.sha256()
+      for chunk in self.stream(exp_name, name):
+        digest.update(chunk)
+      sha = digest.hexdigest()
+    return sha
+
+  def list_bucket(self, prefix, delimiter=None):
+    # Returns ([(key, size, mtime)], [common prefixes]) under a prefix, from all pages
+    objects = []
+    prefixes = []
+    query = {'list-type': '2', 'prefix': prefix}
+    if delimiter:
+      query['delimiter'] = delimiter
+    while True:
+      root = self.request_xml('GET', '', query)
+      objects += [(Text(element, 'Key'), int(Text(element, 'Size')),
+        IsoTime(Text(element, 'LastModified'))) for element in Elements(root, 'Contents')]
+      prefixes += [Text(element, 'Prefix') for element in Elements(root, 'CommonPrefixes')]
+      if Text(root, 'IsTruncated') != 'true':
+        return objects, prefixes
+      query['continuation-token'] = Text(root, 'NextContinuationToken')
+
+  def list(self, exp_name):
+    start = len(self.key(exp_name))
+    objects, prefixes = self.list_bucket(self.key(exp_name), '/')
+    return [(key[start:], size, mtime) for key, size, mtime in objects]
+
+  def list_all(self):
+    # One listing of the whole prefix, rather than one per experiment
+    files = {}
+    for key, size, mtime in self.list_bucket(self.prefix)[0]:
+      exp_name, _, name = key[len(self.prefix):].partition('/')
+      if name and '/' not in name:
+        files.setdefault(exp_name, []).append((name, size, mtime))
+    return files
+
+  def save(self, exp_name, name, stream):
+    """
+    Stores a file from an open, seekable stream, replacing any file of that name. The
+    stream is read once for its SHA256, then sent in one request if it fits in a part, or
+    as a multipart upload otherwise.
+    """
+    start = stream.tell()
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(CHUNK), b''):
+      digest.update(chunk)
+    stream.seek(start)
+    key = self.key(exp_name, name)
+    headers = {'Content-Type': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+      'x-amz-meta-sha256': digest.hexdigest()}
+    part = stream.read(self.part_size)
+    if len(part) < self.part_size:
+      self.request('PUT', key, headers=headers, body=part).close()
+      return
+    upload_id = Text(self.request_xml('POST', key, {'uploads': ''}, headers), 'UploadId')
+    completed = False
+    try:
+      etags = []
+      while part:
+        response = self.request('PUT', key,
+          {'partNumber': str(len(etags)+1), 'uploadId': upload_id}, body=part)
+        etags.append(response.info().get('ETag'))
+        response.close()
+        part = stream.read(self.part_size)
+      body = '<CompleteMultipartUpload>%s</CompleteMultipartUpload>' % ''.join(
+        '<Part><PartNumber>%d</PartNumber><ETag>%s</ETag></Part>' % (number+1, etag)
+        for number, etag in enumerate(etags))
+      # Completing can fail after the response has started, as an Error body
+      root = self.request_xml('POST', key, {'uploadId': upload_id}, body=body.encode('utf-8'))
+      if root.tag.rsplit('}', 1)[-1] == 'Error':
+        raise StorageError('S3 upload of %s failed: %s %s' % (key, Text(root, 'Code'),
+          Text(root, 'Message')))
+      completed = True
+    finally:
+      if not completed:
+        try:
+          self.request('DELETE', key, {'uploadId': upload_id}).close()
+        except StorageError:
+          pass  # Left for the bucket's lifecycle rules to clear
+
+  def stream(self, exp_name, name, start=0, end=None):
+    # Iterator over bytes start to end of a file, read with one ranged request, which is
+    # made now so a missing file raises here rather than part way through a response
+    if end is not None and end <= start:
+      return iter([])
+    headers = {}
+    if start or end is not None:
+      headers['Range'] = 'bytes=%d-%s' % (start, '' if end is None else end-1)
+    return ReadChunks(self.request('GET', self.key(exp_name, name), headers=headers))
+
+  def read(self, exp_name, name, start=0, end=None):
+    return b''.join(self.stream(exp_name, name, start, end))
+
+  def fetch(self, exp_name, name, sha):
+    # Path of a local copy of the file, downloaded into the cache if not there already
+    path = os.path.join(self.cache_path, sha)
+    try:
+      os.utime(path, None)  # Now the most recently used
+      return path
+    except OSError:
+      pass
+    if not os.path.isdir(self.cache_path):
+      os.makedirs(self.cache_path)
+    temp = path+'.%d.tmp' % threading.current_thread().ident
+    digest = hashlib.sha256()
+    with open(temp, 'wb') as outfile:
+      for chunk in self.stream(exp_name, name):
+        digest.update(chunk)
+        outfile.write(chunk)
+    if digest.hexdigest() != sha:
+      os.remove(temp)
+      raise StorageError('%s/%s has changed since it was listed' % (exp_name, name))
+    os.rename(temp, path)
+    PruneCache(self.cache_path, self.cache_bytes, keep=path)
+    return path
+
+  def remove(self, exp_name, name):
+    self.request('DELETE', self.key(exp_name, name)).close()
+
+  def remove_all(self, exp_name):
+    for key, size, mtime in self.list_bucket(self.key(exp_name))[0]:
+      self.request('DELETE', key).close()
+
+
+def Quote(text, safe):
+  # Percent-encodes all but letters, digits, - _ . and safe, as S3 signing expects
+  if not isinstance(text, bytes):
+    text = text.encode('utf-8')
+  return quote(text, safe=safe)
+
+
+def Authorization(method, host, path, query, headers, region, access_key, secret_key):
+  """
+  Authorization header of an S3 request, by AWS Signature Version 4. path and query are as
+  sent (already quoted). headers must include x-amz-date and x-amz-content-sha256; they
+  are signed, with the host and any Range and other x-amz- headers.
+  """
+  signed = dict((name.lower(), ' '.join(str(value).split())) for name, value in headers.items()
+    if name.lower().startswith('x-amz-') or name.lower() == 'range')
+  signed['host'] = host
+  names = sorted(signed)
+  canonical = '\n'.join([method, path, query] + [name+':'+signed[name] for name in names] +
+    ['', ';'.join(names), signed['x-amz-content-sha256']])
+  date = signed['x-amz-date']
+  scope = '%s/%s/s3/aws4_request' % (date[:8], region)
+  text = '\n'.join(['AWS4-HMAC-SHA256', date, scope,
+    hashlib.sha256(canonical.encode('utf-8')).hexdigest()])
+  key = ('AWS4'+secret_key).encode('utf-8')
+  for part in (date[:8], region, 's3', 'aws4_request'):
+    key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+  signature = hmac.new(key, text.encode('utf-8'), hashlib.sha256).hexdigest()
+  return 'AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, Signature=%s' % (
+    access_key, scope, ';'.join(names), signature)
+
+
+def Elements(root, tag):
+  # Elements named tag anywhere under root, whatever their namespace
+  return [element for element in root.iter() if element.tag.rsplit('}', 1)[-1] == tag]
+
+
+def Text(root, tag):
+  found = Elements(root, tag)
+  return found[0].text if found else None
+
+
+def ErrorText(response):
+  # Code and message of an S3 error response (HEAD errors have no body)
+  try:
+    root = ElementTree.fromstring(response.read())
+  except ElementTree.ParseError:
+    return 'HTTP %d' % response.code
+  return '%s %s' % (Text(root, 'Code'), Text(root, 'Message'))
+
+
+def IsoTime(text):
+  # '2016-01-08T14:02:36.000Z' (object listings) as seconds since the epoch
+  return float(calendar.timegm(time.strptime(text[:19], '%Y-%m-%dT%H:%M:%S')))
+
+
+def HttpTime(text):
+  # 'Fri, 08 Jan 2016 14:02:36 GMT' (Last-Modified) as seconds since the epoch
+  return float(mktime_tz(parsedate_tz(text)))
+
+
+def PruneCache(cache_path, max_bytes, keep=None):
+  # Removes least recently used copies until the cache fits in max_bytes
+  entries = []
+  for name in os.listdir(cache_path):
+    path = os.path.join(cache_path, name)
+    if name.endswith('.tmp') or path == keep:
+      continue
+    try:
+      stat = os.stat(path)
+    except OSError:
+      continue
+    entries.append((stat.st_mtime, stat.st_size, path))
+  total = sum(entry[1] for entry in entries)
+  if keep is not None and os.path.exists(keep):
+    total += os.path.getsize(keep)
+  for mtime, size, path in sorted(entries):
+    if total <= max_bytes:
+      break
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+    total -= size
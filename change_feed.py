@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Versioned feed of changes to the databases, for keeping mirrors in sync
+
+Whenever a database is saved, its rows are compared with a shadow copy of row digests to
+find which keys were inserted, updated or deleted. A save that knows which keys it changed
+passes them, so only those rows are compared. Each save that changes anything gets
+the next feed version, and its changes are appended to the feed log with their new rows.
+A client that remembers the last version it saw asks for the changes after it, and so
+only downloads what changed.
+
+The log (change_feed.jsonl) holds one change per line: [version, database, key, op, row].
+When it grows past max_changes, the oldest half is folded into the base file
+(change_feed_base.json), which holds the row digests as of the last version dropped from
+the log. Clients that are further behind than the log reaches are told to resync.
+
+At startup the shadows are rebuilt from the base file and log and compared with the
+loaded databases, so changes made while the server was stopped (restoring a snapshot,
+editing the json files) are recorded too.
+"""
+
+import os
+import bisect
+import hashlib
+import threading
+import simplejson as json
+
+
+def RowDigest(row):
+  # Decimals (from forms) are hashed as the floats they are saved and reloaded as
+  text = json.dumps(row, sort_keys=True, use_decimal=False, default=float)
+  return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+class ChangeFeed(object):
+  def __init__(self, path, max_changes=100000):
+    self.log_path = os.path.join(path, 'change_feed.jsonl')
+    self.base_path = os.path.join(path, 'change_feed_base.json')
+    self.max_changes = max_changes
+    self.condition = threading.Condition()
+    self.base_version = 0
+    self.shadows = {}  # database: {key: row digest}
+    self.changes = []  # (version, database, key, op, row), oldest first
+    self.versions = []  # Version of each change, for bisect
+    self.new = not os.path.exists(self.base_path) and not os.path.exists(self.log_path)
+    if os.path.exists(self.base_path):
+      with open(self.base_path) as infile:
+        base = json.load(infile)
+      self.base_version = base['version']
+      self.shadows = base['shadows']
+    if os.path.exists(self.log_path):
+      with open(self.log_path) as infile:
+        for line in infile:
+          try:
+            change = tuple(json.loads(line))
+          except ValueError:
+            break  # Last line cut short by a crash
+          self._apply(change)
+          self.changes.append(change)
+          self.versions.append(change[0])
+    self.version = self.versions[-1] if self.versions else self.base_version
+
+  def _apply(self, change):
+    # Updates the shadows for one change
+    version, database, key, op, row = change
+    shadow = self.shadows.setdefault(database, {})
+    if op == 'delete':
+      shadow.pop(key, None)
+    else:
+      shadow[key] = RowDigest(row)
+
+  def record(self, database, data, keys=None):
+    """
+    Compares a database with its shadow and records any changes as a new version.
+    Call after each save, holding the lock that guards data. keys limits the comparison
+    to the rows that may have changed. Returns the new version, or None if nothing
+    changed.
+    """
+    shadow = self.shadows.get(database, {})
+    found = []
+    if keys is None:
+      keys = list(data.keys()) + [key for key in shadow if key not in data]
+    for key in keys:
+      if key in data:
+        row = data[key]
+        if shadow.get(key) != RowDigest(row):
+          found.append((key, 'update' if key in shadow else 'insert', row))
+      elif key in shadow:
+        found.append((key, 'delete', None))
+    if not found:
+      return None
+    with self.condition:
+      self.version += 1
+      changes = [(self.version, database, key, op, row) for key, op, row in sorted(found)]
+      # Rows are serialized now, before the caller can change them again
+      lines = [json.dumps(change) for change in changes]
+      for change in changes:
+        self._apply(change)
+      self.changes.extend(json.loads(line) for line in lines)
+      self.versions.extend(change[0] for change in changes)
+      with open(self.log_path, 'a') as outfile:
+        outfile.write(''.join(line+'\n' for line in lines))
+      if len(self.changes) > self.max_changes:
+        self._compact()
+      self.condition.notify_all()
+      return self.version
+
+  def prime(self, database, data):
+    # Sets a database's shadow without recording changes, for a brand new feed
+    with self.condition:
+      self.shadows[database] = dict((key, RowDigest(row)) for key, row in data.items())
+
+  def compact(self, keep):
+    # Folds all but about the newest keep changes into the base file
+    with self.condition:
+      if len(self.changes) > keep:
+        self._compact(keep)
+
+  def _compact(self, keep=None):
+    # Folds the oldest half of the log (or all but keep changes) into the base file
+    if keep is None:
+      keep = self.max_changes // 2
+    if keep:
+      cut = bisect.bisect_right(self.versions, self.versions[-keep])
+      cut = bisect.bisect_left(self.versions, self.versions[cut-1])  # Whole versions only
+    else:
+      cut = len(self.changes)
+    if cut == 0:
+      return
+    base_shadows = self.shadows
+    self.shadows = {}
+    self._load_base()
+    for change in self.changes[:cut]:
+      self._apply(change)
+    base = {'version': self.changes[cut-1][0], 'shadows': self.shadows}
+    self.shadows = base_shadows
+    with open(self.base_path+'.tmp', 'w') as outfile:
+      json.dump(base, outfile)
+    os.rename(self.base_path+'.tmp', self.base_path)
+    self.base_version = base['version']
+    self.changes = self.changes[cut:]
+    self.versions = self.versions[cut:]
+    with open(self.log_path+'.tmp', 'w') as outfile:
+      outfile.write(''.join(json.dumps(change)+'\n' for change in self.changes))
+    os.rename(self.log_path+'.tmp', self.log_path)
+
+  def _load_base(self):
+    if os.path.exists(self.base_path):
+      with open(self.base_path) as infile:
+        self.shadows = json.load(infile)['shadows']
+
+  def save_base(self):
+    # Writes the base file for a new feed, so its starting point survives a restart
+    with self.condition:
+      with open(self.base_path+'.tmp', 'w') as outfile:
+        json.dump({'version': self.version, 'shadows': self.shadows}, outfile)
+      os.rename(self.base_path+'.tmp', self.base_path)
+      self.new = False
+
+  def read(self, since, limit=500, databases=None, wait=0):
+    """
+    Returns (changes after version since, version the client has now seen, whether more
+    changes follow, whether the client must resync). A page holds about limit changes,
+    but never splits a version. With wait, blocks up to that many seconds for a change
+    when there is none yet. databases limits which databases' changes are returned.
+    """
+    with self.condition:
+      if since < self.base_version or since > self.version:
+        return [], self.version, False, True
+      if wait and since == self.version:
+        self.condition.wait(wait)
+      start = bisect.bisect_right(self.versions, since)
+      end = min(len(self.changes), start + limit)
+      if start < end < len(self.changes):
+        end = bisect.bisect_right(self.versions, self.versions[end-1])
+      page = self.changes[start:end]
+      seen = page[-1][0] if page else since
+      more = end < len(self.changes)
+    if databases is not None:
+      page = [change for change in page if change[1] in databases]
+    return page, seen, more, False
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Per-experiment metrics derived from the processed data of all of its conditions
+
+Temperature ramp and neuromodulation experiments have one processed data row per
+condition. These metrics summarize how an experiment's rhythm changes across them:
+
+- Q10 of pyloric and gastric frequency, from a least-squares fit of log frequency
+  against condition temperature (Q10 = exp(10 * slope)), with the fit's R squared
+- Phase constancy: standard deviation across conditions of each phase (0-1)
+- Spikes per burst trends: slope of PD, LP and PY spikes per burst against temperature
+
+A condition without its own temperature uses the experiment's baseline temperature
+(metadata). Metrics are None where there are too few conditions to compute them.
+All experiments are computed together with vectorized pandas group sums.
+"""
+
+DERIVED_COLUMNS = ['Conditions', 'Temps', 'Pyl Q10', 'Pyl Q10 R2', 'Gas Q10', 'Gas Q10 R2',
+  'PD off SD', 'LP on SD', 'LP off SD', 'PY on SD', 'PY off SD',
+  'PD spikes/C', 'LP spikes/C', 'PY spikes/C']
+
+# Positions of the values used, in processed data rows
+COND_FIELDS = {'temp': 1, 'pyl_hz': 2, 'gas_hz': 5, 'pd_off': 8, 'pd_spikes': 9,
+  'lp_on': 10, 'lp_off': 11, 'lp_spikes': 12, 'py_on': 13, 'py_off': 14, 'py_spikes': 15}
+
+
+def Number(value):
+  # Form entries are Decimals until reloaded from json; anything non-numeric is missing
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return None
+
+
+def LinearFits(groups, x, y):
+  # Least-squares slope and R squared of y against x for each group, from group sums
+  import pandas as pd
+  valid = x.notnull() & y.notnull()
+  frame = pd.DataFrame({'n': valid.astype(float), 'x': x.where(valid, 0.0),
+    'y': y.where(valid, 0.0)})
+  frame['xx'] = frame['x']**2
+  frame['yy'] = frame['y']**2
+  frame['xy'] = frame['x']*frame['y']
+  sums = frame.groupby(groups).sum()
+  sxx = sums['n']*sums['xx'] - sums['x']**2
+  syy = sums['n']*sums['yy'] - sums['y']**2
+  sxy = sums['n']*sums['xy'] - sums['x']*sums['y']
+  usable = (sums['n'] >= 2) & (sxx > 1e-12)
+  slope = (sxy / sxx).where(usable)
+  r2 = (sxy**2 / (sxx*syy)).where(usable & (syy > 1e-12))
+  return slope, r2
+
+
+def ComputeMetrics(metadata, proc_data, exp_names=None):
+  """
+  Returns {experiment: row of DERIVED_COLUMNS} for exp_names (all experiments if None).
+  """
+  import numpy as np
+  import pandas as pd
+  if exp_names is None:
+    exp_names = list(metadata.keys())
+  exp_names = [exp_name for exp_name in exp_names if exp_name in metadata]
+  keys, exps = [], []
+  for exp_name in exp_names:
+    for condnum in range(metadata[exp_name][11]):
+      if exp_name+'_'+str(condnum) in proc_data:
+        keys.append(exp_name+'_'+str(condnum))
+        exps.append(exp_name)
+  if not keys:
+    return dict((exp_name, [0, 0] + [None]*(len(DERIVED_COLUMNS)-2)) for exp_name in exp_names)
+
+  conds = pd.DataFrame(dict((field, [Number(proc_data[key][pos]) for key in keys])
+    for field, pos in COND_FIELDS.items()), index=keys, dtype=float)
+  conds['exp'] = exps
+  baseline_temps = pd.Series([Number(metadata[exp][6]) for exp in exps], index=keys, dtype=float)
+  temp = conds['temp'].fillna(baseline_temps)
+  groups = conds['exp']
+
+  metrics = pd.DataFrame(index=pd.Index(exp_names))
+  metrics['Conditions'] = groups.groupby(groups).size()
+  metrics['Temps'] = temp.where(conds['pyl_hz'] > 0).groupby(groups).nunique()
+  for name, field in [('Pyl', 'pyl_hz'), ('Gas', 'gas_hz')]:
+    log_hz = np.log(conds[field].where(conds[field] > 0))
+    slope, r2 = LinearFits(groups, temp, log_hz)
+    metrics[name+' Q10'] = np.exp(10*slope)
+    metrics[name+' Q10 R2'] = r2
+  for name, field in [('PD off', 'pd_off'), ('LP on', 'lp_on'), ('LP off', 'lp_off'),
+      ('PY on', 'py_on'), ('PY off', 'py_off')]:
+    metrics[name+' SD'] = conds[field].groupby(groups).std()
+  for name, field in [('PD', 'pd_spikes'), ('LP', 'lp_spikes'), ('PY', 'py_spikes')]:
+    metrics[name+' spikes/C'] = LinearFits(groups, temp, conds[field])[0]
+  metrics[['Conditions', 'Temps']] = metrics[['Conditions', 'Temps']].fillna(0)
+
+  result = {}
+  for exp_name, row in zip(metrics.index, metrics[DERIVED_COLUMNS].values.tolist()):
+    result[exp_name] = [int(row[0]), int(row[1])] + \
+      [None if value != value else round(value, 5) for value in row[2:]]
+  return result
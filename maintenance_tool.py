@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Integrity checks, repair and compaction of the STG database server's data
+
+check looks for data that does not add up across the databases and the uploaded files:
+  - conditions: slot 11 of each experiment's metadata is its number of conditions, and
+    processed data must have exactly the rows <experiment>_0 .. <experiment>_<count-1>
+  - files: slot 12 is its number of uploaded files, and the file manifest must list its
+    stored files (in its directory, or the object store), with their current size and
+    modification time
+  - owners: each experiment's user must still exist, and its key must be <user>-<exp id>
+  - orphans: processed data, manifest entries and stored files of experiments that no
+    longer exist
+Each database is read once, and each check is a single pass over it that only keeps a
+short summary per experiment, so large installs are checked quickly. Checking is safe
+while the server is running (a file being uploaded at that moment may be reported; check
+again to confirm).
+
+repair fixes what can be worked out from the data: conditions are renumbered without gaps
+and their count set, manifests are rebuilt from the directories (only new or changed
+files are hashed) and file counts set, orphaned processed data and manifest entries are
+dropped, and the binary copies (or shards) are rewritten. Uploaded files and experiments
+of removed users are never deleted, only reported.
+
+compact folds the change feed log down to its newest changes, rewrites the binary copies
+(or the shard index, with sharded storage), and removes cached previews and thumbnails
+of files that are no longer uploaded, and database files left half written by a crash.
+
+repair and compact must be run with the server stopped, since the server keeps the
+databases in memory and would overwrite the changes. The next server start records them
+in the change feed, so mirrors pick them up.
+
+Usage, from the main project directory:
+  python maintenance_tool.py check
+  python maintenance_tool.py repair
+  python maintenance_tool.py compact
+"""
+
+import os
+import sys
+import mimetypes
+import simplejson as json
+from snapshot_tool import ReadDatabaseFiles
+from binary_store import WriteBinary
+from change_feed import ChangeFeed
+from shard_store import ShardStore, WriteShards
+from blob_store import OpenStore
+
+BINARY_DATABASES = ['metadata', 'processed_data']
+
+
+def ReadDatabases(database_path):
+  texts = ReadDatabaseFiles(database_path)
+  data = dict((name, json.loads(text)) for name, text in texts.items())
+  data.setdefault('file_manifest', {})
+  return data
+
+
+def SaveDatabases(database_path, data, names):
+  # Writes databases the same way the server does: replaced in one step, with binary copies,
+  # or as shards with sharded storage
+  shard_path = os.path.join(database_path, 'shards')
+  if os.path.isdir(shard_path):
+    WriteShards(shard_path, data['metadata'], data['processed_data'])
+    names = [name for name in names if name not in BINARY_DATABASES]
+  for name in names:
+    path = os.path.join(database_path, name+'.json')
+    with open(path+'.tmp', 'w') as outfile:
+      json.dump(data[name], outfile)
+    os.rename(path+'.tmp', path)
+    if name in BINARY_DATABASES:
+      WriteBinary(data[name], os.path.join(database_path, name+'.bin'), path)
+
+
+def CheckConditions(metadata, proc_data, repair=False):
+  # Returns the problems found with condition counts and rows, fixing them with repair
+  problems = []
+  found = {}  # experiment: [(condition number, key)]
+  for key in proc_data:
+    exp_name, _, condnum = key.rpartition('_')
+    if exp_name and condnum.isdigit():
+      found.setdefault(exp_name, []).append((int(condnum), key))
+    else:
+      problems.append('processed data row %s has no condition number' % key)
+  for exp_name, row in metadata.items():
+    conditions = sorted(found.pop(exp_name, []))
+    if [condnum for condnum, key in conditions] == list(range(row[11])) and \
+        all(key == exp_name+'_'+str(condnum) for condnum, key in conditions):
+      continue
+    problems.append('%s: metadata has %s conditions, processed data has rows for %s' % (
+      exp_name, row[11], ', '.join(str(condnum) for condnum, key in conditions) or 'none'))
+    if repair:
+      rows = [proc_data.pop(key) for condnum, key in conditions]
+      for condnum, cond in enumerate(rows):
+        proc_data[exp_name+'_'+str(condnum)] = cond
+      row[11] = len(rows)
+  for exp_name, conditions in sorted(found.items()):
+    problems.append('%s: %d processed data rows, but there is no such experiment' % (
+      exp_name, len(conditions)))
+    if repair:
+      for condnum, key in conditions:
+        del proc_data[key]
+  return problems
+
+
+def CheckFiles(metadata, file_manifest, blobs, repair=False):
+  # Returns the problems found with file manifests and counts, fixing them with repair.
+  # blobs is the file store, see blob_store.py
+  problems = []
+  stored = blobs.list_all()
+  for exp_name in sorted(set(stored) - set(metadata)):
+    problems.append('%s: stored files, but there is no such experiment' % exp_name)
+  for exp_name in sorted(set(file_manifest) - set(metadata)):
+    problems.append('%s: file manifest, but there is no such experiment' % exp_name)
+    if repair:
+      del file_manifest[exp_name]
+  for exp_name, row in metadata.items():
+    known = dict((entry[0], entry) for entry in file_manifest.get(exp_name, []))
+    entries = []
+    changed = []
+    for name, size, mtime in stored.get(exp_name, []):
+      entry = known.pop(name, None)
+      if entry is None or entry[1] != size or entry[2] != mtime:
+        changed.append(name)
+        if repair:
+          entry = [name, size, mtime, blobs.sha256(exp_name, name),
+            mimetypes.guess_type(name)[0] or 'application/octet-stream']
+      entries.append(entry)
+    if changed:
+      problems.append('%s: not in the manifest, or changed since: %s' % (
+        exp_name, ', '.join(sorted(changed))))
+    if known:
+      problems.append('%s: in the manifest, but missing: %s' % (
+        exp_name, ', '.join(sorted(known))))
+    if row[12] != len(entries):
+      problems.append('%s: metadata has %s files, store has %d' % (
+        exp_name, row[12], len(entries)))
+    if repair and (changed or known or row[12] != len(entries)):
+      entries.sort(key=lambda entry: entry[0])
+      if entries or exp_name in file_manifest:
+        file_manifest[exp_name] = entries
+      row[12] = len(entries)
+  return problems
+
+
+def CheckOwners(metadata, user_database):
+  # Returns experiments whose user no longer exists, or whose key does not match
+  problems = []
+  for exp_name, row in sorted(metadata.items()):
+    if row[0] not in user_database:
+      problems.append('%s: user %s no longer exists' % (exp_name, row[0]))
+    if exp_name != row[0]+'-'+row[1]:
+      problems.append('%s: key does not match user %s and experiment ID %s' % (
+        exp_name, row[0], row[1]))
+  return problems
+
+
+def Check(database_path, blobs, repair=False):
+  # Runs all checks, and with repair saves the fixes. Returns the problems found
+  data = ReadDatabases(database_path)
+  metadata = data['metadata']
+  problems = CheckConditions(metadata, data['processed_data'], repair)
+  problems += CheckFiles(metadata, data['file_manifest'], blobs, repair)
+  problems += CheckOwners(metadata, data['user_database'])
+  if repair and problems:
+    SaveDatabases(database_path, data, ['metadata', 'processed_data', 'file_manifest'])
+  return problems
+
+
+def Compact(database_path, cache_paths, feed_kept):
+  """
+  Compacts the change feed, binary copies and caches. Returns what was done, as text.
+  cache_paths are the preview, thumbnail and object store copy directories, whose files
+  are named by the SHA256 of the file they show.
+  """
+  done = []
+  feed = ChangeFeed(database_path, feed_kept)
+  before = len(feed.changes)
+  feed.compact(feed_kept // 2)
+  done.append('change feed: kept %d of %d changes' % (len(feed.changes), before))
+  data = ReadDatabases(database_path)
+  if os.path.isdir(os.path.join(database_path, 'shards')):
+    store = ShardStore(os.path.join(database_path, 'shards'), 0)
+    store.load()
+    before = store.index_lines
+    store.write_index()
+    done.append('shard index: %d lines down to %d' % (before, store.index_lines))
+  else:
+    for name in BINARY_DATABASES:
+      WriteBinary(data[name], os.path.join(database_path, name+'.bin'),
+        os.path.join(database_path, name+'.json'))
+    done.append('binary copies: rewritten')
+  hashes = set(entry[3] for entries in data['file_manifest'].values() for entry in entries)
+  removed = 0
+  for cache_path in cache_paths:
+    if not os.path.isdir(cache_path):
+      continue
+    for name in os.listdir(cache_path):
+      if name.endswith('.tmp') or name.split('.')[0].split('-')[0] not in hashes:
+        os.remove(os.path.join(cache_path, name))
+        removed += 1
+  done.append('caches: removed %d previews, thumbnails and copies' % removed)
+  leftovers = [name for name in os.listdir(database_path) if name.endswith('.tmp')]
+  for name in leftovers:
+    os.remove(os.path.join(database_path, name))
+  done.append('temporary files: removed %d' % len(leftovers))
+  return done
+
+
+if __name__ == '__main__':
+  with open('config.json') as json_data:
+    config = json.load(json_data)
+  blobs = OpenStore(config)
+  command = sys.argv[1] if len(sys.argv) > 1 else ''
+  ask = raw_input if sys.version_info[0] < 3 else input
+  if command == 'check':
+    problems = Check('databases', blobs)
+    for problem in problems:
+      print(problem)
+    print('%d problems found.' % len(problems) if problems else 'No problems found.')
+  elif command == 'repair':
+    print('Repair rewrites the databases. Stop the server first!')
+    if ask('Type REPAIR to continue: ') == 'REPAIR':
+      problems = Check('databases', blobs, repair=True)
+      for problem in problems:
+        print(problem)
+      remaining = Check('databases', blobs)
+      print('%d problems found, %d left to fix by hand:' % (len(problems), len(remaining)))
+      for problem in remaining:
+        print(problem)
+    else:
+      print('Did nothing.')
+  elif command == 'compact':
+    print('Compacting rewrites the change feed and removes cached files. Stop the server first!')
+    if ask('Type COMPACT to continue: ') == 'COMPACT':
+      cache_paths = [config.get('PreviewPath', 'previews/'),
+        config.get('ThumbnailPath', 'thumbnails/'), config.get('BlobCachePath', 'blob-cache/')]
+      for line in Compact('databases', cache_paths, config.get('ChangeFeedKept', 100000)):
+        print(line)
+    else:
+      print('Did nothing.')
+  else:
+    print(__doc__)
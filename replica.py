@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Client side of read-replica mode: talking to the primary server
+
+A replica (app.py started with ReplicaOf set) keeps read-only copies of the primary's
+databases and uploaded files. It starts from the primary's database snapshots and then
+follows its change feed (see change_feed.py). Uploaded files are copied when the file
+manifest says they are new or changed, checked against their SHA256, and given the
+primary's modification time, so an unchanged file is recognised from its size and
+modification time alone. A replica that shares the primary's files directory (on the
+same machine) has no file_path and copies nothing.
+"""
+
+import os
+import time
+import hashlib
+import simplejson as json
+try:
+  from urllib2 import urlopen, Request
+  from urllib import quote
+except ImportError:
+  from urllib.request import urlopen, Request
+  from urllib.parse import quote
+
+
+class Primary(object):
+  def __init__(self, url, file_path, token=''):
+    self.url = url.rstrip('/')
+    self.file_path = file_path
+    self.token = token
+
+  def open(self, path, timeout=90):
+    request = Request(self.url + path)
+    if self.token:
+      request.add_header('X-Replica-Token', self.token)
+    return urlopen(request, timeout=timeout)
+
+  def get_json(self, path, timeout=90):
+    response = self.open(path, timeout)
+    try:
+      return json.loads(response.read().decode('utf-8'))
+    finally:
+      response.close()
+
+  def snapshot(self, database):
+    # Returns (feed version, rows) of one of the primary's databases
+    data = self.get_json('/changes/snapshot/'+database)
+    return data['version'], data['rows']
+
+  def changes(self, since, wait=30, limit=1000):
+    return self.get_json('/changes?since=%d&limit=%d&wait=%d' % (since, limit, wait),
+      timeout=wait + 60)
+
+  def sync_files(self, exp_name, old_entries, new_entries):
+    """
+    Brings the local copy of an experiment's files from old_entries to new_entries
+    (file manifest rows). Files are only removed when they leave the manifest, never
+    because they are unknown.
+    """
+    folder = os.path.join(self.file_path, exp_name)
+    wanted = set(entry[0] for entry in new_entries)
+    for entry in new_entries:
+      name, size, mtime, sha = entry[:4]
+      path = os.path.join(folder, name)
+      if os.path.exists(path):
+        stat = os.stat(path)
+        # Setting a modification time can lose its last digits, hence the tolerance
+        if stat.st_size == size and abs(stat.st_mtime - mtime) < 0.001:
+          continue
+      if not os.path.isdir(folder):
+        os.makedirs(folder)
+      if self.fetch_file(exp_name, name, sha, path):
+        os.utime(path, (mtime, mtime))
+    for entry in old_entries:
+      if entry[0] not in wanted:
+        try:
+          os.remove(os.path.join(folder, entry[0]))
+        except OSError:
+          pass  # Already gone
+    if not new_entries and os.path.isdir(folder) and not os.listdir(folder):
+      os.rmdir(folder)
+
+  def fetch_file(self, exp_name, name, sha, path):
+    # Copies a file from the primary. Returns False if the primary's file no longer
+    # matches sha, because it has changed since; a later manifest change brings it
+    response = self.open('/experiments/%s/files/%s' % (quote(exp_name), quote(name)))
+    digest = hashlib.sha256()
+    try:
+      with open(path+'.replica-tmp', 'wb') as outfile:
+        for chunk in iter(lambda: response.read(1 << 20), b''):
+          digest.update(chunk)
+          outfile.write(chunk)
+    finally:
+      response.close()
+    if digest.hexdigest() != sha:
+      os.remove(path+'.replica-tmp')
+      return False
+    os.rename(path+'.replica-tmp', path)
+    return True
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Full-text search over experiments
+
+An inverted index maps each word to the experiments containing it, with a count per
+experiment, so a query only looks at the experiments that contain its words instead of
+scanning metadata and files. Experiments are added, replaced and removed one at a time
+as they change.
+
+Each experiment is indexed from named text fields. Words in the experiment ID,
+experimenter and lab count more than words in the notes and READ_ME text. Results
+contain every query word (a trailing * matches any word starting with the text before
+it) and are ranked by BM25, which favours words that are rare across experiments and
+frequent in the experiment, relative to how much text it has.
+"""
+
+import re
+import math
+import bisect
+import threading
+
+FIELD_WEIGHTS = {'id': 3.0, 'experimenter': 3.0, 'lab': 3.0, 'notes': 1.0, 'readme': 1.0}
+WORD = re.compile(r'\w+', re.UNICODE)
+K1 = 1.2
+B = 0.75
+
+
+def Words(text):
+  return WORD.findall(text.lower()) if text else []
+
+
+class SearchIndex(object):
+  """
+  Inverted index of experiments. update() and remove() keep it current; search() is
+  safe to call from any thread at the same time.
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.postings = {}  # word: {experiment: weighted count}
+    self.vocabulary = []  # Sorted words, for prefix queries
+    self.lengths = {}  # experiment: weighted word count
+    self.texts = {}  # experiment: {field: text}, for result snippets
+    self.total_length = 0.0
+
+  def update(self, name, fields):
+    # Indexes (or re-indexes) an experiment from {field: text}
+    counts = {}
+    for field, text in fields.items():
+      weight = FIELD_WEIGHTS.get(field, 1.0)
+      for word in Words(text):
+        counts[word] = counts.get(word, 0.0) + weight
+    with self.lock:
+      self._remove(name)
+      for word, count in counts.items():
+        if word not in self.postings:
+          self.postings[word] = {}
+          bisect.insort(self.vocabulary, word)
+        self.postings[word][name] = count
+      self.lengths[name] = sum(counts.values())
+      self.total_length += self.lengths[name]
+      self.texts[name] = dict(fields)
+
+  def remove(self, name):
+    with self.lock:
+      self._remove(name)
+
+  def _remove(self, name):
+    if name not in self.lengths:
+      return
+    fields = self.texts.pop(name)
+    words = set(word for text in fields.values() for word in Words(text))
+    for word in words:
+      posting = self.postings.get(word)
+      if posting is None:
+        continue
+      posting.pop(name, None)
+      if not posting:
+        del self.postings[word]
+        self.vocabulary.pop(bisect.bisect_left(self.vocabulary, word))
+    self.total_length -= self.lengths.pop(name)
+
+  def _matches(self, term):
+    # {experiment: weighted count} for a query word, merging words for a prefix*
+    if not term.endswith('*'):
+      return self.postings.get(term, {})
+    prefix = term.rstrip('*')
+    merged = {}
+    start = bisect.bisect_left(self.vocabulary, prefix)
+    for word in self.vocabulary[start:]:
+      if not word.startswith(prefix):
+        break
+      for name, count in self.postings[word].items():
+        merged[name] = merged.get(name, 0.0) + count
+    return merged
+
+  def search(self, query, offset=0, limit=20):
+    """
+    Returns (total matches, [(experiment, score, snippet)]) for one page of results,
+    best first.
+    """
+    terms = [word + ('*' if star else '') for word, star in
+      re.findall(r'(\w+)(\*?)', query.lower(), re.UNICODE)]
+    if not terms:
+      return 0, []
+    with self.lock:
+      matches = [self._matches(term) for term in terms]
+      names = set(min(matches, key=len))
+      for match in matches:
+        names.intersection_update(match)
+      count = len(self.lengths)
+      average = self.total_length / count if count else 1.0
+      scores = []
+      for name in names:
+        norm = K1*(1 - B + B*self.lengths[name]/average)
+        score = 0.0
+        for match in matches:
+          idf = math.log(1 + (count - len(match) + 0.5)/(len(match) + 0.5))
+          score += idf * match[name]*(K1 + 1)/(match[name] + norm)
+        scores.append((-score, name))
+      scores.sort()
+      page = [(name, round(-score, 4), self._snippet(name, terms))
+        for score, name in scores[offset:offset+limit]]
+    return len(scores), page
+
+  def _snippet(self, name, terms, width=160):
+    # Text around the first query word found in the notes or READ_ME
+    for field in ('notes', 'readme'):
+      text = self.texts[name].get(field) or ''
+      lowered = text.lower()
+      for term in terms:
+        found = re.search(r'\b' + re.escape(term.rstrip('*')), lowered, re.UNICODE)
+        if found:
+          start = max(0, found.start() - width//3)
+          return ('...' if start else '') + text[start:start+width] + \
+            ('...' if start + width < len(text) else '')
+    return (self.texts[name].get('notes') or '')[:width]
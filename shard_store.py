@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+Per-experiment storage of metadata and processed data (ShardedStorage in config.json)
+
+Each experiment's metadata row and all its conditions' processed data rows are kept in a
+small shard file, shards/<experiment>.json, so saving a change to one experiment rewrites
+only its shard. The index, shards/index.jsonl, lists every experiment with its metadata
+row and condition keys. It is a log: each save appends one line per changed experiment
+([experiment, metadata row or null, [condition keys]]), and the log is rewritten in full
+once it is more than twice as long as it needs to be.
+
+Metadata (one short row per experiment, needed for every listing) is held in memory from
+the index. Processed data is read from the shards as it is used, and only the recently
+used experiments are kept, up to a memory budget; the index is enough to tell which
+conditions exist. Condition rows must be assigned (proc_data[key] = row), not changed in
+place, so the experiment is known to need saving; until it is saved it stays in memory.
+"""
+
+import os
+import threading
+import simplejson as json
+from collections import OrderedDict
+from change_feed import RowDigest
+try:
+  from collections.abc import MutableMapping
+except ImportError:  # Python 2
+  from collections import MutableMapping
+
+
+def ExperimentOf(key):
+  # 'user-exp_3' -> 'user-exp'
+  return key.rsplit('_', 1)[0]
+
+
+class TrackedDict(dict):
+  # dict that remembers which keys were assigned or removed since take_dirty()
+  def __init__(self):
+    dict.__init__(self)
+    self.dirty = set()
+
+  def __setitem__(self, key, value):
+    self.dirty.add(key)
+    dict.__setitem__(self, key, value)
+
+  def __delitem__(self, key):
+    self.dirty.add(key)
+    dict.__delitem__(self, key)
+
+  def pop(self, key, *default):
+    self.dirty.add(key)
+    return dict.pop(self, key, *default)
+
+  def setdefault(self, key, value=None):
+    if key not in self:
+      self[key] = value
+    return self[key]
+
+  def update(self, *args, **kwargs):
+    for key, value in dict(*args, **kwargs).items():
+      self[key] = value
+
+  def clear(self):
+    self.dirty.update(self)
+    dict.clear(self)
+
+  def popitem(self):
+    key, value = dict.popitem(self)
+    self.dirty.add(key)
+    return key, value
+
+  def take_dirty(self):
+    dirty, self.dirty = self.dirty, set()
+    return dirty
+
+
+class ShardedConditions(MutableMapping):
+  """
+  Processed data rows by condition key, read from the shards through an LRU cache of
+  experiments. Safe to read from several threads; writes are made under the server's
+  database lock.
+  """
+  def __init__(self, store, max_bytes):
+    self.store = store
+    self.max_bytes = max_bytes
+    self.lock = threading.RLock()
+    self.index = {}  # experiment: set of condition keys
+    self.cache = OrderedDict()  # experiment: {key: row}, least recently used first
+    self.sizes = {}  # experiment: bytes of its shard, as the cache's size measure
+    self.cached_bytes = 0
+    self.dirty = set()  # Condition keys changed since take_dirty()
+    self.pinned = set()  # Experiments with unsaved changes, never evicted
+
+  def rows(self, exp_name):
+    # {key: row} of an experiment's conditions, loading its shard if need be
+    with self.lock:
+      rows = self.cache.pop(exp_name, None)
+      if rows is None:
+        rows = {}
+        size = 0
+        if self.index.get(exp_name):
+          shard = self.store.read_shard(exp_name)
+          rows = shard['conditions']
+          size = shard['size']
+        self.sizes[exp_name] = size
+        self.cached_bytes += size
+      self.cache[exp_name] = rows  # Now the most recently used
+      self.evict()
+      return rows
+
+  def evict(self):
+    with self.lock:
+      for exp_name in list(self.cache):
+        if self.cached_bytes <= self.max_bytes or len(self.cache) <= 1:
+          break
+        if exp_name not in self.pinned:
+          del self.cache[exp_name]
+          self.cached_bytes -= self.sizes.pop(exp_name)
+
+  def resize(self, exp_name, size):
+    # Records the size of a cached experiment's shard as just written, so experiments
+    # created or grown since they were read are measured too
+    with self.lock:
+      if exp_name in self.cache:
+        self.cached_bytes += size - self.sizes.get(exp_name, 0)
+        self.sizes[exp_name] = size
+
+  def unpin(self, exp_names):
+    with self.lock:
+      self.pinned.difference_update(exp_names)
+      self.evict()
+
+  def take_dirty(self):
+    with self.lock:
+      dirty, self.dirty = self.dirty, set()
+      return dirty
+
+  def __getitem__(self, key):
+    exp_name = ExperimentOf(key)
+    with self.lock:
+      if key not in self.index.get(exp_name, ()):
+        raise KeyError(key)
+      return self.rows(exp_name)[key]
+
+  def __setitem__(self, key, row):
+    exp_name = ExperimentOf(key)
+    with self.lock:
+      self.rows(exp_name)[key] = row
+      self.index.setdefault(exp_name, set()).add(key)
+      self.dirty.add(key)
+      self.pinned.add(exp_name)
+
+  def __delitem__(self, key):
+    exp_name = ExperimentOf(key)
+    with self.lock:
+      if key not in self.index.get(exp_name, ()):
+        raise KeyError(key)
+      del self.rows(exp_name)[key]
+      self.index[exp_name].discard(key)
+      self.dirty.add(key)
+      self.pinned.add(exp_name)
+
+  def __contains__(self, key):
+    try:
+      return key in self.index.get(ExperimentOf(key), ())
+    except AttributeError:  # Not a string, so not a key
+      return False
+
+  def __iter__(self):
+    # Grouped by experiment, so each shard is read once
+    with self.lock:
+      keys = [sorted(keys) for keys in self.index.values()]
+    for group in keys:
+      for key in group:
+        yield key
+
+  def __len__(self):
+    with self.lock:
+      return sum(len(keys) for keys in self.index.values())
+
+
+class ShardStore(object):
+  def __init__(self, path, max_bytes):
+    self.path = path
+    self.index_path = os.path.join(path, 'index.jsonl')
+    self.new = not os.path.exists(self.index_path)
+    self.metadata = TrackedDict()
+    self.conditions = ShardedConditions(self, max_bytes)
+    self.digests = {}  # experiment: digest of its saved metadata row
+    self.index_lines = 0
+
+  def shard_path(self, exp_name):
+    return os.path.join(self.path, exp_name+'.json')
+
+  def read_shard(self, exp_name):
+    with open(self.shard_path(exp_name), 'rb') as infile:
+      text = infile.read()
+    shard = json.loads(text.decode('utf-8'))
+    shard['size'] = len(text)
+    return shard
+
+  def load(self):
+    # Reads the index. Metadata is held from it; processed data is read as it is used
+    index = {}
+    with open(self.index_path) as infile:
+      for line in infile:
+        try:
+          exp_name, row, keys = json.loads(line)
+        except ValueError:
+          break  # Last line cut short by a crash
+        index[exp_name] = (row, keys)
+        self.index_lines += 1
+    for exp_name, (row, keys) in index.items():
+      if row is not None:
+        dict.__setitem__(self.metadata, exp_name, row)
+        self.digests[exp_name] = RowDigest(row)
+      if keys:
+        self.conditions.index[exp_name] = set(keys)
+
+  def changed_metadata(self):
+    # Experiments whose metadata differs from what was last saved, for rows changed in place
+    changed = set(exp_name for exp_name, row in self.metadata.items()
+      if self.digests.get(exp_name) != RowDigest(row))
+    return changed | (set(self.digests) - set(self.metadata))
+
+  def save(self, exp_names):
+    # Writes the shards of experiments and appends their index lines
+    lines = []
+    for exp_name in sorted(exp_names):
+      row = self.metadata.get(exp_name)
+      rows = self.conditions.rows(exp_name) if self.conditions.index.get(exp_name) else {}
+      if row is None and not rows:
+        if os.path.exists(self.shard_path(exp_name)):
+          os.remove(self.shard_path(exp_name))
+        self.conditions.index.pop(exp_name, None)
+        self.conditions.resize(exp_name, 0)
+        self.digests.pop(exp_name, None)
+      else:
+        WriteShard(self.shard_path(exp_name), row, rows)
+        self.conditions.resize(exp_name, os.path.getsize(self.shard_path(exp_name)))
+        self.digests[exp_name] = RowDigest(row)
+      lines.append(json.dumps([exp_name, row, sorted(rows)]))
+    with open(self.index_path, 'a') as outfile:
+      outfile.write(''.join(line+'\n' for line in lines))
+    self.index_lines += len(lines)
+    self.conditions.unpin(exp_names)
+    if self.index_lines > 2*len(self.digests) + 1000:
+      self.write_index()
+
+  def write_index(self):
+    # Rewrites the index with one line per experiment
+    exp_names = set(self.metadata) | set(self.conditions.index)
+    with open(self.index_path+'.tmp', 'w') as outfile:
+      for exp_name in sorted(exp_names):
+        outfile.write(json.dumps([exp_name, self.metadata.get(exp_name),
+          sorted(self.conditions.index.get(exp_name, ()))])+'\n')
+    os.rename(self.index_path+'.tmp', self.index_path)
+    self.index_lines = len(exp_names)
+
+
+def WriteShard(path, row, rows):
+  with open(path+'.tmp', 'w') as outfile:
+    json.dump({'metadata': row, 'conditions': rows}, outfile)
+  os.rename(path+'.tmp', path)
+
+
+def ReadShards(path):
+  # Returns (metadata, processed data) as plain dicts, from the shards alone
+  metadata = {}
+  proc_data = {}
+  for name in os.listdir(path):
+    if name.endswith('.json'):
+      with open(os.path.join(path, name)) as infile:
+        shard = json.load(infile)
+      if shard['metadata'] is not None:
+        metadata[name[:-len('.json')]] = shard['metadata']
+      proc_data.update(shard['conditions'])
+  return metadata, proc_data
+
+
+def WriteShards(path, metadata, proc_data):
+  # Replaces all shards and the index with the given metadata and processed data
+  if not os.path.isdir(path):
+    os.makedirs(path)
+  grouped = dict((exp_name, {}) for exp_name in metadata)
+  for key, row in proc_data.items():
+    grouped.setdefault(ExperimentOf(key), {})[key] = row
+  for exp_name, rows in grouped.items():
+    WriteShard(os.path.join(path, exp_name+'.json'), metadata.get(exp_name), rows)
+  for name in os.listdir(path):
+    if name.endswith('.json') and name[:-len('.json')] not in grouped:
+      os.remove(os.path.join(path, name))
+  store = ShardStore(path, 0)
+  store.metadata.update(metadata)
+  for exp_name, rows in grouped.items():
+    if rows:
+      store.conditions.index[exp_name] = set(rows)
+  store.write_index()
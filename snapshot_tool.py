@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Point-in-time snapshots of the STG database server's data
+
+A snapshot is a directory under the snapshot path (snapshots/ by default) holding a copy
+of the json databases, a copy of the uploaded files listed in their file manifest, and
+snapshot.json listing every file with its size, modification time and SHA256 hash.
+Uploaded files that are unchanged since the previous snapshot are hard links to that
+snapshot's copy, so each snapshot only stores (and copies) new or changed files.
+
+Snapshots can be taken while the server is running, from the Admin page or from the
+command line. Restoring must be done with the server stopped, since the server keeps the
+databases in memory and would overwrite the restored files.
+
+Usage, from the main project directory:
+  python snapshot_tool.py take
+  python snapshot_tool.py list
+  python snapshot_tool.py verify <snapshot name>
+  python snapshot_tool.py restore <snapshot name>
+"""
+
+import os
+import sys
+import time
+import shutil
+import simplejson as json
+from blob_store import OpenStore, FileHash
+
+DATABASES = ['user_database', 'user_pdatabase', 'metadata', 'processed_data',
+  'file_manifest']
+
+
+def ListSnapshots(snapshot_path):
+  # Completed snapshots, oldest first. Names sort by time taken
+  if not os.path.isdir(snapshot_path):
+    return []
+  return sorted(name for name in os.listdir(snapshot_path)
+    if os.path.exists(os.path.join(snapshot_path, name, 'snapshot.json')))
+
+
+def ReadDatabaseFiles(database_path, attempts=10):
+  # Reads the json databases from disk as one consistent set while the server may be
+  # writing them. The server replaces each file atomically, so every file read is whole;
+  # the set is retried until no file changed while it was being read.
+  def signature():
+    stats = [os.stat(os.path.join(database_path, name+'.json'))
+      if os.path.exists(os.path.join(database_path, name+'.json')) else None
+      for name in DATABASES]
+    return [(stat.st_ino, stat.st_size, stat.st_mtime) if stat else None for stat in stats]
+  for _ in range(attempts):
+    before = signature()
+    texts = {}
+    for name in DATABASES:
+      if os.path.exists(os.path.join(database_path, name+'.json')):
+        with open(os.path.join(database_path, name+'.json'), 'rb') as infile:
+          texts[name] = infile.read()
+    if signature() == before:
+      break
+    time.sleep(0.1)
+  else:
+    raise RuntimeError('Databases kept changing while being read, try again')
+  if os.path.isdir(os.path.join(database_path, 'shards')):
+    # Sharded storage (see shard_store.py): the json files of these are out of date. Each
+    # shard is replaced in one step, so every experiment read is whole
+    from shard_store import ReadShards
+    metadata, proc_data = ReadShards(os.path.join(database_path, 'shards'))
+    texts['metadata'] = json.dumps(metadata)
+    texts['processed_data'] = json.dumps(proc_data)
+  return texts
+
+
+def TakeSnapshot(snapshot_path, database_path, file_path, database_texts=None):
+  """
+  Takes a snapshot and returns its name.
+
+  database_texts maps database name to its serialized json. The server passes these
+  from memory so they are consistent with each other; otherwise they are read from disk.
+  file_path None leaves out the uploaded files, for files kept in an object store.
+  """
+  if database_texts is None:
+    database_texts = ReadDatabaseFiles(database_path)
+  name = time.strftime('%Y%m%d-%H%M%S')
+  previous = ListSnapshots(snapshot_path)
+  if previous and previous[-1] >= name:
+    name = previous[-1]+'-1'
+  partial = os.path.join(snapshot_path, name+'.partial')
+  if os.path.exists(partial):
+    shutil.rmtree(partial)
+  os.makedirs(os.path.join(partial, 'databases'))
+  for db_name, text in database_texts.items():
+    if not isinstance(text, bytes):
+      text = text.encode('utf-8')
+    with open(os.path.join(partial, 'databases', db_name+'.json'), 'wb') as outfile:
+      outfile.write(text)
+
+  # The files are those the snapshot's file manifest lists, so a file still being
+  # uploaded is left out rather than copied half written. Files unchanged since the last
+  # snapshot (same SHA256) are hard linked
+  manifest = {}
+  if file_path is not None and 'file_manifest' in database_texts:
+    manifest = json.loads(database_texts['file_manifest'])
+  base_files = {}
+  if previous:
+    with open(os.path.join(snapshot_path, previous[-1], 'snapshot.json')) as infile:
+      base_files = json.load(infile)['files']
+  files = {}
+  linked = 0
+  for exp_name, entries in manifest.items():
+    for entry in entries:
+      relpath = os.path.join(exp_name, entry[0])
+      target = os.path.join(partial, 'files', relpath)
+      if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+      base = base_files.get(relpath)
+      base_copy = os.path.join(snapshot_path, previous[-1], 'files', relpath) if base else None
+      if base is not None and base[2] == entry[3] and os.path.exists(base_copy):
+        os.link(base_copy, target)
+        files[relpath] = base
+        linked += 1
+      else:
+        try:
+          files[relpath] = CopyListedFile(os.path.join(file_path, relpath), target, entry)
+        except (IOError, OSError):
+          pass  # Deleted since the manifest was saved
+  databases = dict((db_name, FileHash(os.path.join(partial, 'databases', db_name+'.json')))
+    for db_name in database_texts)
+  with open(os.path.join(partial, 'snapshot.json'), 'w') as outfile:
+    json.dump({'name': name, 'created': time.time(), 'databases': databases,
+      'files': files, 'linked': linked}, outfile)
+  os.rename(partial, os.path.join(snapshot_path, name))
+  return name
+
+
+def CopyListedFile(source, target, entry, attempts=5):
+  """
+  Copies a file listed in the file manifest as entry, and returns its [size, mtime,
+  SHA256] for snapshot.json. A copy that does not match the listed hash may have caught
+  the file being rewritten, so it is copied again a few times; a file that has changed
+  for good is kept as found, with its own size and hash.
+  """
+  for attempt in range(attempts):
+    shutil.copy2(source, target)
+    sha = FileHash(target)
+    if sha == entry[3]:
+      return [entry[1], entry[2], sha]
+    time.sleep(0.2)
+  stat = os.stat(target)
+  return [stat.st_size, stat.st_mtime, sha]
+
+
+def VerifySnapshot(snapshot_dir):
+  # Returns a list of problems found (empty if the snapshot is intact)
+  problems = []
+  with open(os.path.join(snapshot_dir, 'snapshot.json')) as infile:
+    info = json.load(infile)
+  for db_name, sha in info['databases'].items():
+    path = os.path.join(snapshot_dir, 'databases', db_name+'.json')
+    if not os.path.exists(path) or FileHash(path) != sha:
+      problems.append('database '+db_name+' is missing or damaged')
+  for relpath, (size, mtime, sha) in info['files'].items():
+    path = os.path.join(snapshot_dir, 'files', relpath)
+    if not os.path.exists(path) or FileHash(path) != sha:
+      problems.append('file '+relpath+' is missing or damaged')
+  return problems
+
+
+def RestoreSnapshot(snapshot_dir, database_path, file_path):
+  # Replaces the databases and uploaded files with the snapshot's. Server must be stopped.
+  # file_path None restores the databases only, for files kept in an object store
+  problems = VerifySnapshot(snapshot_dir)
+  if problems:
+    raise RuntimeError('Snapshot failed verification: '+'; '.join(problems))
+  with open(os.path.join(snapshot_dir, 'snapshot.json')) as infile:
+    info = json.load(infile)
+  # The files tree is rebuilt beside the live one and swapped in, so a failed restore
+  # leaves the live files alone
+  if file_path is not None:
+    file_path = file_path.rstrip('/')
+    restoring = file_path+'.restoring'
+    if os.path.exists(restoring):
+      shutil.rmtree(restoring)
+    os.makedirs(restoring)
+    for relpath in info['files']:
+      target = os.path.join(restoring, relpath)
+      if not os.path.isdir(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+      shutil.copy2(os.path.join(snapshot_dir, 'files', relpath), target)
+  for db_name in info['databases']:
+    shutil.copy2(os.path.join(snapshot_dir, 'databases', db_name+'.json'),
+      os.path.join(database_path, db_name+'.json.tmp'))
+    os.rename(os.path.join(database_path, db_name+'.json.tmp'),
+      os.path.join(database_path, db_name+'.json'))
+  if os.path.isdir(os.path.join(database_path, 'shards')):
+    # Sharded storage is rebuilt from the restored json files at the next start
+    shutil.rmtree(os.path.join(database_path, 'shards'))
+  if file_path is not None:
+    if os.path.exists(file_path):
+      os.rename(file_path, file_path+'.replaced')
+    os.rename(restoring, file_path)
+    if os.path.exists(file_path+'.replaced'):
+      shutil.rmtree(file_path+'.replaced')
+
+
+if __name__ == '__main__':
+  with open('config.json') as json_data:
+    config = json.load(json_data)
+  snapshot_path = config.get('SnapshotPath', 'snapshots/')
+  file_path = OpenStore(config).file_path  # None for files in an object store
+  command = sys.argv[1] if len(sys.argv) > 1 else ''
+  if command == 'take':
+    print('Took snapshot '+TakeSnapshot(snapshot_path, 'databases', file_path))
+  elif command == 'list':
+    for name in ListSnapshots(snapshot_path):
+      print(name)
+  elif command == 'verify' and len(sys.argv) > 2:
+    problems = VerifySnapshot(os.path.join(snapshot_path, sys.argv[2]))
+    for problem in problems:
+      print(problem)
+    print('Snapshot is damaged.' if problems else 'Snapshot is intact.')
+  elif command == 'restore' and len(sys.argv) > 2:
+    print('Restoring replaces all databases and uploaded files. Stop the server first!')
+    ask = raw_input if sys.version_info[0] < 3 else input
+    if ask('Type RESTORE to continue: ') == 'RESTORE':
+      RestoreSnapshot(os.path.join(snapshot_path, sys.argv[2]), 'databases', file_path)
+      print('Restored snapshot '+sys.argv[2]+'.')
+    else:
+      print('Did nothing.')
+  else:
+    print(__doc__)
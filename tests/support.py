@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Shared helpers for the tests. Run the tests from the main project directory with
+  python -m unittest discover tests
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO not in sys.path:
+  sys.path.insert(0, REPO)
+
+
+class TempDirTestCase(unittest.TestCase):
+  # Gives each test an empty directory, self.tmp, removed afterwards
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp(prefix='stg-test-')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp, ignore_errors=True)
+
+  def path(self, *parts):
+    return os.path.join(self.tmp, *parts)
+
+  def write(self, data, *parts):
+    path = self.path(*parts)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as outfile:
+      outfile.write(data)
+    return path
+
+  def read(self, *parts):
+    with open(self.path(*parts), 'rb') as infile:
+      return infile.read()
+
+
+_app = []
+
+def LoadApp():
+  """
+  Imports app.py once per test run, working in a temporary directory holding a copy of
+  the databases, files and config.json, so the project's own data is left alone.
+  """
+  if _app:
+    return _app[0]
+  import atexit
+  workdir = tempfile.mkdtemp(prefix='stg-app-')
+  atexit.register(shutil.rmtree, workdir, True)
+  shutil.copy(os.path.join(REPO, 'config.json'), workdir)
+  shutil.copytree(os.path.join(REPO, 'databases'), os.path.join(workdir, 'databases'),
+    ignore=shutil.ignore_patterns('*.bin', 'change_feed*', 'shards'))
+  shutil.copytree(os.path.join(REPO, 'files'), os.path.join(workdir, 'files'))
+  os.chdir(workdir)
+  import app
+  app.app.config['SECRET_KEY'] = 'test'
+  app.app.config['TESTING'] = True
+  app.databases_loaded.wait()
+  _app.append(app)
+  return app
+
+
+def LogIn(client, username='Admin', password='test-password'):
+  # Signs the test client in, setting the user's password first
+  import hashlib
+  app = LoadApp()
+  app.user_pdatabase[username] = hashlib.sha256(password.encode('utf-8')).hexdigest()
+  return client.post('/login', data={'username': username, 'password': password})
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+LocalStore tests always run. S3Store tests run against an S3-compatible server given by
+the S3_TEST_ENDPOINT environment variable (such as a local MinIO or moto server, e.g.
+http://127.0.0.1:9000), with keys from S3_TEST_ACCESS_KEY and S3_TEST_SECRET_KEY; each
+run makes and empties a bucket of its own. Without one they are skipped.
+"""
+import os
+import uuid
+import hashlib
+import unittest
+from io import BytesIO
+from support import TempDirTestCase, LoadApp
+from blob_store import LocalStore, S3Store, StorageError
+
+S3_ENDPOINT = os.environ.get('S3_TEST_ENDPOINT', '')
+
+
+def Data(size):
+  # Bytes that differ from one position to the next, so a misplaced range shows
+  return bytes(bytearray(n*7 % 251 for n in range(size)))
+
+
+class LocalStoreTest(TempDirTestCase):
+  def setUp(self):
+    TempDirTestCase.setUp(self)
+    self.store = LocalStore(self.path('files'))
+    self.data = Data(200000)
+    self.store.save('lab-1', 'trace.abf', BytesIO(self.data))
+    self.store.save('lab-1', 'READ_ME.txt', BytesIO(b'read me'))
+
+  def test_save_list_and_hash(self):
+    self.assertEqual(self.read('files', 'lab-1', 'trace.abf'), self.data)
+    self.assertEqual(sorted(entry[:2] for entry in self.store.list('lab-1')),
+      [('READ_ME.txt', 7), ('trace.abf', 200000)])
+    self.assertEqual(list(self.store.list_all()), ['lab-1'])
+    self.assertEqual(self.store.list('lab-missing'), [])
+    self.assertEqual(self.store.stat('lab-1', 'trace.abf')[0], 200000)
+    self.assertEqual(self.store.sha256('lab-1', 'trace.abf'),
+      hashlib.sha256(self.data).hexdigest())
+    self.assertTrue(self.store.exists('lab-1', 'trace.abf'))
+    self.assertFalse(self.store.exists('lab-1', 'other.abf'))
+
+  def test_stream_a_range(self):
+    self.assertEqual(self.store.read('lab-1', 'trace.abf', 70000, 150001),
+      self.data[70000:150001])
+    self.assertEqual(self.store.read('lab-1', 'trace.abf', 199990), self.data[199990:])
+    self.assertEqual(self.store.read('lab-1', 'trace.abf', 5, 5), b'')
+    self.assertRaises(IOError, self.store.stream, 'lab-1', 'missing.abf')
+
+  def test_fetch_is_the_file_itself(self):
+    path = self.store.fetch('lab-1', 'trace.abf', hashlib.sha256(self.data).hexdigest())
+    self.assertEqual(path, self.path('files', 'lab-1', 'trace.abf'))
+
+  def test_remove(self):
+    self.store.remove('lab-1', 'READ_ME.txt')
+    self.assertEqual([entry[0] for entry in self.store.list('lab-1')], ['trace.abf'])
+    self.store.remove_all('lab-1')
+    self.assertFalse(os.path.exists(self.path('files', 'lab-1')))
+    self.assertEqual(self.store.list_all(), {})
+    self.store.remove_all('lab-1')  # Nothing left is not an error
+
+
+@unittest.skipIf(not S3_ENDPOINT, 'set S3_TEST_ENDPOINT to test against an S3 server')
+class S3StoreTest(TempDirTestCase):
+  def setUp(self):
+    TempDirTestCase.setUp(self)
+    self.store = S3Store(S3_ENDPOINT, 'stg-test-'+uuid.uuid4().hex[:12], 'files/', 'us-east-1',
+      os.environ.get('S3_TEST_ACCESS_KEY', 'testing'),
+      os.environ.get('S3_TEST_SECRET_KEY', 'testing'), part_size=5 * 2**20,
+      cache_path=self.path('cache'), cache_bytes=2**20, timeout=30)
+    try:
+      self.store.request('PUT').close()  # Creates the bucket
+    except StorageError as e:
+      if e.status is None:
+        self.skipTest('no S3 server at %s: %s' % (S3_ENDPOINT, e))
+      raise
+    self.data = Data(12 * 2**20 + 1000)  # Three parts
+    self.sha = hashlib.sha256(self.data).hexdigest()
+    self.store.save('lab-1', 'trace.abf', BytesIO(self.data))
+    self.store.save('lab-1', 'READ_ME.txt', BytesIO(b'read me'))
+
+  def tearDown(self):
+    for exp_name in self.store.list_all():
+      self.store.remove_all(exp_name)
+    self.store.request('DELETE').close()
+    TempDirTestCase.tearDown(self)
+
+  def test_multipart_upload(self):
+    self.assertEqual(self.store.read('lab-1', 'trace.abf'), self.data)
+    self.assertEqual(self.store.stat('lab-1', 'trace.abf')[0], len(self.data))
+    self.assertEqual(self.store.sha256('lab-1', 'trace.abf'), self.sha)
+    self.assertEqual(sorted(entry[:2] for entry in self.store.list('lab-1')),
+      [('READ_ME.txt', 7), ('trace.abf', len(self.data))])
+    self.assertEqual(list(self.store.list_all()), ['lab-1'])
+    self.assertTrue(self.store.exists('lab-1', 'READ_ME.txt'))
+    self.assertFalse(self.store.exists('lab-1', 'other.abf'))
+
+  def test_stream_a_range(self):
+    start, end = 5 * 2**20 - 10, 10 * 2**20 + 10  # Across part boundaries
+    self.assertEqual(self.store.read('lab-1', 'trace.abf', start, end), self.data[start:end])
+    self.assertEqual(self.store.read('lab-1', 'trace.abf', len(self.data) - 5),
+      self.data[-5:])
+    self.assertEqual(self.store.read('lab-1', 'trace.abf', 5, 5), b'')
+    with self.assertRaises(StorageError) as context:
+      self.store.stream('lab-1', 'missing.abf')
+    self.assertEqual(context.exception.status, 404)
+
+  def test_fetch_checks_the_hash(self):
+    path = self.store.fetch('lab-1', 'READ_ME.txt', hashlib.sha256(b'read me').hexdigest())
+    self.assertEqual(self.read('cache', os.path.basename(path)), b'read me')
+    self.assertRaises(StorageError, self.store.fetch, 'lab-1', 'trace.abf', '0'*64)
+    self.assertEqual(os.listdir(self.path('cache')), [os.path.basename(path)])
+    # Larger than the cache, but kept as the file just fetched
+    self.assertEqual(open(self.store.fetch('lab-1', 'trace.abf', self.sha), 'rb').read(),
+      self.data)
+    self.assertEqual(os.listdir(self.path('cache')), [self.sha])
+
+  def test_remove(self):
+    self.store.save('lab-2', 'other.txt', BytesIO(b'other'))
+    self.store.remove('lab-1', 'READ_ME.txt')
+    self.assertEqual([entry[0] for entry in self.store.list('lab-1')], ['trace.abf'])
+    self.store.remove_all('lab-1')
+    self.assertEqual(self.store.list('lab-1'), [])
+    self.assertEqual(list(self.store.list_all()), ['lab-2'])
+
+
+class PublicBlobTest(unittest.TestCase):
+  # Ranged downloads of an uploaded file through /experiments/<key>/files/<name>
+  def setUp(self):
+    self.app = LoadApp()
+    self.client = self.app.app.test_client()
+    self.data = Data(5000)
+    self.sha = hashlib.sha256(self.data).hexdigest()
+    self.app.blobs.save('Admin-template', 'range.abf', BytesIO(self.data))
+    self.app.UpdateManifest('Admin-template', added=['range.abf'])
+
+  def tearDown(self):
+    self.app.blobs.remove('Admin-template', 'range.abf')
+    self.app.UpdateManifest('Admin-template', removed=['range.abf'])
+
+  def get(self, **headers):
+    # Closing the response gives back its admission slot
+    response = self.client.get('/experiments/Admin-template/files/range.abf', headers=headers)
+    try:
+      return response.status_code, response.headers, response.data
+    finally:
+      response.close()
+
+  def test_whole_file(self):
+    status, headers, data = self.get()
+    self.assertEqual((status, data), (200, self.data))
+    self.assertEqual(headers['ETag'], '"%s"' % self.sha)
+    self.assertEqual(headers['Accept-Ranges'], 'bytes')
+    self.assertEqual(self.get(**{'If-None-Match': '"%s"' % self.sha})[0], 304)
+
+  def test_range(self):
+    status, headers, data = self.get(Range='bytes=100-199')
+    self.assertEqual((status, data), (206, self.data[100:200]))
+    self.assertEqual(headers['Content-Range'], 'bytes 100-199/5000')
+    status, headers, data = self.get(Range='bytes=-10')
+    self.assertEqual((status, data), (206, self.data[-10:]))
+    self.assertEqual(self.get(Range='bytes=6000-7000')[0], 200)  # Not satisfiable
+
+  def test_if_range(self):
+    status, headers, data = self.get(Range='bytes=0-9', **{'If-Range': '"%s"' % self.sha})
+    self.assertEqual((status, data), (206, self.data[:10]))
+    # A different version of the file gets all of this one
+    status, headers, data = self.get(Range='bytes=0-9', **{'If-Range': '"older"'})
+    self.assertEqual((status, data), (200, self.data))
+    status, headers, data = self.get(Range='bytes=0-9',
+      **{'If-Range': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+    self.assertEqual((status, data), (200, self.data))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import unittest
+from support import TempDirTestCase, LoadApp, LogIn
+from change_feed import ChangeFeed
+import simplejson as json
+
+
+class ChangeFeedTest(TempDirTestCase):
+  def setUp(self):
+    TempDirTestCase.setUp(self)
+    self.data = {'a_0': ['baseline', 12], 'a_1': ['warm', 15], 'b_0': ['baseline', 11]}
+    self.feed = ChangeFeed(self.tmp, 100)
+    self.feed.prime('processed_data', self.data)
+    self.feed.save_base()
+
+  def test_changes_found_by_comparing_all_rows(self):
+    self.data['a_1'] = ['warm', 16]
+    del self.data['b_0']
+    self.data['c_0'] = ['baseline', 10]
+    self.assertEqual(self.feed.record('processed_data', self.data), 1)
+    page, version, more, resync = self.feed.read(0)
+    self.assertEqual([change[2:4] for change in page],
+      [['a_1', 'update'], ['b_0', 'delete'], ['c_0', 'insert']])
+    self.assertEqual((version, more, resync), (1, False, False))
+    self.assertIsNone(self.feed.record('processed_data', self.data))
+
+  def test_keys_limit_the_comparison(self):
+    self.data['a_1'] = ['warm', 16]
+    self.data['b_0'] = ['baseline', 13]
+    self.feed.record('processed_data', self.data, ['a_1', 'missing_0'])
+    self.assertEqual([change[2] for change in self.feed.read(0)[0]], ['a_1'])
+    # b_0 is found once every row is compared
+    self.feed.record('processed_data', self.data)
+    self.assertEqual([change[2] for change in self.feed.read(1)[0]], ['b_0'])
+
+  def test_reopened_feed_has_the_same_shadows(self):
+    self.data['a_0'] = ['baseline', 14]
+    self.feed.record('processed_data', self.data, ['a_0'])
+    reopened = ChangeFeed(self.tmp, 100)
+    self.assertEqual((reopened.version, reopened.shadows), (self.feed.version, self.feed.shadows))
+    self.assertIsNone(reopened.record('processed_data', self.data))
+    self.assertTrue(self.feed.read(5)[3])  # Ahead of the feed, so told to resync
+
+
+class SavedKeysTest(unittest.TestCase):
+  # Edits pass the keys they changed, so saving does not compare every row
+  def setUp(self):
+    self.app = LoadApp()
+    self.client = self.app.app.test_client()
+    LogIn(self.client)
+    self.row = self.app.proc_data['Admin-template_0']
+    self.recorded = []
+    feed = self.app.change_feed
+    self.record = feed.record
+    def record(database, data, keys=None):
+      self.recorded.append((database, None if keys is None else sorted(keys)))
+      return self.record(database, data, keys)
+    feed.record = record
+
+  def tearDown(self):
+    del self.app.change_feed.record
+    self.app.proc_data['Admin-template_0'] = self.row
+
+  def test_batch_edit_records_only_its_conditions(self):
+    response = self.client.post('/processed-data/batch', data=json.dumps({'updates':
+      [{'condition': 'Admin-template_0', 'values': {'temp': 9}}]}),
+      content_type='application/json')
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(self.recorded, [('processed_data', ['Admin-template_0'])])
+    self.assertEqual(self.app.change_feed.read(self.app.change_feed.version - 1)[0][-1][2:4],
+      ['Admin-template_0', 'update'])
+
+  def test_new_and_deleted_conditions_record_their_keys(self):
+    with self.client.session_transaction() as session:
+      session['exp_name'] = 'Admin-template'
+    response = self.client.post('/new-condition', data={'name': 'warm'})
+    self.assertEqual(response.status_code, 302)
+    self.assertEqual(self.recorded, [('metadata', ['Admin-template']),
+      ('processed_data', ['Admin-template_1'])])
+    del self.recorded[:]
+    response = self.client.post('/experiment-page', data={'identifier': 1, 'action': 'delete'})
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(self.recorded, [('metadata', ['Admin-template']),
+      ('processed_data', ['Admin-template_1'])])
+    self.assertNotIn('Admin-template_1', self.app.proc_data)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import unittest
+from support import LoadApp, LogIn
+
+
+class ExperimentPagesTest(unittest.TestCase):
+  # Experiments whose names contain one another, or regex characters
+  EXPERIMENTS = {'Admin-exp1': 1.111, 'Admin-exp10': 10.101, 'Admin-a.c': 2.222,
+    'Admin-abc': 3.333}
+
+  def setUp(self):
+    self.app = LoadApp()
+    self.client = self.app.app.test_client()
+    template = self.app.metadata['Admin-template']
+    with self.app.db_lock:
+      for exp_name, hz in self.EXPERIMENTS.items():
+        self.app.metadata[exp_name] = template[:1] + [exp_name[6:]] + template[2:11] + [2] + \
+          template[12:]
+        for condnum in range(2):
+          self.app.proc_data[exp_name+'_'+str(condnum)] = ['cond %d' % condnum, 12,
+            hz + condnum] + [None]*30
+      self.app.BumpDataVersion()
+
+  def tearDown(self):
+    with self.app.db_lock:
+      for exp_name in self.EXPERIMENTS:
+        del self.app.metadata[exp_name]
+        for condnum in range(2):
+          del self.app.proc_data[exp_name+'_'+str(condnum)]
+      self.app.BumpDataVersion()
+
+  def page(self, exp_name):
+    response = self.client.get('/experiments/'+exp_name)
+    self.assertEqual(response.status_code, 200)
+    return response.data.decode('utf-8')
+
+  def test_conditions_are_the_experiments_own(self):
+    for exp_name, hz in self.EXPERIMENTS.items():
+      html = self.page(exp_name)
+      for other, other_hz in self.EXPERIMENTS.items():
+        if other != exp_name:
+          self.assertNotIn(str(other_hz), html, (exp_name, other))
+      self.assertIn(str(hz), html)
+      self.assertTrue(html.index(str(hz)) < html.index(str(hz + 1)))
+
+  def test_old_file_download_address_redirects(self):
+    response = self.client.get('/file-download')
+    self.assertEqual(response.status_code, 302)
+    self.assertTrue(response.headers['Location'].endswith('/dl-files-page'))
+    LogIn(self.client)
+    with self.client.session_transaction() as session:
+      session['exp_name'] = 'Admin-exp1'
+    response = self.client.get('/file-download')
+    self.assertEqual(response.status_code, 302)
+    self.assertTrue(response.headers['Location'].endswith('/experiments/Admin-exp1'))
+    response = self.client.post('/file-download')
+    self.assertEqual(response.status_code, 303)
+    self.assertTrue(response.headers['Location'].endswith('/experiments/Admin-exp1/archive'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import unittest
+import simplejson as json
+from support import LoadApp
+
+
+class ExportJoinedTest(unittest.TestCase):
+  def setUp(self):
+    self.client = LoadApp().app.test_client()
+
+  def get(self, query, **headers):
+    # Closing the response gives back its admission slot
+    response = self.client.get('/export/joined?'+query, headers=headers)
+    try:
+      self.etag = response.headers.get('ETag')
+      return response.status_code, response.data
+    finally:
+      response.close()
+
+  def test_filtered_json(self):
+    status, data = self.get('columns=experiment,cond_num&where=experiment=Admin-template'
+      '&format=json')
+    self.assertEqual(status, 200)
+    self.assertEqual(json.loads(data), {'columns': ['experiment', 'cond_num'],
+      'data': [['Admin-template', 0]]})
+
+  def test_unchanged_export_is_not_built_again(self):
+    app = LoadApp()
+    status, data = self.get('columns=experiment,temp&format=json')
+    self.assertEqual(status, 200)
+    etag = self.etag
+    built = []
+    joined_rows = app.JoinedRows
+    app.JoinedRows = lambda *args: built.append(args) or joined_rows(*args)
+    try:
+      self.assertEqual(self.get('columns=experiment,temp&format=json',
+        **{'If-None-Match': etag})[0], 304)
+      self.assertEqual(built, [])
+      self.assertEqual(self.get('columns=experiment,temp', **{'If-None-Match': etag})[0], 200)
+      app.BumpDataVersion()
+      self.assertEqual(self.get('columns=experiment,temp&format=json',
+        **{'If-None-Match': etag}), (200, data))
+      self.assertNotEqual(self.etag, etag)
+      self.assertEqual(len(built), 2)
+    finally:
+      app.JoinedRows = joined_rows
+
+  def test_unreadable_filter_with_accents_is_a_400(self):
+    status, data = self.get('where=sp%C3%A9cies=x')
+    self.assertEqual(status, 400)
+    self.assertEqual(json.loads(data)['error'], u'Cannot read filter: sp\xe9cies=x')
+
+  def test_unknown_column_is_a_400(self):
+    status, data = self.get('columns=experiment,nonsense')
+    self.assertEqual(status, 400)
+    self.assertIn('nonsense', json.loads(data)['error'])
+
+
+if __name__ == '__main__':
+  unittest.main()
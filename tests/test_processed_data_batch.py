@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import unittest
+import simplejson as json
+from support import LoadApp, LogIn
+
+CONDITION = 'Admin-template_0'
+
+
+class ProcessedDataBatchTest(unittest.TestCase):
+  def setUp(self):
+    self.app = LoadApp()
+    self.client = self.app.app.test_client()
+    LogIn(self.client)
+    self.row = list(self.app.proc_data[CONDITION])
+
+  def tearDown(self):
+    self.app.proc_data[CONDITION] = self.row
+
+  def post(self, updates):
+    response = self.client.post('/processed-data/batch', data=json.dumps({'updates': updates}),
+      content_type='application/json')
+    return response.status_code, json.loads(response.data)
+
+  def test_updates_are_applied(self):
+    status, body = self.post([{'condition': CONDITION, 'values': {'temp': 11, 'pyl_hz': 0.75}}])
+    self.assertEqual((status, body['applied']), (200, 1))
+    self.assertEqual(self.app.proc_data[CONDITION][1], 11)
+    self.assertEqual(float(self.app.proc_data[CONDITION][2]), 0.75)
+
+  def test_whole_float_is_accepted_for_an_integer_field(self):
+    status, body = self.post([{'condition': CONDITION, 'values': {'temp': 12.0}}])
+    self.assertEqual(status, 200, body)
+    self.assertEqual(self.app.proc_data[CONDITION][1], 12)
+    status, body = self.post([{'condition': CONDITION, 'values': {'temp': 12.5}}])
+    self.assertEqual(status, 400)
+    self.assertIn('exp_temp', body['errors'][0]['errors'])
+
+  def test_condition_must_be_a_key(self):
+    status, body = self.post([{'condition': ['a', 'list'], 'values': {'temp': 10}},
+      {'condition': {'a': 'dict'}, 'values': {'temp': 10}},
+      {'condition': CONDITION, 'values': {'temp': 10}}])
+    self.assertEqual((status, body['applied']), (400, 0))
+    self.assertEqual([error['errors'] for error in body['errors']],
+      [{'condition': ['Must be a condition key']}]*2)
+    self.assertEqual(self.app.proc_data[CONDITION], self.row)
+
+  def test_nothing_is_applied_if_any_update_is_invalid(self):
+    status, body = self.post([{'condition': CONDITION, 'values': {'temp': 10}},
+      {'condition': 'Admin-missing_0', 'values': {'temp': 10}},
+      {'condition': CONDITION, 'values': {'no_such_field': 1}}])
+    self.assertEqual((status, body['applied']), (400, 0))
+    self.assertEqual([error['index'] for error in body['errors']], [1, 2])
+    self.assertEqual(self.app.proc_data[CONDITION], self.row)
+
+
+if __name__ == '__main__':
+  unittest.main()
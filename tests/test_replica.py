@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Starts a primary and a read replica as two server processes sharing a temporary copy of
+the databases, and checks that the replica follows the primary's changes and sends
+edits to it.
+"""
+import os
+import sys
+import time
+import shutil
+import socket
+import hashlib
+import tempfile
+import unittest
+import subprocess
+import simplejson as json
+from support import REPO
+try:
+  from httplib import HTTPConnection
+  from urllib import urlencode
+except ImportError:
+  from http.client import HTTPConnection
+  from urllib.parse import urlencode
+try:
+  import flask
+except ImportError:
+  flask = None
+
+PASSWORD = 'test-password'
+CONDITION = 'Admin-template_0'
+
+
+def FreePort():
+  sock = socket.socket()
+  sock.bind(('127.0.0.1', 0))
+  port = sock.getsockname()[1]
+  sock.close()
+  return port
+
+
+def Request(port, method, path, body=None, headers=None):
+  # Returns (status, headers, body) without following redirects
+  connection = HTTPConnection('127.0.0.1', port, timeout=30)
+  try:
+    connection.request(method, path, body, headers or {})
+    response = connection.getresponse()
+    return response.status, dict(response.getheaders()), response.read()
+  finally:
+    connection.close()
+
+
+@unittest.skipIf(flask is None, 'needs Flask to run the server')
+class ReplicaTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.tmp = tempfile.mkdtemp(prefix='stg-replica-')
+    shutil.copytree(os.path.join(REPO, 'databases'), os.path.join(cls.tmp, 'databases'),
+      ignore=shutil.ignore_patterns('*.bin', 'change_feed*', 'shards'))
+    shutil.copytree(os.path.join(REPO, 'files'), os.path.join(cls.tmp, 'files'))
+    with open(os.path.join(REPO, 'config.json')) as infile:
+      config = json.load(infile)
+    config['ReplicaToken'] = 'test-token'
+    with open(os.path.join(cls.tmp, 'config.json'), 'w') as outfile:
+      json.dump(config, outfile)
+    passwords_path = os.path.join(cls.tmp, 'databases', 'user_pdatabase.json')
+    with open(passwords_path) as infile:
+      passwords = json.load(infile)
+    passwords['Admin'] = hashlib.sha256(PASSWORD.encode('utf-8')).hexdigest()
+    with open(passwords_path, 'w') as outfile:
+      json.dump(passwords, outfile)
+    cls.primary_port, cls.replica_port = FreePort(), FreePort()
+    cls.servers = []
+    cls.start(cls.primary_port)
+    cls.wait_until_ready(cls.primary_port)
+    cls.start(cls.replica_port, REPLICA_OF='http://127.0.0.1:%d' % cls.primary_port)
+    cls.wait_until_ready(cls.replica_port)
+
+  @classmethod
+  def start(cls, port, **environ):
+    env = dict(os.environ, PORT=str(port), PYTHONDONTWRITEBYTECODE='1', **environ)
+    log = open(os.path.join(cls.tmp, 'server-%d.log' % port), 'w')
+    cls.servers.append(subprocess.Popen([sys.executable, os.path.join(REPO, 'app.py')],
+      cwd=cls.tmp, env=env, stdout=log, stderr=subprocess.STDOUT))
+    log.close()
+
+  @classmethod
+  def wait_until_ready(cls, port, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+      try:
+        if json.loads(Request(port, 'GET', '/health')[2])['status'] == 'ready':
+          return
+      except (socket.error, ValueError):
+        pass
+      time.sleep(0.2)
+    cls.tearDownClass()
+    raise AssertionError('server on port %d did not start' % port)
+
+  @classmethod
+  def tearDownClass(cls):
+    for server in cls.servers:
+      if server.poll() is None:
+        server.terminate()
+        server.wait()
+    cls.servers = []
+    shutil.rmtree(cls.tmp, ignore_errors=True)
+
+  def health(self, port):
+    return json.loads(Request(port, 'GET', '/health')[2])
+
+  def test_replica_follows_a_change(self):
+    status, headers, body = Request(self.primary_port, 'POST', '/login',
+      urlencode({'username': 'Admin', 'password': PASSWORD}),
+      {'Content-Type': 'application/x-www-form-urlencoded'})
+    self.assertEqual(status, 302)
+    cookie = headers['set-cookie'].split(';')[0]
+    status, headers, body = Request(self.primary_port, 'POST', '/processed-data/batch',
+      json.dumps({'updates': [{'condition': CONDITION, 'values': {'pyl_hz': 0.4321}}]}),
+      {'Content-Type': 'application/json', 'Cookie': cookie})
+    self.assertEqual(status, 200, body)
+    version = self.health(self.primary_port)['feed_version']
+    deadline = time.time() + 30
+    while (self.health(self.replica_port)['replica']['since'] or 0) < version:
+      self.assertLess(time.time(), deadline, 'replica did not follow the change')
+      time.sleep(0.2)
+    status, headers, body = Request(self.replica_port, 'GET', '/experiments/Admin-template')
+    self.assertEqual(status, 200)
+    self.assertIn(b'0.4321', body)
+
+  def test_edits_are_sent_to_the_primary(self):
+    primary = 'http://127.0.0.1:%d' % self.primary_port
+    status, headers, body = Request(self.replica_port, 'POST', '/processed-data/batch',
+      json.dumps({'updates': []}), {'Content-Type': 'application/json'})
+    self.assertEqual(status, 307)
+    self.assertEqual(headers['location'], primary+'/processed-data/batch')
+    status, headers, body = Request(self.replica_port, 'GET', '/changes?since=0')
+    self.assertEqual(status, 302)
+    self.assertEqual(headers['location'], primary+'/changes?since=0')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from support import TempDirTestCase
+from shard_store import ShardStore, WriteShards, ReadShards
+
+
+def Metadata(user, exp):
+  return [user, exp, '2012-04-01', None, None, 'Marder', 12, 12, 'Cancer borealis', None,
+    'cancer-std', 2, 0, 'lvn', '', '', 'Notes']
+
+
+def Condition(name, hz):
+  return [name, 12, hz] + [None]*30
+
+
+class ShardStoreTest(TempDirTestCase):
+  def setUp(self):
+    TempDirTestCase.setUp(self)
+    self.metadata = dict(('lab-%d' % n, Metadata('lab', str(n))) for n in range(3))
+    self.metadata['lab-empty'] = Metadata('lab', 'empty')
+    self.proc_data = {}
+    for n in range(3):
+      for cond in range(2):
+        self.proc_data['lab-%d_%d' % (n, cond)] = Condition('cond %d' % cond, 0.5*n + cond)
+
+  def open(self, max_bytes=2**20):
+    store = ShardStore(self.path('shards'), max_bytes)
+    store.load()
+    return store
+
+  def shard_size(self, exp_name):
+    return os.path.getsize(self.path('shards', exp_name+'.json'))
+
+  def test_migration_keeps_all_rows(self):
+    WriteShards(self.path('shards'), self.metadata, self.proc_data)
+    self.assertEqual(ReadShards(self.path('shards')), (self.metadata, self.proc_data))
+    store = self.open()
+    self.assertFalse(store.new)
+    self.assertEqual(dict(store.metadata), self.metadata)
+    self.assertEqual(sorted(store.conditions), sorted(self.proc_data))
+    self.assertEqual(dict(store.conditions.items()), self.proc_data)
+    self.assertNotIn('lab-empty_0', store.conditions)
+    self.assertNotIn(['not', 'a', 'key'], store.conditions)
+    # Writing again drops shards of experiments that are gone
+    del self.metadata['lab-2']
+    self.proc_data = dict((key, row) for key, row in self.proc_data.items()
+      if not key.startswith('lab-2_'))
+    WriteShards(self.path('shards'), self.metadata, self.proc_data)
+    self.assertFalse(os.path.exists(self.path('shards', 'lab-2.json')))
+    self.assertEqual(ReadShards(self.path('shards')), (self.metadata, self.proc_data))
+
+  def test_least_recently_used_experiments_are_evicted(self):
+    WriteShards(self.path('shards'), self.metadata, self.proc_data)
+    store = self.open(max_bytes=self.shard_size('lab-0') + self.shard_size('lab-1'))
+    conditions = store.conditions
+    conditions['lab-0_0'], conditions['lab-1_0']  # Reads two shards
+    self.assertEqual(list(conditions.cache), ['lab-0', 'lab-1'])
+    conditions['lab-0_1']  # lab-0 becomes the most recently used
+    conditions['lab-2_0']
+    self.assertEqual(list(conditions.cache), ['lab-0', 'lab-2'])
+    self.assertEqual(conditions.cached_bytes, self.shard_size('lab-0') + self.shard_size('lab-2'))
+    self.assertEqual(conditions['lab-1_1'], self.proc_data['lab-1_1'])  # Read again
+
+  def test_save_round_trip_and_cache_sizes(self):
+    WriteShards(self.path('shards'), self.metadata, self.proc_data)
+    store = self.open()
+    conditions = store.conditions
+    for cond in range(20):
+      conditions['lab-new_%d' % cond] = Condition('new %d' % cond, 1.25)
+    store.metadata['lab-new'] = Metadata('lab', 'new')
+    conditions['lab-0_0'] = Condition('changed', 3.5)
+    del conditions['lab-1_1']
+    store.save(set(['lab-new', 'lab-0', 'lab-1']))
+    # Sizes follow what was written, not only what was read
+    for exp_name in ('lab-new', 'lab-0', 'lab-1'):
+      self.assertEqual(conditions.sizes[exp_name], self.shard_size(exp_name))
+    self.assertEqual(conditions.cached_bytes, sum(conditions.sizes.values()))
+    self.assertEqual(conditions.pinned, set())
+    reopened = self.open()
+    self.assertEqual(dict(reopened.metadata), dict(store.metadata))
+    self.assertEqual(dict(reopened.conditions.items()), dict(conditions.items()))
+    self.assertEqual(reopened.conditions['lab-0_0'], Condition('changed', 3.5))
+    self.assertNotIn('lab-1_1', reopened.conditions)
+    self.assertEqual(len(reopened.conditions), len(self.proc_data) + 20 - 1)
+
+  def test_saved_new_experiment_counts_towards_the_budget(self):
+    WriteShards(self.path('shards'), self.metadata, self.proc_data)
+    store = self.open(max_bytes=self.shard_size('lab-0'))
+    store.conditions['lab-0_0']
+    for cond in range(20):
+      store.conditions['lab-new_%d' % cond] = Condition('new %d' % cond, 1.25)
+    store.metadata['lab-new'] = Metadata('lab', 'new')
+    self.assertEqual(list(store.conditions.cache), ['lab-0', 'lab-new'])
+    store.save(set(['lab-new']))
+    # Once saved, the new shard's size pushes the older experiment out
+    self.assertEqual(list(store.conditions.cache), ['lab-new'])
+    self.assertEqual(store.conditions.cached_bytes, self.shard_size('lab-new'))
+
+  def test_removed_experiment_loses_its_shard(self):
+    WriteShards(self.path('shards'), self.metadata, self.proc_data)
+    store = self.open()
+    del store.metadata['lab-2']
+    for key in ('lab-2_0', 'lab-2_1'):
+      del store.conditions[key]
+    store.save(set(['lab-2']))
+    self.assertFalse(os.path.exists(self.path('shards', 'lab-2.json')))
+    self.assertEqual(store.conditions.cached_bytes, sum(store.conditions.sizes.values()))
+    reopened = self.open()
+    self.assertNotIn('lab-2', reopened.metadata)
+    self.assertNotIn('lab-2_0', reopened.conditions)
+
+
+if __name__ == '__main__':
+  unittest.main()
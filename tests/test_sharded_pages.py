@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Pages over sharded storage read only the shards they show. The app's metadata and
+processed data are swapped for a ShardStore's for each test.
+"""
+import os
+from support import TempDirTestCase, LoadApp
+from shard_store import ShardStore, WriteShards
+
+
+class ShardedPagesTest(TempDirTestCase):
+  def setUp(self):
+    TempDirTestCase.setUp(self)
+    self.app = LoadApp()
+    template = self.app.metadata['Admin-template']
+    metadata, proc_data = {}, {}
+    for n in range(12):
+      exp_name = 'Admin-exp%d' % n
+      metadata[exp_name] = template[:1] + ['exp%d' % n] + template[2:11] + [3] + template[12:]
+      for condnum in range(3):
+        proc_data[exp_name+'_'+str(condnum)] = ['cond %d' % condnum, 10 + condnum,
+          n + 0.25*condnum] + [None]*30
+    WriteShards(self.path('shards'), metadata, proc_data)
+    self.shard_bytes = os.path.getsize(self.path('shards', 'Admin-exp0.json'))
+    self.store = ShardStore(self.path('shards'), 2*self.shard_bytes)
+    self.store.load()
+    self.saved = self.app.metadata, self.app.proc_data
+    self.app.metadata, self.app.proc_data = self.store.metadata, self.store.conditions
+    self.app.BumpDataVersion()  # Nothing rendered from the other data is reused
+    self.client = self.app.app.test_client()
+
+  def tearDown(self):
+    self.app.metadata, self.app.proc_data = self.saved
+    self.app.BumpDataVersion()
+    TempDirTestCase.tearDown(self)
+
+  def test_experiment_page_reads_only_its_shard(self):
+    response = self.client.get('/experiments/Admin-exp1')
+    self.assertEqual(response.status_code, 200)
+    self.assertIn(b'1.25', response.data)
+    self.assertNotIn(b'10.25', response.data)  # Admin-exp10's
+    self.assertEqual(list(self.store.conditions.cache), ['Admin-exp1'])
+
+  def test_all_conditions_page_stays_within_the_cache(self):
+    response = self.client.get('/dl-procdata-page')
+    self.assertEqual(response.status_code, 200)
+    for n in range(12):
+      self.assertIn(('Admin-exp%d_2' % n).encode('utf-8'), response.data)
+    self.assertLessEqual(len(self.store.conditions.cache), 2)
+    self.assertLessEqual(self.store.conditions.cached_bytes, 2*self.shard_bytes)
+
+  def test_metrics_in_batches_match_one_pass(self):
+    from derived_metrics import ComputeMetrics
+    whole = ComputeMetrics(self.store.metadata, self.store.conditions)
+    names = sorted(self.store.metadata)
+    batched = {}
+    for start in range(0, len(names), 5):
+      batched.update(ComputeMetrics(self.store.metadata, self.store.conditions,
+        names[start:start+5]))
+    self.assertEqual(batched, whole)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import os
+import hashlib
+import unittest
+import simplejson as json
+from support import TempDirTestCase
+import snapshot_tool
+
+
+def Entry(name, data, mtime=1450000000.0):
+  return [name, len(data), mtime, hashlib.sha256(data).hexdigest(), 'text/plain']
+
+
+class SnapshotTest(TempDirTestCase):
+  def setUp(self):
+    TempDirTestCase.setUp(self)
+    self.files = {'Admin-exp/READ_ME.txt': b'read me', 'Admin-exp/trace.abf': b'\x00\x01' * 500}
+    for relpath, data in self.files.items():
+      self.write(data, 'files', relpath)
+    self.save_databases({'Admin-exp': [Entry('READ_ME.txt', self.files['Admin-exp/READ_ME.txt']),
+      Entry('trace.abf', self.files['Admin-exp/trace.abf'])]})
+
+  def save_databases(self, manifest, metadata_note='first'):
+    texts = {'user_database': {'Admin': ['a@b.c', 'Admin', 'lab', 1]},
+      'user_pdatabase': {'Admin': 'x'}, 'metadata': {'Admin-exp': [metadata_note]},
+      'processed_data': {'Admin-exp_0': ['baseline']}, 'file_manifest': manifest}
+    for name, data in texts.items():
+      self.write(json.dumps(data).encode('utf-8'), 'databases', name+'.json')
+    self.manifest = manifest
+
+  def take(self):
+    return snapshot_tool.TakeSnapshot(self.path('snapshots'), self.path('databases'),
+      self.path('files'))
+
+  def info(self, name):
+    with open(self.path('snapshots', name, 'snapshot.json')) as infile:
+      return json.load(infile)
+
+  def test_unchanged_files_are_hard_linked(self):
+    first = self.take()
+    changed = b'read me, edited'
+    self.write(changed, 'files', 'Admin-exp', 'READ_ME.txt')
+    self.save_databases({'Admin-exp': [Entry('READ_ME.txt', changed),
+      self.manifest['Admin-exp'][1]]}, 'second')
+    second = self.take()
+    self.assertNotEqual(first, second)
+    self.assertEqual(snapshot_tool.ListSnapshots(self.path('snapshots')), [first, second])
+    inode = lambda name, relpath: os.stat(self.path('snapshots', name, 'files', relpath)).st_ino
+    self.assertEqual(inode(first, 'Admin-exp/trace.abf'), inode(second, 'Admin-exp/trace.abf'))
+    self.assertNotEqual(inode(first, 'Admin-exp/READ_ME.txt'),
+      inode(second, 'Admin-exp/READ_ME.txt'))
+    self.assertEqual(self.info(second)['linked'], 1)
+    self.assertEqual(self.read('snapshots', first, 'files', 'Admin-exp', 'READ_ME.txt'), b'read me')
+
+  def test_only_files_in_the_manifest_are_taken(self):
+    self.write(b'half an upl', 'files', 'Admin-exp', 'uploading.abf')
+    name = self.take()
+    self.assertEqual(sorted(self.info(name)['files']), sorted(self.files))
+    self.assertFalse(os.path.exists(self.path('snapshots', name, 'files', 'Admin-exp',
+      'uploading.abf')))
+
+  def test_file_changed_since_the_manifest_is_kept_as_found(self):
+    self.write(b'rewritten', 'files', 'Admin-exp', 'READ_ME.txt')
+    sleep, snapshot_tool.time.sleep = snapshot_tool.time.sleep, lambda seconds: None
+    try:
+      name = self.take()
+    finally:
+      snapshot_tool.time.sleep = sleep
+    self.assertEqual(self.info(name)['files']['Admin-exp/READ_ME.txt'][2],
+      hashlib.sha256(b'rewritten').hexdigest())
+    self.assertEqual(snapshot_tool.VerifySnapshot(self.path('snapshots', name)), [])
+
+  def test_verify_reports_damage(self):
+    name = self.take()
+    self.assertEqual(snapshot_tool.VerifySnapshot(self.path('snapshots', name)), [])
+    self.write(b'damaged', 'snapshots', name, 'files', 'Admin-exp', 'trace.abf')
+    os.remove(self.path('snapshots', name, 'databases', 'metadata.json'))
+    problems = snapshot_tool.VerifySnapshot(self.path('snapshots', name))
+    self.assertEqual(sorted(problems), ['database metadata is missing or damaged',
+      'file Admin-exp/trace.abf is missing or damaged'])
+    with self.assertRaises(RuntimeError):
+      snapshot_tool.RestoreSnapshot(self.path('snapshots', name), self.path('databases'),
+        self.path('files'))
+
+  def test_restore_brings_back_databases_and_files(self):
+    name = self.take()
+    databases = dict((db_name, self.read('databases', db_name+'.json'))
+      for db_name in snapshot_tool.DATABASES)
+    self.write(b'new file', 'files', 'Admin-exp', 'later.txt')
+    self.write(b'changed', 'files', 'Admin-exp', 'READ_ME.txt')
+    self.save_databases({}, 'changed')
+    snapshot_tool.RestoreSnapshot(self.path('snapshots', name), self.path('databases'),
+      self.path('files'))
+    for db_name, text in databases.items():
+      self.assertEqual(self.read('databases', db_name+'.json'), text)
+    self.assertEqual(sorted(os.listdir(self.path('files', 'Admin-exp'))),
+      ['READ_ME.txt', 'trace.abf'])
+    for relpath, data in self.files.items():
+      self.assertEqual(self.read('files', relpath), data)
+    self.assertFalse(os.path.exists(self.path('files.restoring')))
+    self.assertFalse(os.path.exists(self.path('files.replaced')))
+
+
+if __name__ == '__main__':
+  unittest.main()
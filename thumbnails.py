@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Thumbnails and medium-size previews of uploaded images (tiff, png, jpg, jpeg)
+
+Each image gets a small thumbnail and a medium preview, saved as JPEG in the cache
+directory and named by the image's SHA256 hash and size, so an image that is replaced
+gets new previews. The cache is kept under a size budget: when it grows past it, the
+least recently used previews are removed (serving a preview marks it as used). Removed
+previews are simply made again when next asked for.
+
+Needs the Pillow package. Without it, AVAILABLE is False and no previews are made.
+"""
+
+import os
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+AVAILABLE = Image is not None
+SIZES = {'thumb': 160, 'medium': 800}  # Longest side, in pixels
+IMAGE_EXTENSIONS = ('.tif', '.tiff', '.png', '.jpg', '.jpeg')
+
+
+def IsImage(filename):
+  return filename.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def CachedPath(cache_dir, sha, size):
+  return os.path.join(cache_dir, '%s-%s.jpg' % (sha, size))
+
+
+def Displayable(image):
+  # Converts to 8-bit RGB or greyscale. Microscope images are often 16-bit or float
+  # greyscale using a small part of the range, so those are stretched to min/max
+  if image.mode in ('I', 'F') or image.mode.startswith('I;16'):
+    import numpy as np
+    values = np.asarray(image, dtype=float)
+    low, high = values.min(), values.max()
+    scaled = (values - low) * (255.0 / (high - low)) if high > low else values*0
+    return Image.fromarray(scaled.astype(np.uint8), 'L')
+  if image.mode in ('L', 'RGB'):
+    return image
+  if image.mode in ('RGBA', 'LA', 'P', 'PA'):
+    # Transparent areas are shown as white
+    image = image.convert('RGBA')
+    background = Image.new('RGB', image.size, (255, 255, 255))
+    background.paste(image, mask=image.split()[3])
+    return background
+  return image.convert('RGB')
+
+
+def MakePreviews(source, cache_dir, sha):
+  # Writes the thumbnail and medium preview of the image file at source
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  image = Image.open(source)
+  image.draft('RGB', (SIZES['medium'], SIZES['medium']))  # Quick JPEG downscale on load
+  image = Displayable(image)
+  for size in sorted(SIZES, key=SIZES.get, reverse=True):
+    # Each size is made from the one above it, which is much quicker than the original
+    image.thumbnail((SIZES[size], SIZES[size]), Image.LANCZOS)
+    target = CachedPath(cache_dir, sha, size)
+    image.save(target+'.tmp', 'JPEG', quality=85)
+    os.rename(target+'.tmp', target)
+
+
+def Touch(path):
+  # Marks a cached preview as recently used
+  try:
+    os.utime(path, None)
+  except OSError:
+    pass
+
+
+def PruneCache(cache_dir, max_bytes):
+  # Removes least recently used previews until the cache fits in max_bytes
+  if not os.path.isdir(cache_dir):
+    return
+  entries = []
+  for name in os.listdir(cache_dir):
+    if name.endswith('.jpg'):
+      try:
+        stat = os.stat(os.path.join(cache_dir, name))
+      except OSError:
+        continue
+      entries.append((stat.st_mtime, stat.st_size, name))
+  total = sum(entry[1] for entry in entries)
+  for mtime, size, name in sorted(entries):
+    if total <= max_bytes:
+      break
+    try:
+      os.remove(os.path.join(cache_dir, name))
+    except OSError:
+      pass
+    total -= size
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Downsampled previews of uploaded Axon .abf recordings
+
+A preview is a min/max envelope of each channel: the recording is split into a fixed
+number of buckets (about one per screen pixel) and the lowest and highest sample of each
+bucket are kept. Drawn as a filled band this looks like the full trace at screen
+resolution, but takes kilobytes instead of the whole recording.
+
+Recordings are read by memory-mapping the file, so only the data pages actually touched
+are read from disk. ABF 1.x and 2.x files with gap-free or episodic data, stored as
+16-bit integers or 32-bit floats, are supported. Integer samples are scaled to the
+recorded units when the header has the scaling information needed.
+"""
+
+import mmap
+import struct
+
+BLOCK = 512  # ABF section positions are given in 512 byte blocks
+
+
+class PreviewError(Exception):
+  pass
+
+
+def ReadHeader(buf):
+  # Returns (data offset in bytes, sample count, channel count, data format,
+  # per-channel (scale, offset) or None, channel names)
+  signature = buf[:4]
+  if signature == b'ABF2':
+    data_block, data_bytes, data_count = struct.unpack_from('<IIq', buf, 236)
+    data_format, = struct.unpack_from('<h', buf, 30)
+    adc_block, adc_bytes, adc_count = struct.unpack_from('<IIq', buf, 92)
+    protocol_block, = struct.unpack_from('<I', buf, 76)
+    channels = adc_count
+    scaling = None
+    names = ['Channel %d' % n for n in range(channels)]
+    if protocol_block and adc_block:
+      adc_range, = struct.unpack_from('<f', buf, protocol_block*BLOCK + 110)
+      resolution, = struct.unpack_from('<i', buf, protocol_block*BLOCK + 118)
+      scaling = []
+      for n in range(channels):
+        entry = adc_block*BLOCK + n*adc_bytes
+        telegraph_enabled, = struct.unpack_from('<h', buf, entry + 2)
+        telegraph_gain, = struct.unpack_from('<f', buf, entry + 6)
+        programmable_gain, = struct.unpack_from('<f', buf, entry + 28)
+        scale_factor, instrument_offset, signal_gain, signal_offset = \
+          struct.unpack_from('<ffff', buf, entry + 40)
+        gain = scale_factor*signal_gain*programmable_gain*(telegraph_gain if telegraph_enabled else 1)
+        if gain == 0 or resolution == 0:
+          scaling = None
+          break
+        scaling.append((adc_range/(resolution*gain), instrument_offset - signal_offset))
+    return data_block*BLOCK, data_count, channels, data_format, scaling, names
+  if signature == b'ABF ':
+    samples, = struct.unpack_from('<i', buf, 10)
+    data_block, = struct.unpack_from('<i', buf, 40)
+    data_format, = struct.unpack_from('<h', buf, 100)
+    channels, = struct.unpack_from('<h', buf, 120)
+    adc_range, = struct.unpack_from('<f', buf, 244)
+    resolution, = struct.unpack_from('<i', buf, 252)
+    sequence = struct.unpack_from('<16h', buf, 410)
+    programmable_gain = struct.unpack_from('<16f', buf, 730)
+    scale_factor = struct.unpack_from('<16f', buf, 922)
+    instrument_offset = struct.unpack_from('<16f', buf, 986)
+    signal_gain = struct.unpack_from('<16f', buf, 1050)
+    signal_offset = struct.unpack_from('<16f', buf, 1114)
+    scaling = []
+    for n in range(channels):
+      adc = sequence[n]
+      if not 0 <= adc < 16:
+        scaling = None
+        break
+      gain = scale_factor[adc]*signal_gain[adc]*programmable_gain[adc]
+      if gain == 0 or resolution == 0:
+        scaling = None
+        break
+      scaling.append((adc_range/(resolution*gain), instrument_offset[adc] - signal_offset[adc]))
+    names = ['Channel %d' % n for n in range(channels)]
+    return data_block*BLOCK, samples, channels, data_format, scaling, names
+  raise PreviewError('Not an ABF file')
+
+
+def Envelope(path, buckets=1000):
+  """
+  Returns {'channels': [{'name', 'min': [...], 'max': [...]}], 'samples': n} for an .abf
+  file, with at most buckets min/max pairs per channel.
+  """
+  with open(path, 'rb') as infile:
+    buf = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    return MapEnvelope(buf, buckets)
+  except struct.error:
+    raise PreviewError('Damaged or truncated ABF header')
+  finally:
+    try:
+      buf.close()
+    except BufferError:  # An error left arrays viewing the map; they close it when freed
+      pass
+
+
+def MapEnvelope(buf, buckets):
+  import numpy as np
+  if len(buf) < 256:
+    raise PreviewError('Not an ABF file')
+  offset, count, channels, data_format, scaling, names = ReadHeader(buf)
+  if channels < 1 or count < channels:
+    raise PreviewError('Recording has no data')
+  dtype = np.dtype('<f4') if data_format == 1 else np.dtype('<i2')
+  per_channel = min(count, (len(buf) - offset) // dtype.itemsize) // channels
+  if per_channel < 1:
+    raise PreviewError('Recording has no data')
+  data = np.frombuffer(buf, dtype=dtype, count=per_channel*channels, offset=offset)
+  data = data.reshape(per_channel, channels)
+  size = max(1, -(-per_channel // buckets))  # samples per bucket, rounded up
+  starts = np.arange(0, per_channel, size)
+  preview = {'samples': int(per_channel), 'channels': []}
+  for n in range(channels):
+    column = data[:, n]
+    lows = np.minimum.reduceat(column, starts).astype(float)
+    highs = np.maximum.reduceat(column, starts).astype(float)
+    if data_format != 1 and scaling is not None:
+      scale, shift = scaling[n]
+      lows, highs = lows*scale + shift, highs*scale + shift
+      if scale < 0:
+        lows, highs = highs, lows
+    preview['channels'].append({'name': names[n], 'min': [round(v, 6) for v in lows],
+      'max': [round(v, 6) for v in highs]})
+  return preview
+
+
+def PreviewSvg(preview, width=1000, channel_height=120):
+  # Draws each channel's envelope as a filled band, stacked vertically
+  channels = preview['channels']
+  parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d">'
+    % (width, channel_height*len(channels))]
+  for n, channel in enumerate(channels):
+    lows, highs = channel['min'], channel['max']
+    if not lows:
+      continue
+    bottom, top = min(lows), max(highs)
+    span = (top - bottom) or 1.0
+    step = float(width) / max(1, len(lows) - 1)
+    def y(value):
+      return n*channel_height + 5 + (channel_height - 20)*(top - value)/span
+    points = ['%.1f,%.1f' % (i*step, y(v)) for i, v in enumerate(highs)] + \
+      ['%.1f,%.1f' % (i*step, y(v)) for i, v in reversed(list(enumerate(lows)))]
+    parts.append('<polygon points="%s" fill="#335" stroke="#335" stroke-width="0.5"/>'
+      % ' '.join(points))
+    parts.append('<text x="4" y="%d" font-size="11" fill="#a00">%s (%.4g to %.4g)</text>'
+      % ((n+1)*channel_height - 4, channel['name'], bottom, top))
+  parts.append('</svg>')
+  return '\n'.join(parts)